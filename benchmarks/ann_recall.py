@@ -0,0 +1,76 @@
+"""Recall@k and query time of the approximate studies index.
+
+Builds an `IVFIndex` over a synthetic corpus of studies loadings (clustered
+around random topics, like real study maps) and reports, for several values
+of `n_probe`, the fraction of the exact top-k studies found and the time per
+query compared to an exact scan.
+
+    python benchmarks/ann_recall.py --n_studies 200000 --k 50
+
+"""
+import argparse
+import time
+
+import numpy as np
+
+from neuroquery_image_search._ann import IVFIndex, recall_at_k
+from neuroquery_image_search._ranking import top_k_rows
+
+
+def make_corpus(n_studies, n_components, n_topics, n_queries, seed=0):
+    rng = np.random.default_rng(seed)
+    topics = rng.standard_normal((n_topics, n_components))
+
+    def sample(n):
+        mixture = topics[rng.integers(n_topics, size=n)]
+        return mixture + 0.7 * rng.standard_normal((n, n_components))
+
+    return sample(n_studies), sample(n_queries)
+
+
+def _time_per_query(search, queries, n_repeats=3):
+    best = np.inf
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        search(queries)
+        best = min(best, time.perf_counter() - start)
+    return best / len(queries)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--n_studies", type=int, default=100000)
+    parser.add_argument("--n_components", type=int, default=512)
+    parser.add_argument("--n_topics", type=int, default=300)
+    parser.add_argument("--n_queries", type=int, default=100)
+    parser.add_argument("--n_lists", type=int, default=None)
+    parser.add_argument("--k", type=int, default=50)
+    parser.add_argument(
+        "--n_probe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64]
+    )
+    args = parser.parse_args(args)
+    loadings, queries = make_corpus(
+        args.n_studies, args.n_components, args.n_topics, args.n_queries
+    )
+    start = time.perf_counter()
+    index = IVFIndex(loadings, n_lists=args.n_lists)
+    print(
+        f"Built index with {index.n_lists} lists over {args.n_studies:,} "
+        f"studies in {time.perf_counter() - start:.2f}s"
+    )
+    exact_time = _time_per_query(
+        lambda q: top_k_rows(q.dot(loadings.T), args.k), queries
+    )
+    print(f"exact scan: {exact_time * 1e3:.3f} ms/query")
+    print(f"{'n_probe':>8} {f'recall@{args.k}':>10} {'ms/query':>10}")
+    for n_probe in args.n_probe:
+        index.n_probe = n_probe
+        recall = recall_at_k(index, queries, args.k)
+        query_time = _time_per_query(
+            lambda q: index.search(q, args.k), queries
+        )
+        print(f"{n_probe:>8} {recall:>10.3f} {query_time * 1e3:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""Time each stage of the search pipeline on synthetic corpora.
+
+For each number of studies, a synthetic data bundle (see `synthetic.py`) is
+written in a temporary directory (or reused from `--data_root`) and the
+following stages are timed separately:
+
+- fetch_data: loading the data files
+- prepare: creating `NeuroQueryImageSearch` (projection, indexes)
+- masking: masking the query images
+- projection: projecting the masked images on the atlas
+- scoring_studies, scoring_terms: similarities with all studies and terms
+- top_k_studies, top_k_terms: selecting the most similar ones
+- dataframes: building the results DataFrames
+- json, html: serializing the results of one image
+
+Each stage is run `--n_repeats` times; the first and the best times are
+reported (the first run includes cold caches, e.g. for lazy loading).
+`--save` writes the timings to a JSON file, and `--compare` prints the ratio
+to timings saved by a previous run, to check for regressions.
+
+    python benchmarks/search_pipeline.py --n_studies 10000 100000 1000000
+    python benchmarks/search_pipeline.py --save before.json
+    python benchmarks/search_pipeline.py --compare before.json
+
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+import tempfile
+import time
+
+import numpy as np
+
+from neuroquery_image_search import _searching
+from neuroquery_image_search._datasets import fetch_data
+from neuroquery_image_search._ranking import top_k_rows
+from neuroquery_image_search._results import SearchHits
+
+from synthetic import make_data_home, make_query_imgs
+
+
+def _time(func, n_repeats):
+    """Run `func` `n_repeats` times; return its result, first and best time."""
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, times[0], min(times)
+
+
+def run_stages(args, n_studies, data_home):
+    """Time all stages for one corpus; returns {stage: (first, best)}."""
+    os.environ["NEUROQUERY_DATA_DIR"] = str(data_home)
+    timings = {}
+
+    def timed(stage, func):
+        result, first, best = _time(func, args.n_repeats)
+        timings[stage] = first, best
+        return result
+
+    data = timed("fetch_data", lambda: fetch_data(lazy=args.lazy))
+    search = timed(
+        "prepare",
+        lambda: _searching.NeuroQueryImageSearch(
+            data=data,
+            projection=args.projection,
+            dtype=np.dtype(args.dtype).type,
+            n_shards=args.n_shards,
+        ),
+    )
+    imgs = make_query_imgs(data["masker"].mask_img_, args.n_queries)
+    masked = timed("masking", lambda: search._masker.transform(imgs))
+    queries = timed("projection", lambda: search.projection.project(masked))
+    results = {}
+    for kind, n_results, score, info in [
+        (
+            "studies",
+            args.n_results,
+            search._studies_scorer.scores,
+            search.studies_info,
+        ),
+        (
+            "terms",
+            args.n_results,
+            search._terms_scorer.scores,
+            search.terms_info,
+        ),
+    ]:
+        scores = timed(f"scoring_{kind}", lambda: score(queries))
+        indices = timed(f"top_k_{kind}", lambda: top_k_rows(scores, n_results))
+        results[kind] = info, indices, np.take_along_axis(scores, indices, 1)
+    all_results = timed(
+        "dataframes",
+        lambda: {
+            kind: [
+                SearchHits(info, index, similarity).to_dataframe()
+                for index, similarity in zip(indices, similarities)
+            ]
+            for kind, (info, indices, similarities) in results.items()
+        },
+    )
+    first_results = {
+        "studies": all_results["studies"][0],
+        "terms": all_results["terms"][0],
+        "image": imgs[0],
+    }
+    timed("json", lambda: _searching._results_to_json(first_results))
+    timed(
+        "html",
+        lambda: _searching.results_to_html(
+            first_results, img_display=args.img_display
+        ),
+    )
+    return timings
+
+
+def _print_timings(n_studies, timings, baseline):
+    print(f"\n{n_studies:,} studies")
+    header = f"{'stage':<16} {'first (s)':>10} {'best (s)':>10}"
+    if baseline is not None:
+        header += f" {'vs saved':>9}"
+    print(header)
+    for stage, (first, best) in timings.items():
+        line = f"{stage:<16} {first:>10.4f} {best:>10.4f}"
+        if baseline is not None and stage in baseline:
+            line += f" {best / baseline[stage][1]:>8.2f}x"
+        print(line)
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--n_studies", type=int, nargs="+", default=[10_000, 100_000]
+    )
+    parser.add_argument("--n_voxels", type=int, default=200_000)
+    parser.add_argument("--n_components", type=int, default=1024)
+    parser.add_argument("--n_terms", type=int, default=7_500)
+    parser.add_argument("--n_queries", type=int, default=8)
+    parser.add_argument("--n_results", type=int, default=50)
+    parser.add_argument("--n_repeats", type=int, default=3)
+    parser.add_argument("--dtype", default="float64")
+    parser.add_argument("--projection", default="auto")
+    parser.add_argument("--n_shards", type=int, default=1)
+    parser.add_argument("--lazy", action="store_true")
+    parser.add_argument(
+        "--img_display", choices=["viewer", "static", "none"], default="none"
+    )
+    parser.add_argument(
+        "--data_root",
+        default=None,
+        help="Directory in which synthetic data bundles are kept between "
+        "runs (by default they are written in a temporary directory)",
+    )
+    parser.add_argument("--save", default=None, help="JSON file for timings")
+    parser.add_argument(
+        "--compare", default=None, help="JSON file saved by a previous run"
+    )
+    return parser
+
+
+def main(args=None):
+    args = _get_parser().parse_args(args)
+    baseline = {}
+    if args.compare is not None:
+        baseline = json.loads(Path(args.compare).read_text())["timings"]
+    all_timings = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_root = Path(args.data_root or tmp_dir)
+        for n_studies in args.n_studies:
+            data_home = data_root.joinpath(
+                f"{args.n_voxels}_{args.n_components}_{n_studies}_"
+                f"{args.n_terms}_{args.dtype}"
+            )
+            if not data_home.is_dir():
+                start = time.perf_counter()
+                make_data_home(
+                    data_home,
+                    n_voxels=args.n_voxels,
+                    n_components=args.n_components,
+                    n_studies=n_studies,
+                    n_terms=args.n_terms,
+                    dtype=args.dtype,
+                )
+                print(
+                    f"Created data with {n_studies:,} studies in "
+                    f"{time.perf_counter() - start:.1f}s"
+                )
+            timings = run_stages(args, n_studies, data_home)
+            all_timings[str(n_studies)] = timings
+            _print_timings(
+                n_studies,
+                timings,
+                baseline.get(str(n_studies)) if args.compare else None,
+            )
+    if args.save is not None:
+        Path(args.save).write_text(
+            json.dumps({"params": vars(args), "timings": all_timings})
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""Synthetic NeuroQuery image search data with realistic (or larger) shapes.
+
+Writes the same files as the downloaded data (`mask.nii.gz`,
+`difumo_maps.npz`, `difumo_inverse_covariance.npy`, `projections.npy`,
+`term_projections.npy`, `articles-info.csv`, `document_frequencies.csv`) so
+that `fetch_data` and the whole search pipeline can be run on them. The real
+data has about 200k voxels, 1024 DiFuMo components, 14k studies and 7.5k
+terms; the number of studies can be increased to benchmark larger corpora.
+Loadings are written in chunks to memory-mapped files, so corpora larger
+than the available memory can be created.
+
+    python benchmarks/synthetic.py /tmp/nq_data --n_studies 1000000
+
+"""
+import argparse
+from pathlib import Path
+
+import nibabel
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# shape and affine of the MNI152 2mm template, in which the real mask is
+MASK_SHAPE = (91, 109, 91)
+MASK_AFFINE = np.array(
+    [
+        [-2.0, 0.0, 0.0, 90.0],
+        [0.0, 2.0, 0.0, -126.0],
+        [0.0, 0.0, 2.0, -72.0],
+        [0.0, 0.0, 0.0, 1.0],
+    ]
+)
+_CHUNK_SIZE = 2**14
+
+
+def make_mask(n_voxels):
+    """Ellipsoid-shaped mask with `n_voxels` voxels in the MNI 2mm grid."""
+    n_voxels = min(n_voxels, int(np.prod(MASK_SHAPE)))
+    coords = np.indices(MASK_SHAPE).reshape((3, -1)).T
+    center = (np.asarray(MASK_SHAPE) - 1) / 2
+    distances = (((coords - center) / center) ** 2).sum(axis=1)
+    mask = np.zeros(np.prod(MASK_SHAPE), dtype="uint8")
+    mask[np.argsort(distances, kind="stable")[:n_voxels]] = 1
+    return nibabel.Nifti1Image(mask.reshape(MASK_SHAPE), MASK_AFFINE)
+
+
+def make_atlas_maps(n_components, n_voxels, density, rng):
+    """Sparse nonnegative maps, each covering a contiguous range of voxels."""
+    rows, cols = [], []
+    width = max(1, int(density * n_voxels))
+    for component in range(n_components):
+        start = rng.integers(max(1, n_voxels - width))
+        cols.append(np.arange(start, min(start + width, n_voxels)))
+        rows.append(np.full(len(cols[-1]), component))
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    return sparse.csr_matrix(
+        (rng.random(len(rows)), (rows, cols)), shape=(n_components, n_voxels)
+    )
+
+
+def write_loadings(output_file, n_rows, n_components, n_topics, dtype, rng):
+    """Loadings clustered around random topics, like real study maps."""
+    topics = rng.standard_normal((n_topics, n_components))
+    loadings = np.lib.format.open_memmap(
+        str(output_file), mode="w+", dtype=dtype, shape=(n_rows, n_components)
+    )
+    for start in range(0, n_rows, _CHUNK_SIZE):
+        n = min(_CHUNK_SIZE, n_rows - start)
+        chunk = topics[rng.integers(n_topics, size=n)]
+        chunk += 0.7 * rng.standard_normal((n, n_components))
+        loadings[start : start + n] = chunk
+    loadings.flush()
+    del loadings
+
+
+def make_synthetic_data(
+    data_dir,
+    n_voxels=200_000,
+    n_components=1024,
+    n_studies=14_000,
+    n_terms=7_500,
+    density=0.02,
+    dtype="float64",
+    seed=0,
+):
+    """Write a synthetic data bundle in `data_dir` and return its path.
+
+    See `make_data_home` to write it where `fetch_data` finds it.
+    """
+    rng = np.random.default_rng(seed)
+    data_dir = Path(data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    mask_img = make_mask(n_voxels)
+    n_voxels = int(np.asarray(mask_img.dataobj).sum())
+    mask_img.to_filename(str(data_dir / "mask.nii.gz"))
+    atlas_maps = make_atlas_maps(n_components, n_voxels, density, rng)
+    sparse.save_npz(str(data_dir / "difumo_maps.npz"), atlas_maps)
+    covariance = atlas_maps.dot(atlas_maps.T).toarray()
+    np.save(
+        str(data_dir / "difumo_inverse_covariance.npy"),
+        np.linalg.pinv(covariance),
+    )
+    n_topics = max(1, min(300, n_studies // 10))
+    write_loadings(
+        data_dir / "projections.npy",
+        n_studies,
+        n_components,
+        n_topics,
+        dtype,
+        rng,
+    )
+    write_loadings(
+        data_dir / "term_projections.npy",
+        n_terms,
+        n_components,
+        n_topics,
+        dtype,
+        rng,
+    )
+    pmids = np.arange(n_studies) + 10_000_000
+    pd.DataFrame(
+        {
+            "pmid": pmids,
+            "title": [f"Synthetic study {pmid}" for pmid in pmids],
+            "pubmed_url": [
+                f"https://www.ncbi.nlm.nih.gov/pubmed/{pmid}" for pmid in pmids
+            ],
+        }
+    ).to_csv(str(data_dir / "articles-info.csv"), index=False)
+    pd.DataFrame(
+        {
+            "term": [f"term {i}" for i in range(n_terms)],
+            "document_frequency": rng.integers(1, n_studies + 1, n_terms),
+        }
+    ).to_csv(str(data_dir / "document_frequencies.csv"), index=False)
+    return data_dir
+
+
+def make_data_home(home, **params):
+    """Write synthetic data where `fetch_data` finds it.
+
+    Returns the directory to set as `NEUROQUERY_DATA_DIR`.
+    """
+    home = Path(home)
+    make_synthetic_data(
+        home / "extra" / "neuroquery_image_search_data", **params
+    )
+    return home
+
+
+def make_query_imgs(mask_img, n_queries, seed=1):
+    """Random images in the space of the mask."""
+    rng = np.random.default_rng(seed)
+    mask = np.asarray(mask_img.dataobj) != 0
+    imgs = []
+    for _ in range(n_queries):
+        data = np.zeros(mask.shape)
+        data[mask] = rng.standard_normal(mask.sum())
+        imgs.append(nibabel.Nifti1Image(data, mask_img.affine))
+    return imgs
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "data_home",
+        help="Directory to use as NEUROQUERY_DATA_DIR; the data is written "
+        "in its 'extra/neuroquery_image_search_data' subdirectory",
+    )
+    parser.add_argument("--n_voxels", type=int, default=200_000)
+    parser.add_argument("--n_components", type=int, default=1024)
+    parser.add_argument("--n_studies", type=int, default=14_000)
+    parser.add_argument("--n_terms", type=int, default=7_500)
+    parser.add_argument("--dtype", default="float64")
+    return parser
+
+
+def main(args=None):
+    args = _get_parser().parse_args(args)
+    home = make_data_home(
+        args.data_home,
+        n_voxels=args.n_voxels,
+        n_components=args.n_components,
+        n_studies=args.n_studies,
+        n_terms=args.n_terms,
+        dtype=args.dtype,
+    )
+    print(f"Use with NEUROQUERY_DATA_DIR={home}")
+
+
+if __name__ == "__main__":
+    main()
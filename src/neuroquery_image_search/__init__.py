@@ -7,6 +7,11 @@ __all__ = [
     "studies_to_html_table",
     "terms_to_html_table",
     "results_to_html",
+    "build_index",
+    "load_index",
+    "ResultCache",
+    "Profiler",
+    "publish_data",
 ]
 
 from pathlib import Path
@@ -20,3 +25,7 @@ from ._searching import (
     terms_to_html_table,
     results_to_html,
 )
+from ._index import build_index, load_index
+from ._caching import ResultCache
+from ._profiling import Profiler
+from ._registry import publish_data
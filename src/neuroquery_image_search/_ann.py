@@ -0,0 +1,252 @@
+"""Approximate maximum-inner-product search over the studies loadings.
+
+An inverted file (IVF) index: the loadings are clustered with spherical
+k-means and their rows are grouped by cluster ("list"). A query is compared
+to the cluster centroids, and only the rows of the `n_probe` lists whose
+centroids have the largest inner product with the query are scored exactly.
+Scanning more lists increases recall and cost; scanning all of them is an
+exact search.
+
+Building the lists reads all the loadings, so `build_index` saves them in
+the binary index and `NeuroQueryImageSearch` reuses them.
+
+"""
+import numpy as np
+from scipy import sparse
+
+from neuroquery_image_search._ranking import (
+    top_k,
+    top_k_rows,
+    rescale_selected,
+)
+
+# k-means is trained on at most this many rows per list
+_TRAINING_ROWS_PER_LIST = 64
+# rows are assigned to lists in chunks of this size
+_CHUNK_SIZE = 2**14
+
+
+class IVFIndex:
+    """Inverted file index for approximate maximum-inner-product search.
+
+    Parameters
+    ----------
+    vectors : array of shape (n rows, n components), e.g. the (folded)
+        studies loadings of a `Projection`. It is not copied, so memory-mapped
+        loadings stay on disk and only the rows of scanned lists are read.
+
+    n_lists : number of clusters. By default, about `sqrt(n rows)`.
+
+    n_probe : number of lists scanned for each query; the recall/speed knob.
+        It can be changed after the index is built.
+
+    n_iter : number of k-means iterations.
+
+    random_state : seed for the k-means initialization and training sample.
+
+    lists : `None` or dict returned by `build_lists` for these vectors (for
+        example saved by `build_index`). If provided, the lists are not built
+        again and `n_lists`, `n_iter` and `random_state` are ignored.
+
+    Attributes
+    ----------
+    centroids : array of shape (n lists, n components), unit-norm centroids
+
+    list_offsets : array of shape (n lists + 1,); the rows of list `l` are
+        `row_ids[list_offsets[l]:list_offsets[l + 1]]`
+
+    row_ids : positions in `vectors` of the rows, grouped by list
+
+    """
+
+    def __init__(
+        self,
+        vectors,
+        n_lists=None,
+        n_probe=8,
+        n_iter=10,
+        random_state=0,
+        lists=None,
+    ):
+        self.vectors = vectors
+        if lists is None:
+            lists = build_lists(vectors, n_lists, n_iter, random_state)
+        self.centroids = lists["centroids"]
+        self.row_ids = lists["row_ids"]
+        self.list_offsets = lists["list_offsets"]
+        if len(self.row_ids) != vectors.shape[0]:
+            raise ValueError(
+                f"IVF lists hold {len(self.row_ids)} rows, "
+                f"vectors have {vectors.shape[0]}"
+            )
+        self.n_lists = len(self.centroids)
+        self.n_probe = n_probe
+
+    @property
+    def n_rows(self):
+        return len(self.row_ids)
+
+    def search(self, queries, k, rescale_similarities=False, exact=False):
+        """The `k` rows with the largest inner product with each query.
+
+        Parameters
+        ----------
+        queries : array of shape (n queries, n components)
+
+        k : number of results per query
+
+        rescale_similarities : if `True`, similarities are rescaled to the
+            range [0, 1] using the minimum and maximum over the scanned rows
+            (all rows for an exact search).
+
+        exact : if `True`, all rows are scanned, whatever `n_probe`.
+
+        Returns
+        -------
+        indices : array of shape (n queries, min(k, n rows)), positions of
+            the selected rows in `vectors`, by decreasing inner product
+
+        similarities : array of the same shape, the inner products
+
+        """
+        indices, similarities, low, high = self.search_with_range(
+            queries, k, exact
+        )
+        if rescale_similarities:
+            similarities = rescale_selected(similarities, low, high)
+        return indices, similarities
+
+    def search_with_range(self, queries, k, exact=False):
+        """Like `search`, also returning the range of the scanned scores.
+
+        Returns
+        -------
+        indices, similarities : see `search`; similarities are not rescaled.
+
+        low, high : arrays of shape (n queries,), minimum and maximum
+            inner product among the scanned rows.
+
+        """
+        queries = np.atleast_2d(np.asarray(queries))
+        k = max(0, min(k, self.n_rows))
+        if exact or self.n_probe >= self.n_lists:
+            return self._search_exact(queries, k)
+        probe_order = top_k_rows(queries.dot(self.centroids.T), self.n_lists)
+        indices = np.empty((len(queries), k), dtype=int)
+        similarities = np.empty((len(queries), k), dtype=self.vectors.dtype)
+        low = np.empty(len(queries))
+        high = np.empty(len(queries))
+        for i, query in enumerate(queries):
+            # scan candidates by position in `vectors` so ties are broken as
+            # in an exact search
+            ids = np.sort(
+                self.row_ids[self._candidate_rows(probe_order[i], k)]
+            )
+            scores = self.vectors[ids].dot(query)
+            selected = top_k(scores, k)
+            indices[i] = ids[selected]
+            similarities[i] = scores[selected]
+            low[i], high[i] = scores.min(), scores.max()
+        return indices, similarities, low, high
+
+    def _candidate_rows(self, probe_order, k):
+        """Positions in `row_ids` of the rows of the first `n_probe` lists.
+
+        More lists are added if they have fewer than `k` rows.
+        """
+        slices, n_candidates = [], 0
+        for n_probed, list_id in enumerate(probe_order):
+            if n_probed >= self.n_probe and n_candidates >= k:
+                break
+            start, stop = self.list_offsets[list_id : list_id + 2]
+            slices.append(np.arange(start, stop))
+            n_candidates += stop - start
+        return np.concatenate(slices)
+
+    def _search_exact(self, queries, k):
+        all_scores = queries.dot(self.vectors.T)
+        selected = top_k_rows(all_scores, k)
+        return (
+            selected,
+            np.take_along_axis(all_scores, selected, axis=1),
+            all_scores.min(axis=1),
+            all_scores.max(axis=1),
+        )
+
+
+def build_lists(vectors, n_lists=None, n_iter=10, random_state=0):
+    """Cluster the rows of `vectors` into the lists of an `IVFIndex`.
+
+    See `IVFIndex` for the parameters. Returns a dict with keys "centroids",
+    "row_ids" and "list_offsets" (see the `IVFIndex` attributes).
+    """
+    n_rows = vectors.shape[0]
+    if n_lists is None:
+        n_lists = int(round(np.sqrt(n_rows)))
+    n_lists = max(1, min(n_lists, n_rows))
+    centroids = _spherical_kmeans(
+        vectors, n_lists, n_iter, np.random.default_rng(random_state)
+    )
+    assignment = _assign(vectors, centroids)
+    list_offsets = np.zeros(n_lists + 1, dtype=int)
+    np.cumsum(np.bincount(assignment, minlength=n_lists), out=list_offsets[1:])
+    return {
+        "centroids": centroids,
+        "row_ids": np.argsort(assignment, kind="stable"),
+        "list_offsets": list_offsets,
+    }
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _assign(vectors, centroids):
+    """Index of the centroid with the largest cosine similarity for each row."""
+    assignment = np.empty(len(vectors), dtype=int)
+    for start in range(0, len(vectors), _CHUNK_SIZE):
+        chunk = _normalize(np.asarray(vectors[start : start + _CHUNK_SIZE]))
+        assignment[start : start + len(chunk)] = chunk.dot(centroids.T).argmax(
+            axis=1
+        )
+    return assignment
+
+
+def _spherical_kmeans(vectors, n_clusters, n_iter, rng):
+    """Unit-norm centroids of `vectors` clustered by cosine similarity."""
+    n_rows = len(vectors)
+    n_train = min(n_rows, _TRAINING_ROWS_PER_LIST * n_clusters)
+    sample = np.sort(rng.choice(n_rows, n_train, replace=False))
+    train = _normalize(np.asarray(vectors[sample], dtype=np.float64))
+    centroids = train[rng.choice(n_train, n_clusters, replace=False)]
+    for _ in range(n_iter):
+        assignment = train.dot(centroids.T).argmax(axis=1)
+        membership = sparse.csr_matrix(
+            (np.ones(n_train), (assignment, np.arange(n_train))),
+            shape=(n_clusters, n_train),
+        )
+        sums = np.asarray(membership.dot(train))
+        empty = ~sums.any(axis=1)
+        # empty clusters are re-seeded with random training rows
+        sums[empty] = train[rng.choice(n_train, empty.sum(), replace=False)]
+        centroids = _normalize(sums)
+    return centroids
+
+
+def recall_at_k(index, queries, k):
+    """Fraction of the exact top `k` rows found by the approximate search.
+
+    Averaged over the queries; exact results are computed with
+    `index.search(queries, k, exact=True)`.
+    """
+    exact, _ = index.search(queries, k, exact=True)
+    approximate, _ = index.search(queries, k)
+    if not exact.size:
+        return 1.0
+    found = [
+        len(np.intersect1d(expected, obtained))
+        for expected, obtained in zip(exact, approximate)
+    ]
+    return float(np.sum(found) / exact.size)
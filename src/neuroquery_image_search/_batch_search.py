@@ -0,0 +1,292 @@
+"""Searching with many images while loading the search data only once.
+
+Query images are given as files, directories (all NIfTI files they contain)
+or glob patterns, and optionally listed in a manifest file with one path per
+line. Loading and masking the images is spread over a pool of processes;
+masked images are sent back to the main process, where they are projected and
+scored in batches with the (possibly memory-mapped) search data, so the
+loadings are never copied to the workers.
+
+"""
+from concurrent.futures import ProcessPoolExecutor
+import glob
+from pathlib import Path
+import sys
+
+import numpy as np
+
+from neuroquery_image_search._masking import QueryMasker
+from neuroquery_image_search._searching import _transform_masked_imgs
+from neuroquery_image_search._output import open_writer
+
+_NIFTI_SUFFIXES = (".nii", ".nii.gz")
+_COMBINED_SUFFIXES = (
+    ".jsonl",
+    ".npz",
+    ".npy",
+    ".parquet",
+    ".arrow",
+    ".feather",
+)
+
+# masker used by the worker processes, set by `_init_worker`
+_worker_masker = None
+
+# the `initializer` of `ProcessPoolExecutor` needs Python 3.7; otherwise the
+# masker is sent to the workers with each image
+_POOL_INITIALIZER = sys.version_info >= (3, 7)
+
+
+def _is_nifti(path):
+    return str(path).endswith(_NIFTI_SUFFIXES)
+
+
+def _is_glob(pattern):
+    return any(char in str(pattern) for char in "*?[")
+
+
+def read_manifest(manifest_file):
+    """Paths listed in a manifest, one per line.
+
+    Empty lines and lines starting with "#" are ignored; relative paths are
+    relative to the manifest's directory.
+    """
+    manifest_file = Path(manifest_file)
+    paths = []
+    for line in manifest_file.read_text(encoding="utf-8").splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        path = Path(line)
+        if not path.is_absolute():
+            path = manifest_file.parent / path
+        paths.append(str(path))
+    return paths
+
+
+def is_batch(query_imgs, manifest=None, output=None):
+    """Whether the CLI should use `batch_search`.
+
+    That is the case if the inputs designate more than one image or if the
+    output is a file in one of the formats only written by `batch_search`.
+    """
+    if manifest is not None or len(query_imgs) > 1:
+        return True
+    if output is not None and Path(output).suffix in _COMBINED_SUFFIXES:
+        return True
+    return any(Path(p).is_dir() or _is_glob(p) for p in query_imgs)
+
+
+def expand_query_imgs(query_imgs, manifest=None):
+    """List the image files designated by paths, directories and globs.
+
+    Directories are replaced by the NIfTI files they contain (not
+    recursively), and glob patterns by the files they match, in sorted order.
+    Paths listed in `manifest` are added after `query_imgs`.
+    """
+    inputs = list(query_imgs)
+    if manifest is not None:
+        inputs.extend(read_manifest(manifest))
+    paths = []
+    for query in inputs:
+        if Path(query).is_dir():
+            paths.extend(
+                str(p) for p in sorted(Path(query).iterdir()) if _is_nifti(p)
+            )
+        elif _is_glob(query):
+            matches = sorted(glob.glob(query, recursive=True))
+            if not matches:
+                raise FileNotFoundError(f"No image matches {query}")
+            paths.extend(matches)
+        else:
+            paths.append(str(query))
+    return paths
+
+
+def image_names(paths):
+    """Unique names for output files, derived from image file names."""
+    names, seen = [], set()
+    for path in paths:
+        name = Path(path).name if isinstance(path, (str, Path)) else "Image"
+        for suffix in _NIFTI_SUFFIXES[::-1]:
+            if name.endswith(suffix):
+                name = name[: -len(suffix)]
+                break
+        unique_name, i = name, 1
+        while unique_name in seen:
+            unique_name = f"{name}_{i}"
+            i += 1
+        seen.add(unique_name)
+        names.append(unique_name)
+    return names
+
+
+def _init_worker(masker, interpolation):
+    global _worker_masker
+    _worker_masker = QueryMasker(masker, interpolation)
+
+
+def _mask_img(path, transform, masker=None, init_args=None):
+    from nilearn import image
+
+    if masker is None:
+        if init_args is not None:
+            _init_worker(*init_args)
+        masker = _worker_masker
+    img = image.load_img(path)
+    if len(img.shape) != 3:
+        raise ValueError(f"Expected a 3D image, got shape {img.shape}")
+    return _transform_masked_imgs(masker.transform([img]), transform)[0]
+
+
+def batch_search(
+    search,
+    query_imgs,
+    output,
+    n_studies=50,
+    n_terms=20,
+    transform="absolute_value",
+    rescale_similarities=True,
+    output_format="json",
+    n_jobs=1,
+    batch_size=64,
+    verbose=True,
+):
+    """Search with each image in `query_imgs` and write the results.
+
+    Parameters
+    ----------
+    search : `NeuroQueryImageSearch`
+
+    query_imgs : list of paths to 3D images or `nibabel.Nifti1Image`
+
+    output : where results are written; the format depends on the
+        extension: ".jsonl", ".npz", ".npy", ".parquet", ".arrow" or
+        ".feather" files
+        contain the results for all images (see `_output.open_writer`).
+        Otherwise it is a directory in which one file per image is written.
+
+    n_studies, n_terms, transform, rescale_similarities :
+        see `NeuroQueryImageSearch.__call__`
+
+    output_format : "json" or "html", format of the per-image files when
+        `output` is a directory.
+
+    n_jobs : number of processes loading and masking images.
+
+    batch_size : number of images scored together.
+
+    verbose : whether to print progress.
+
+    Returns
+    -------
+    failed : dict mapping the paths of images that could not be searched to
+        the error message.
+
+    """
+    names = image_names(query_imgs)
+    writer = open_writer(output, search, output_format, image_names=names)
+    executor, init_args = None, None
+    if n_jobs > 1:
+        resampling = search._masker.resampling
+        init_args = (
+            search.data["masker"],
+            None if resampling is None else resampling.interpolation,
+        )
+        if _POOL_INITIALIZER:
+            executor = ProcessPoolExecutor(
+                max_workers=n_jobs,
+                initializer=_init_worker,
+                initargs=init_args,
+            )
+            init_args = None
+        else:
+            executor = ProcessPoolExecutor(max_workers=n_jobs)
+    failed = {}
+    n_done = 0
+    try:
+        for start in range(0, len(query_imgs), batch_size):
+            batch = list(
+                range(start, min(start + batch_size, len(query_imgs)))
+            )
+            if executor is None:
+                futures = None
+            else:
+                futures = [
+                    executor.submit(
+                        _mask_img, query_imgs[i], transform, None, init_args
+                    )
+                    for i in batch
+                ]
+            masked, searched = [], []
+            for j, i in enumerate(batch):
+                try:
+                    if futures is None:
+                        masked_img = _mask_img(
+                            query_imgs[i], transform, search._masker
+                        )
+                    else:
+                        masked_img = futures[j].result()
+                except Exception as e:
+                    failed[str(query_imgs[i])] = str(e)
+                    if verbose:
+                        print(f"Failed: {query_imgs[i]}: {e}", file=sys.stderr)
+                    continue
+                masked.append(masked_img)
+                searched.append(i)
+            if not searched:
+                continue
+            _write_batch(
+                search,
+                writer,
+                np.asarray(masked),
+                searched,
+                [query_imgs[i] for i in searched],
+                [names[i] for i in searched],
+                n_studies=n_studies,
+                n_terms=n_terms,
+                transform=transform,
+                rescale_similarities=rescale_similarities,
+            )
+            if verbose:
+                for i in searched:
+                    n_done += 1
+                    print(
+                        f"[{n_done + len(failed)}/{len(query_imgs)}] "
+                        f"{query_imgs[i]}"
+                    )
+    finally:
+        writer.close()
+        if executor is not None:
+            executor.shutdown(wait=True)
+    return failed
+
+
+def _write_batch(search, writer, masked, rows, query_imgs, names, **params):
+    if writer.kind == "similarities":
+        writer.write_similarities(
+            search._compute_similarities(
+                masked, params["rescale_similarities"]
+            ),
+            rows,
+        )
+        return
+    if writer.kind == "top_arrays":
+        # array outputs skip building DataFrames (and the result cache)
+        writer.write_arrays(
+            search._compute_top_arrays(
+                masked,
+                params["n_studies"],
+                params["n_terms"],
+                params["rescale_similarities"],
+            ),
+            names,
+        )
+        return
+    all_results = search._search_masked(masked, **params)
+    for query_img, name, results in zip(query_imgs, names, all_results):
+        if getattr(writer, "output_format", None) == "html":
+            from nilearn import image
+
+            results["image"] = image.load_img(query_img)
+        writer.write(results, name)
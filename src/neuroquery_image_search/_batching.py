@@ -0,0 +1,190 @@
+import asyncio
+from collections import Counter
+import functools
+import time
+
+
+class BatchMetrics:
+    """Batch sizes and queueing delays recorded by a `BatchScheduler`."""
+
+    def __init__(self):
+        self.batch_sizes = Counter()
+        self.n_requests = 0
+        self.total_queue_delay = 0.0
+        self.max_queue_delay = 0.0
+
+    def record(self, queue_delays):
+        self.batch_sizes[len(queue_delays)] += 1
+        self.n_requests += len(queue_delays)
+        self.total_queue_delay += sum(queue_delays)
+        self.max_queue_delay = max([self.max_queue_delay] + queue_delays)
+
+    def summary(self):
+        """Metrics as a JSON-serializable dict; delays are in seconds."""
+        n_batches = sum(self.batch_sizes.values())
+        return {
+            "n_requests": self.n_requests,
+            "n_batches": n_batches,
+            "mean_batch_size": self.n_requests / n_batches if n_batches else 0,
+            "max_batch_size": max(self.batch_sizes, default=0),
+            "batch_sizes": {
+                str(size): count
+                for size, count in sorted(self.batch_sizes.items())
+            },
+            "mean_queue_delay": (
+                self.total_queue_delay / self.n_requests
+                if self.n_requests
+                else 0
+            ),
+            "max_queue_delay": self.max_queue_delay,
+        }
+
+
+def _search_batch(search, query_imgs, params):
+    """Search with a batch of images; returns a list of results or errors."""
+    from nilearn import image
+
+    outcomes, loaded, positions = [None] * len(query_imgs), [], []
+    for i, query_img in enumerate(query_imgs):
+        try:
+            query_img = image.load_img(query_img)
+            if len(query_img.shape) != 3:
+                raise ValueError(
+                    f"Expected a 3D image, got shape {query_img.shape}"
+                )
+        except Exception as e:
+            outcomes[i] = e
+        else:
+            loaded.append(query_img)
+            positions.append(i)
+    try:
+        all_results = search.search_many(loaded, **params)
+    except Exception:
+        if len(loaded) == 1:
+            raise
+        # isolate the failing requests
+        all_results = []
+        for query_img in loaded:
+            try:
+                all_results.append(search(query_img, **params))
+            except Exception as e:
+                all_results.append(e)
+    for i, results in zip(positions, all_results):
+        outcomes[i] = results
+    return outcomes
+
+
+class BatchScheduler:
+    """Group concurrent single-image searches into batches.
+
+    Requests submitted within `max_delay` seconds of the first request of a
+    batch (up to `max_batch_size` of them) are scored together with
+    `NeuroQueryImageSearch.search_many`, so that scoring is a matrix-matrix
+    product rather than one matrix-vector product per request. Each caller
+    receives its own results.
+
+    Must be started with `start()` from within a running event loop.
+
+    Parameters
+    ----------
+    search : `NeuroQueryImageSearch`
+
+    max_batch_size : maximum number of images in a batch
+
+    max_delay : maximum time, in seconds, that the first request of a batch
+        waits for other requests
+
+    executor : `concurrent.futures.Executor` in which batches are computed;
+        if `None`, the event loop's default executor is used.
+
+    Attributes
+    ----------
+    metrics : `BatchMetrics`
+
+    """
+
+    def __init__(
+        self, search, max_batch_size=16, max_delay=0.005, executor=None
+    ):
+        self.search = search
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.executor = executor
+        self.metrics = BatchMetrics()
+        self._queue = None
+        self._collector = None
+        self._running = set()
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._collector = asyncio.ensure_future(self._collect())
+
+    async def close(self):
+        """Stop collecting requests and wait for running batches."""
+        if self._collector is not None:
+            self._collector.cancel()
+            try:
+                await self._collector
+            except asyncio.CancelledError:
+                pass
+            self._collector = None
+        if self._running:
+            await asyncio.wait(self._running)
+
+    async def submit(self, query_img, **params):
+        """Search for one image; returns the same results as `search(img)`."""
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put((query_img, params, time.monotonic(), future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(
+                        await asyncio.wait_for(self._queue.get(), timeout)
+                    )
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.ensure_future(self._run_batch(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run_batch(self, batch):
+        start = time.monotonic()
+        self.metrics.record(
+            [start - submitted for _, _, submitted, _ in batch]
+        )
+        groups = {}
+        for request in batch:
+            key = tuple(sorted(request[1].items()))
+            groups.setdefault(key, []).append(request)
+        await asyncio.gather(
+            *[self._run_group(requests) for requests in groups.values()]
+        )
+
+    async def _run_group(self, requests):
+        """Search for a group of requests that have the same parameters."""
+        query_imgs = [request[0] for request in requests]
+        try:
+            outcomes = await asyncio.get_event_loop().run_in_executor(
+                self.executor,
+                functools.partial(
+                    _search_batch, self.search, query_imgs, requests[0][1]
+                ),
+            )
+        except Exception as e:
+            outcomes = [e] * len(requests)
+        for (_, _, _, future), outcome in zip(requests, outcomes):
+            if future.done():
+                continue
+            if isinstance(outcome, Exception):
+                future.set_exception(outcome)
+            else:
+                future.set_result(outcome)
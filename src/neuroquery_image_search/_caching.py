@@ -0,0 +1,187 @@
+from collections import OrderedDict
+import hashlib
+import os
+from pathlib import Path
+import pickle
+import tempfile
+import threading
+import time
+import warnings
+
+import numpy as np
+
+
+class ResultCache:
+    """LRU cache of search results, keyed on the masked query image.
+
+    Pass it to `NeuroQueryImageSearch(cache=ResultCache())`: when the same
+    (masked and transformed) image is searched again with the same parameters,
+    the cached results are returned without projecting or scoring the image.
+
+    Parameters
+    ----------
+    max_size : maximum number of results kept in memory; the least recently
+        used ones are discarded first.
+
+    ttl : time to live of cached results, in seconds. If `None`, results don't
+        expire.
+
+    directory : if not `None`, results are also stored in this directory, so
+        that they survive the process. Results found on disk are loaded into
+        the in-memory cache.
+
+    Attributes
+    ----------
+    hits, misses : number of lookups that found or did not find a result.
+
+    """
+
+    def __init__(self, max_size=128, ttl=None, directory=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.directory = None if directory is None else Path(directory)
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(masked_query, params):
+        """Hash of a masked query vector and the search parameters."""
+        masked_query = np.ascontiguousarray(masked_query, dtype=np.float64)
+        digest = hashlib.sha256(masked_query.tobytes())
+        digest.update(repr(sorted(params.items())).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _is_expired(self, stored_at):
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def _disk_file(self, key):
+        return self.directory / f"{key}.pkl"
+
+    def _get_from_disk(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._disk_file(key), "rb") as f:
+                stored_at, results = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # truncated, or written by an incompatible version
+            try:
+                self._disk_file(key).unlink()
+            except OSError:
+                pass
+            return None
+        if self._is_expired(stored_at):
+            try:
+                self._disk_file(key).unlink()
+            except OSError as error:
+                _warn_disk_error(error)
+            return None
+        return stored_at, results
+
+    def get(self, key):
+        """Cached results for `key`, or `None`.
+
+        A copy of the results is returned so callers can modify it.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry[0]):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                entry = self._get_from_disk(key)
+                if entry is not None:
+                    self._store(key, entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return _copy_results(entry[1])
+
+    def put(self, key, results):
+        """Store search results (a dict of DataFrames) under `key`."""
+        entry = (time.time(), _copy_results(results))
+        with self._lock:
+            self._store(key, entry)
+        if self.directory is not None:
+            self._put_on_disk(key, entry)
+
+    def _put_on_disk(self, key, entry):
+        # each writer uses its own temporary file, so that concurrent writes
+        # of the same key (from threads or processes) don't interfere
+        tmp_file = None
+        try:
+            fd, tmp_file = tempfile.mkstemp(
+                suffix=".tmp", prefix=f"{key}.", dir=str(self.directory)
+            )
+            with open(fd, "wb") as f:
+                pickle.dump(entry, f)
+            os.replace(tmp_file, str(self._disk_file(key)))
+        except Exception as error:
+            _warn_disk_error(error)
+            if tmp_file is not None:
+                try:
+                    os.unlink(tmp_file)
+                except OSError:
+                    pass
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all results, from memory and from disk."""
+        with self._lock:
+            self._entries.clear()
+            if self.directory is not None:
+                for cached_file in self.directory.glob("*.pkl"):
+                    cached_file.unlink()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+
+def _warn_disk_error(error):
+    warnings.warn(f"Disk cache error, ignored: {error!r}")
+
+
+def _copy_results(results):
+    return {key: value.copy() for key, value in results.items()}
+
+
+def corpus_fingerprint(arrays, tables, n_samples=64):
+    """Hash of the shapes and of a sample of rows of arrays and tables.
+
+    Used in cache keys so that results cached on disk are not reused after
+    the search data or segments are rebuilt with the same shapes; only
+    `n_samples` evenly spaced rows of each array and table are read.
+    """
+    digest = hashlib.sha256()
+    for array in arrays:
+        array = np.asanyarray(array)
+        digest.update(f"{array.dtype.str}{array.shape}".encode("utf-8"))
+        rows = _sample_rows(array.shape[0], n_samples)
+        digest.update(np.ascontiguousarray(array[rows]).tobytes())
+    for table in tables:
+        rows = _sample_rows(len(table), n_samples)
+        digest.update(f"{len(table)}".encode("utf-8"))
+        digest.update(table.iloc[rows].to_csv(index=False).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _sample_rows(n_rows, n_samples):
+    return np.unique(
+        np.linspace(0, n_rows - 1, min(n_rows, n_samples), dtype=int)
+    )
@@ -1,12 +1,31 @@
+import contextlib
+import hashlib
 import os
 from pathlib import Path
+import secrets
+import shutil
 import tarfile
+import tempfile
+import time
 
-import requests
 import numpy as np
 from scipy import sparse
 import pandas as pd
-from nilearn import input_data
+
+from neuroquery_image_search._profiling import stage
+from neuroquery_image_search._tables import LazyCSVTable
+
+_DATA_URL = "https://osf.io/mx3t4/download"
+# metadata of the archive on OSF, which includes its SHA-256
+_DATA_METADATA_URL = "https://api.osf.io/v2/files/mx3t4/"
+# SHA-256 of the data archive. Downloads from `_DATA_URL` are checked
+# against it or, while it is not set, against the digest published by OSF.
+_DATA_SHA256 = None
+_CHUNK_SIZE = 2**20
+_N_ATTEMPTS = 5
+# a lock file that has not been refreshed for this long (in seconds) was
+# left by a dead process
+_STALE_LOCK_AGE = 3600
 
 
 def get_neuroquery_data_dir():
@@ -17,37 +36,261 @@ def get_neuroquery_data_dir():
     return data_dir
 
 
-def _download_data(data_dir):
-    print("Downloading Neuroquery image search data ...")
+class _Lock:
+    """A lock file held by this process (see `_file_lock`)."""
+
+    def __init__(self, lock_file, token):
+        self.lock_file = lock_file
+        self.token = token
+
+    def refresh(self):
+        """Update the lock's modification time so it is not seen as stale."""
+        try:
+            os.utime(str(self.lock_file))
+        except FileNotFoundError:
+            pass
+
+    def is_held(self):
+        try:
+            return self.lock_file.read_text() == self.token
+        except FileNotFoundError:
+            return False
+
+
+@contextlib.contextmanager
+def _file_lock(lock_file, poll_interval=0.5):
+    """Hold an exclusive lock file, waiting for other processes to release it.
+
+    Lock files that have not been modified for `_STALE_LOCK_AGE` seconds are
+    removed; long operations call `refresh()` on the yielded `_Lock` to keep
+    theirs. The lock file contains the process id and a random token, and it
+    is only removed on exit if it is still the one this process created.
+    """
+    lock_file = Path(lock_file)
+    token = f"{os.getpid()} {secrets.token_hex(8)}"
+    while True:
+        try:
+            fd = os.open(str(lock_file), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - lock_file.stat().st_mtime > _STALE_LOCK_AGE:
+                    lock_file.unlink()
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(poll_interval)
+        else:
+            break
+    lock = _Lock(lock_file, token)
+    try:
+        os.write(fd, token.encode("utf-8"))
+        os.close(fd)
+        yield lock
+    finally:
+        if lock.is_held():
+            lock_file.unlink()
+
+
+def _stream_to_file(url, target_file, on_chunk=None):
+    """Download `url` into `target_file` in chunks.
+
+    If `target_file` already exists (a previous download was interrupted),
+    the download is resumed with an HTTP Range request. Interrupted transfers
+    are retried `_N_ATTEMPTS` times. `on_chunk`, if provided, is called after
+    each chunk is written.
+    """
+    import requests
+
+    target_file = Path(target_file)
+    for attempt in range(_N_ATTEMPTS):
+        offset = target_file.stat().st_size if target_file.is_file() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with requests.get(
+                url, headers=headers, stream=True, timeout=60
+            ) as response:
+                if response.status_code == 416:
+                    # the range starts at or after the end of the file: the
+                    # partial file is complete only if it has the full size
+                    total = response.headers.get("Content-Range", "")
+                    if total.rpartition("/")[2] == str(offset):
+                        return
+                    print(f"{target_file} is invalid, downloading it again")
+                    target_file.unlink()
+                    continue
+                response.raise_for_status()
+                # 206 means the server honored the range; otherwise it sends
+                # the whole file
+                mode = "ab" if response.status_code == 206 else "wb"
+                expected_size = response.headers.get("Content-Length")
+                n_bytes = 0
+                with open(target_file, mode) as f:
+                    for chunk in response.iter_content(chunk_size=_CHUNK_SIZE):
+                        f.write(chunk)
+                        n_bytes += len(chunk)
+                        if on_chunk is not None:
+                            on_chunk()
+            if expected_size is not None and n_bytes < int(expected_size):
+                raise requests.exceptions.ChunkedEncodingError(
+                    f"Received {n_bytes} bytes out of {expected_size}"
+                )
+            return
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout,
+        ):
+            if attempt == _N_ATTEMPTS - 1:
+                raise
+            print("Download interrupted, resuming ...")
+
+
+def _sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _published_sha256(metadata_url=_DATA_METADATA_URL):
+    """SHA-256 of the data archive, as published by OSF."""
+    import requests
+
+    try:
+        response = requests.get(metadata_url, timeout=60)
+        response.raise_for_status()
+        return response.json()["data"]["attributes"]["extra"]["hashes"][
+            "sha256"
+        ]
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        raise OSError(
+            f"Could not get the SHA-256 of the data from {metadata_url}: {e}"
+        ) from e
+
+
+def _is_valid_archive(archive, digest_file, sha256=None):
+    """Whether `archive` exists and has its recorded (and expected) digest."""
+    if not archive.is_file() or not digest_file.is_file():
+        return False
+    digest = _sha256(archive)
+    if digest == digest_file.read_text().strip() and sha256 in (None, digest):
+        return True
+    print(f"{archive} is corrupted, downloading it again")
+    archive.unlink()
+    return False
+
+
+def _download_data(data_dir, url=_DATA_URL, sha256=None):
+    """Download and extract the data archive in `data_dir`.
+
+    The archive is streamed to a partial file (resuming a previous
+    interrupted download if there is one), its SHA-256 is checked, and it is
+    extracted in a temporary directory which is then moved into place, so
+    `data_dir/neuroquery_image_search_data` is either complete or absent. A
+    lock file prevents several processes from downloading at the same time.
+
+    The archive downloaded from `_DATA_URL` must have the SHA-256
+    `_DATA_SHA256`, or, if it is not set, the one published by OSF; for other
+    URLs `sha256` can be provided. The digest of the archive is recorded next
+    to it; an archive left by a previous download is extracted again without
+    downloading it only if it still has the recorded (and expected) digest.
+    """
     data_dir = Path(data_dir)
     data_dir.mkdir(parents=True, exist_ok=True)
-    url = "https://osf.io/mx3t4/download"
-    data = requests.get(url).content
-    archive = data_dir / "neuroquery_image_search_data.tar.gz"
-    archive.write_bytes(data)
-    with tarfile.open(archive, "r:gz") as f:
-        f.extractall(data_dir)
+    target_dir = data_dir / "neuroquery_image_search_data"
+    with _file_lock(data_dir / "neuroquery_image_search_data.lock") as lock:
+        if target_dir.is_dir():
+            # downloaded by another process while we waited for the lock
+            return
+        if sha256 is None and url == _DATA_URL:
+            sha256 = _DATA_SHA256 or _published_sha256()
+        archive = data_dir / "neuroquery_image_search_data.tar.gz"
+        digest_file = archive.with_name(f"{archive.name}.sha256")
+        if not _is_valid_archive(archive, digest_file, sha256):
+            print("Downloading Neuroquery image search data ...")
+            partial_archive = archive.with_name(f"{archive.name}.part")
+            _stream_to_file(url, partial_archive, on_chunk=lock.refresh)
+            digest = _sha256(partial_archive)
+            if sha256 is not None and digest != sha256:
+                partial_archive.unlink()
+                raise OSError(
+                    f"Downloaded data from {url} has SHA-256 {digest}, "
+                    f"expected {sha256}"
+                )
+            os.replace(str(partial_archive), str(archive))
+            digest_file.write_text(digest)
+        extract_dir = Path(tempfile.mkdtemp(dir=str(data_dir)))
+        try:
+            with tarfile.open(archive, "r:gz") as f:
+                f.extractall(extract_dir)
+            os.replace(
+                str(extract_dir / "neuroquery_image_search_data"),
+                str(target_dir),
+            )
+        finally:
+            shutil.rmtree(str(extract_dir), ignore_errors=True)
     print("Done")
 
 
-def fetch_data():
+def fetch_data(lazy=False, profiler=None):
+    """Load the NeuroQuery image search data, downloading it if necessary.
+
+    Parameters
+    ----------
+    lazy : if `True`, the `.npy` arrays are memory-mapped (read-only) rather
+        than loaded in memory, and the studies and terms metadata are
+        `LazyCSVTable` objects that parse only the rows that are requested.
+        Processes that load the data this way share the operating system's
+        page cache rather than each holding a private copy.
+
+    profiler : `_profiling.Profiler` or `None`. If provided, the loading of
+        each file is recorded as a "fetch_data/<file name>" stage.
+
+    Returns
+    -------
+    data : dict with keys "masker", "atlas_maps", "atlas_inv_covar",
+        "studies_loadings", "terms_loadings", "studies_info",
+        "document_frequencies".
+
+    """
+    from nilearn import input_data
+
     data_dir = Path(get_neuroquery_data_dir()).joinpath(
         "extra", "neuroquery_image_search_data"
     )
     if not data_dir.is_dir():
-        _download_data(data_dir.parent)
+        with stage(profiler, "fetch_data/download"):
+            _download_data(data_dir.parent)
+    mmap_mode = "r" if lazy else None
+    read_table = LazyCSVTable if lazy else pd.read_csv
+    loaders = [
+        (
+            "masker",
+            "mask.nii.gz",
+            lambda path: input_data.NiftiMasker(path).fit(),
+        ),
+        ("atlas_maps", "difumo_maps.npz", sparse.load_npz),
+        (
+            "atlas_inv_covar",
+            "difumo_inverse_covariance.npy",
+            lambda path: np.load(path, mmap_mode=mmap_mode),
+        ),
+        (
+            "studies_loadings",
+            "projections.npy",
+            lambda path: np.load(path, mmap_mode=mmap_mode),
+        ),
+        (
+            "terms_loadings",
+            "term_projections.npy",
+            lambda path: np.load(path, mmap_mode=mmap_mode),
+        ),
+        ("studies_info", "articles-info.csv", read_table),
+        ("document_frequencies", "document_frequencies.csv", read_table),
+    ]
     result = {}
-    result["masker"] = input_data.NiftiMasker(
-        str(data_dir / "mask.nii.gz")
-    ).fit()
-    result["atlas_maps"] = sparse.load_npz(str(data_dir / "difumo_maps.npz"))
-    result["atlas_inv_covar"] = np.load(
-        str(data_dir / "difumo_inverse_covariance.npy")
-    )
-    result["studies_loadings"] = np.load(str(data_dir / "projections.npy"))
-    result["terms_loadings"] = np.load(str(data_dir / "term_projections.npy"))
-    result["studies_info"] = pd.read_csv(str(data_dir / "articles-info.csv"))
-    result["document_frequencies"] = pd.read_csv(
-        str(data_dir / "document_frequencies.csv")
-    )
+    for key, file_name, load in loaders:
+        with stage(profiler, f"fetch_data/{file_name}"):
+            result[key] = load(str(data_dir / file_name))
     return result
@@ -0,0 +1,327 @@
+"""Binary index holding all the data needed by `NeuroQueryImageSearch`.
+
+The index is a single uncompressed file:
+
+- 8 bytes: magic string `b"NQISIDX\\0"`
+- 8 bytes: little-endian uint64, length of the JSON header
+- the JSON header, describing the format version, the mask geometry and the
+  name, dtype, shape and offset of each array
+- the arrays, each starting at an offset that is a multiple of 64 bytes.
+
+The arrays include the lists of an approximate nearest-neighbour index of the
+(folded) studies loadings (see `_ann.IVFIndex`), so that they are built once
+rather than each time a search with `ann` is created.
+
+Loading an index memory-maps the file, so arrays are views on the page cache
+and nothing is copied or parsed apart from the header.
+
+"""
+import json
+import mmap
+import os
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+import nibabel
+
+from neuroquery_image_search._ann import build_lists
+from neuroquery_image_search._datasets import (
+    fetch_data,
+    get_neuroquery_data_dir,
+)
+from neuroquery_image_search._tables import ColumnarTable
+
+_MAGIC = b"NQISIDX\0"
+_FORMAT_VERSION = 1
+_ALIGNMENT = 64
+_ANN_LISTS = ("centroids", "row_ids", "list_offsets")
+
+
+def get_default_index_file():
+    return Path(get_neuroquery_data_dir()).joinpath(
+        "extra", "neuroquery_image_search_index.bin"
+    )
+
+
+def _table_to_arrays(table, name):
+    """Columnar representation of a DataFrame.
+
+    String columns are stored as the concatenated UTF-8 bytes of all values,
+    the offsets at which each value starts, and a boolean array marking
+    missing values.
+    """
+    arrays, columns = {}, []
+    for column in table.columns:
+        values = table[column]
+        prefix = f"{name}/{column}"
+        if values.dtype == object:
+            missing = values.isna().values
+            encoded = [
+                b"" if is_missing else str(value).encode("utf-8")
+                for value, is_missing in zip(values.values, missing)
+            ]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(value) for value in encoded])
+            arrays[f"{prefix}/offsets"] = offsets
+            arrays[f"{prefix}/bytes"] = np.frombuffer(
+                b"".join(encoded), dtype=np.uint8
+            )
+            arrays[f"{prefix}/missing"] = missing
+            columns.append({"name": column, "kind": "string"})
+        else:
+            arrays[f"{prefix}/values"] = values.values
+            columns.append({"name": column, "kind": "numeric"})
+    return arrays, {"n_rows": len(table), "columns": columns}
+
+
+def _table_from_arrays(arrays, name, table_info):
+    columns = {}
+    for column in table_info["columns"]:
+        prefix = f"{name}/{column['name']}"
+        if column["kind"] == "string":
+            columns[column["name"]] = (
+                arrays[f"{prefix}/offsets"],
+                arrays[f"{prefix}/bytes"],
+                arrays[f"{prefix}/missing"],
+            )
+        else:
+            columns[column["name"]] = arrays[f"{prefix}/values"]
+    return ColumnarTable(columns, table_info["n_rows"])
+
+
+def build_index(index_file=None, data=None):
+    """Build a binary index from the NeuroQuery image search data.
+
+    The index holds the mask voxel indices, the atlas, the loadings with the
+    atlas inverse covariance already folded in, the lists of an approximate
+    nearest-neighbour index of the studies, and the studies and terms
+    metadata, in a layout that `load_index` maps in memory without parsing or
+    copying anything.
+
+    Parameters
+    ----------
+    index_file : path of the index file to create. If `None`, it is created
+        in the NeuroQuery data directory.
+
+    data : dict as returned by `fetch_data`. If `None`, `fetch_data()` is
+        called.
+
+    Returns
+    -------
+    index_file : `pathlib.Path`, the path of the created index.
+
+    """
+    if index_file is None:
+        index_file = get_default_index_file()
+    index_file = Path(index_file)
+    if data is None:
+        data = fetch_data()
+    header, arrays, array_info, size = _serialize(data)
+    index_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = index_file.with_name(f"{index_file.name}.{os.getpid()}.tmp")
+    with open(tmp_file, "wb") as f:
+        f.write(_MAGIC)
+        f.write(np.array(len(header), dtype="<u8").tobytes())
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(_data_start(len(header)) + array_info[name]["offset"])
+            f.write(array.astype(array_info[name]["dtype"], copy=False).data)
+        f.truncate(size)
+    os.replace(str(tmp_file), str(index_file))
+    return index_file
+
+
+def _serialize(data):
+    """Header and arrays of the index of `data`.
+
+    Returns the encoded JSON header, the arrays by name, the dtype, shape and
+    offset (from the start of the arrays) of each array, and the total size
+    of the index in bytes.
+    """
+    from nilearn import image
+
+    mask_img = data["masker"].mask_img_
+    mask = np.asarray(image.get_data(mask_img)) != 0
+    atlas_maps = sparse.csr_matrix(data["atlas_maps"])
+    inv_covar = np.asarray(data["atlas_inv_covar"])
+    arrays = {
+        "mask_voxels": np.flatnonzero(mask),
+        "atlas_maps/data": atlas_maps.data,
+        "atlas_maps/indices": atlas_maps.indices,
+        "atlas_maps/indptr": atlas_maps.indptr,
+        "atlas_inv_covar": inv_covar,
+        "studies_loadings": np.asarray(data["studies_loadings"]),
+        "terms_loadings": np.asarray(data["terms_loadings"]),
+    }
+    for name in "studies_loadings", "terms_loadings":
+        folded = data.get(f"folded_{name}")
+        if folded is None:
+            folded = arrays[name].dot(inv_covar)
+        arrays[f"folded_{name}"] = np.asarray(folded)
+    lists = {key: data.get(f"ann_{key}") for key in _ANN_LISTS}
+    if any(value is None for value in lists.values()):
+        lists = build_lists(arrays["folded_studies_loadings"])
+    for key in _ANN_LISTS:
+        arrays[f"ann/{key}"] = np.asarray(lists[key])
+    tables = {}
+    for name in "studies_info", "document_frequencies":
+        table = data[name]
+        if hasattr(table, "to_dataframe"):
+            table = table.to_dataframe()
+        table_arrays, tables[name] = _table_to_arrays(table, name)
+        arrays.update(table_arrays)
+    array_info, offset = {}, 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[name] = array
+        array_info[name] = {
+            "dtype": array.dtype.newbyteorder("<").str,
+            "shape": list(array.shape),
+            "offset": offset,
+        }
+        offset += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+    header = json.dumps(
+        {
+            "format_version": _FORMAT_VERSION,
+            "mask": {
+                "shape": list(mask.shape),
+                "affine": np.asarray(mask_img.affine).tolist(),
+            },
+            "atlas_maps": {"shape": list(atlas_maps.shape)},
+            "tables": tables,
+            "arrays": array_info,
+        }
+    ).encode("utf-8")
+    return header, arrays, array_info, _data_start(len(header)) + offset
+
+
+def _write_to_buffer(buffer, header, arrays, array_info):
+    """Write an index returned by `_serialize` in a writable buffer."""
+    content = np.frombuffer(buffer, dtype=np.uint8)
+    header_start = len(_MAGIC) + 8
+    content[: len(_MAGIC)] = np.frombuffer(_MAGIC, dtype=np.uint8)
+    content[len(_MAGIC) : header_start] = np.frombuffer(
+        np.array(len(header), dtype="<u8").tobytes(), dtype=np.uint8
+    )
+    content[header_start : header_start + len(header)] = np.frombuffer(
+        header, dtype=np.uint8
+    )
+    data_start = _data_start(len(header))
+    for name, array in arrays.items():
+        info = array_info[name]
+        np.frombuffer(
+            buffer,
+            dtype=info["dtype"],
+            count=array.size,
+            offset=data_start + info["offset"],
+        ).reshape(array.shape)[...] = array
+
+
+def _data_start(header_length):
+    header_end = len(_MAGIC) + 8 + header_length
+    return -(-header_end // _ALIGNMENT) * _ALIGNMENT
+
+
+def load_index(index_file=None):
+    """Load search data from a binary index created by `build_index`.
+
+    Arrays are read-only views on a memory map of the index file, and the
+    studies and terms metadata are `ColumnarTable` objects that decode only
+    the rows that are requested.
+
+    Parameters
+    ----------
+    index_file : path of the index. If `None`, the default index in the
+        NeuroQuery data directory is used. If the file does not exist, it is
+        built first with `build_index`.
+
+    Returns
+    -------
+    data : dict with the same keys as the one returned by `fetch_data`, plus
+        "folded_studies_loadings" and "folded_terms_loadings": the loadings
+        multiplied by the atlas inverse covariance, and "ann_centroids",
+        "ann_row_ids" and "ann_list_offsets": the lists of an `IVFIndex` of
+        the folded studies loadings.
+
+    """
+    if index_file is None:
+        index_file = get_default_index_file()
+    index_file = Path(index_file)
+    if not index_file.is_file():
+        build_index(index_file)
+    with open(index_file, "rb") as f:
+        content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return read_index_buffer(content, str(index_file))
+
+
+def read_index_buffer(content, source="buffer"):
+    """Load search data from an index held in a buffer (without copying).
+
+    `content` can be any object supporting the buffer protocol, e.g. a
+    memory map or a shared memory block; the arrays are views on it.
+    `source` is used in error messages.
+    """
+    from nilearn import input_data
+
+    if bytes(content[: len(_MAGIC)]) != _MAGIC:
+        raise ValueError(f"{source} is not a NeuroQuery image search index")
+    header_length = int(
+        np.frombuffer(content, dtype="<u8", count=1, offset=len(_MAGIC))[0]
+    )
+    header_start = len(_MAGIC) + 8
+    header = json.loads(
+        bytes(content[header_start : header_start + header_length]).decode(
+            "utf-8"
+        )
+    )
+    if header["format_version"] != _FORMAT_VERSION:
+        raise ValueError(
+            f"{source} has index format version "
+            f"{header['format_version']}; expected {_FORMAT_VERSION}. "
+            "Rebuild it with `build_index`."
+        )
+    data_start = _data_start(header_length)
+    arrays = {}
+    for name, info in header["arrays"].items():
+        dtype = np.dtype(info["dtype"])
+        count = int(np.prod(info["shape"], dtype=np.int64))
+        arrays[name] = np.frombuffer(
+            content,
+            dtype=dtype,
+            count=count,
+            offset=data_start + info["offset"],
+        ).reshape(info["shape"])
+        arrays[name].flags.writeable = False
+    mask_shape = tuple(header["mask"]["shape"])
+    mask = np.zeros(int(np.prod(mask_shape)), dtype=np.int8)
+    mask[arrays["mask_voxels"]] = 1
+    mask_img = nibabel.Nifti1Image(
+        mask.reshape(mask_shape), np.asarray(header["mask"]["affine"])
+    )
+    result = {}
+    result["masker"] = input_data.NiftiMasker(mask_img).fit()
+    result["atlas_maps"] = sparse.csr_matrix(
+        (
+            arrays["atlas_maps/data"],
+            arrays["atlas_maps/indices"],
+            arrays["atlas_maps/indptr"],
+        ),
+        shape=tuple(header["atlas_maps"]["shape"]),
+        copy=False,
+    )
+    for name in [
+        "atlas_inv_covar",
+        "studies_loadings",
+        "terms_loadings",
+        "folded_studies_loadings",
+        "folded_terms_loadings",
+    ]:
+        result[name] = arrays[name]
+    # indexes built by earlier versions have no lists
+    if all(f"ann/{key}" in arrays for key in _ANN_LISTS):
+        for key in _ANN_LISTS:
+            result[f"ann_{key}"] = arrays[f"ann/{key}"]
+    for name in "studies_info", "document_frequencies":
+        result[name] = _table_from_arrays(arrays, name, header["tables"][name])
+    return result
@@ -0,0 +1,119 @@
+import numpy as np
+
+from neuroquery_image_search._resampling import ResamplingCache
+
+# number of distinct image geometries remembered by a `QueryMasker`
+_MAX_CACHED_GEOMETRIES = 1024
+
+
+class QueryMasker:
+    """Extract the mask voxels from query images.
+
+    Images that are already in the space of the mask (same shape and affine)
+    are masked by indexing their data with precomputed voxel coordinates,
+    skipping the checks, resampling and signal processing steps of the nilearn
+    masker. Other images are transformed by the nilearn masker, or, if
+    `interpolation` is specified, resampled with a `ResamplingCache`. Whether
+    an image geometry matches the mask is computed once and remembered.
+
+    Parameters
+    ----------
+    masker : fitted `nilearn.input_data.NiftiMasker`
+
+    interpolation : `None`, "linear" or "nearest". If `None`, images that are
+        not in the mask space are resampled by the nilearn masker (which uses
+        continuous interpolation). Otherwise, a sparse resampling operator is
+        built once for each image geometry and reused.
+
+    """
+
+    def __init__(self, masker, interpolation=None):
+        from nilearn import image
+
+        self.masker = masker
+        mask_img = masker.mask_img_
+        mask = np.asarray(image.get_data(mask_img)) != 0
+        self.mask_shape = mask.shape
+        self.mask_affine = np.asarray(mask_img.affine)
+        self.voxel_indices = np.flatnonzero(mask)
+        self._voxel_coords = np.unravel_index(self.voxel_indices, mask.shape)
+        self._geometries = {}
+        self.resampling = None
+        if interpolation is not None:
+            self.resampling = ResamplingCache(
+                self.mask_affine, self._voxel_coords, interpolation
+            )
+
+    @property
+    def n_voxels(self):
+        return len(self.voxel_indices)
+
+    def in_mask_space(self, img):
+        """Whether `img` has the same shape and affine as the mask."""
+        key = (img.shape[:3], np.asarray(img.affine).tobytes())
+        in_mask_space = self._geometries.get(key)
+        if in_mask_space is None:
+            in_mask_space = bool(
+                tuple(img.shape[:3]) == self.mask_shape
+                and np.allclose(img.affine, self.mask_affine)
+            )
+            if len(self._geometries) >= _MAX_CACHED_GEOMETRIES:
+                self._geometries.clear()
+            self._geometries[key] = in_mask_space
+        return in_mask_space
+
+    def transform(self, imgs):
+        """Mask a list of 3D images.
+
+        Returns
+        -------
+        masked_imgs : array of shape (n images, n voxels)
+
+        """
+        masked_imgs = np.empty((len(imgs), self.n_voxels))
+        to_resample = []
+        for i, img in enumerate(imgs):
+            if self.in_mask_space(img):
+                masked_imgs[i] = np.asanyarray(img.dataobj)[self._voxel_coords]
+            else:
+                to_resample.append(i)
+        # as in nilearn, non-finite values (often found in statistical maps)
+        # are replaced by 0
+        masked_imgs[~np.isfinite(masked_imgs)] = 0
+        if not to_resample:
+            return masked_imgs
+        if self.resampling is None:
+            masked_imgs[to_resample] = self._masker_transform(
+                [imgs[i] for i in to_resample]
+            )
+            return masked_imgs
+        # images sharing a geometry are resampled with one matrix product
+        groups = {}
+        for i in to_resample:
+            key = (imgs[i].shape[:3], np.asarray(imgs[i].affine).tobytes())
+            groups.setdefault(key, []).append(i)
+        for group in groups.values():
+            operator = self.resampling.operator(
+                imgs[group[0]].affine, imgs[group[0]].shape
+            )
+            data = np.column_stack(
+                [
+                    np.asanyarray(imgs[i].dataobj).ravel(order="F")
+                    for i in group
+                ]
+            ).astype(float)
+            data[~np.isfinite(data)] = 0
+            masked_imgs[group] = operator.dot(data).T
+        return masked_imgs
+
+    def _masker_transform(self, imgs):
+        from nilearn import image
+
+        if len(imgs) == 1:
+            return self.masker.transform(imgs[0]).reshape((1, -1))
+        geometries = {(img.shape[:3], img.affine.tobytes()) for img in imgs}
+        if len(geometries) == 1:
+            return self.masker.transform(
+                image.concat_imgs(imgs, dtype=np.float64)
+            )
+        return np.vstack([self.masker.transform(img) for img in imgs])
@@ -0,0 +1,310 @@
+"""Writing search results for many images to files.
+
+The output format is chosen from the file extension by `open_writer`:
+
+- ".jsonl": one JSON object per line, per image.
+- ".parquet", ".arrow" or ".feather": one table with one row per similar
+  study or term (see `results_to_frame`); needs `pyarrow` (or
+  `fastparquet` for Parquet).
+- ".npz": NumPy arrays of the positions and similarities of the similar
+  studies and terms, which refer to the rows of the search data's metadata
+  tables rather than copying them (see `NPZWriter` and `read_npz_results`).
+- ".npy": a (n images, n studies) float32 matrix of the similarities with
+  all the studies, written to a memory-mapped file (see
+  `ScoreMatrixWriter`).
+- anything else: a directory with one JSON or HTML file per image.
+
+"""
+import importlib.util
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from neuroquery_image_search._results import SearchHits, as_dataframe
+from neuroquery_image_search._searching import (
+    _JSONEncoder,
+    _results_to_json,
+    results_to_html,
+)
+
+_NPZ_FORMAT_VERSION = 1
+
+
+def results_to_frame(all_results, image_names):
+    """Combine results for several images in one long DataFrame.
+
+    Each row is one similar study or term; the columns are "image",
+    "result_type" ("study" or "term"), "rank", "similarity" and the studies
+    and terms metadata columns.
+    """
+    frames = []
+    for results, image_name in zip(all_results, image_names):
+        for result_type, key in [("study", "studies"), ("term", "terms")]:
+            frame = as_dataframe(results[key]).copy()
+            frame.insert(0, "rank", range(len(frame)))
+            frame.insert(0, "result_type", result_type)
+            frame.insert(0, "image", image_name)
+            frames.append(frame)
+    if not frames:
+        return pd.DataFrame(
+            columns=["image", "result_type", "rank", "similarity"]
+        )
+    return pd.concat(frames, ignore_index=True, sort=False)
+
+
+class DirectoryWriter:
+    """Write one JSON or HTML file per image in a directory."""
+
+    kind = "results"
+
+    def __init__(self, directory, output_format="json"):
+        if output_format not in ("json", "html"):
+            raise ValueError(
+                f"output_format must be 'json' or 'html', got {output_format}"
+            )
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.output_format = output_format
+
+    def write(self, results, image_name):
+        output_file = self.directory / f"{image_name}.{self.output_format}"
+        if self.output_format == "html":
+            results_to_html(
+                results, image_name, img_display="static"
+            ).save_as_html(output_file)
+        else:
+            output_file.write_text(_results_to_json(results))
+
+    def close(self):
+        pass
+
+
+class JSONLinesWriter:
+    """Write results for each image as one line of a JSON Lines file."""
+
+    kind = "results"
+
+    def __init__(self, output_file):
+        self._file = open(output_file, "w", encoding="utf-8")
+
+    def write(self, results, image_name):
+        record = {"image": image_name}
+        record.update(
+            {key: value for key, value in results.items() if key != "image"}
+        )
+        self._file.write(json.dumps(record, cls=_JSONEncoder))
+        self._file.write("\n")
+
+    def close(self):
+        self._file.close()
+
+
+class FrameWriter:
+    """Accumulate results and write them as one table when closed.
+
+    The table is the one returned by `results_to_frame`; it is written as
+    Parquet for ".parquet" files and as Arrow IPC (Feather v2) otherwise.
+    """
+
+    kind = "results"
+
+    def __init__(self, output_file):
+        self.output_file = Path(output_file)
+        self._results, self._names = [], []
+
+    def write(self, results, image_name):
+        self._results.append(
+            {key: results[key] for key in ("studies", "terms")}
+        )
+        self._names.append(image_name)
+
+    def close(self):
+        frame = results_to_frame(self._results, self._names)
+        if self.output_file.suffix == ".parquet":
+            frame.to_parquet(self.output_file, index=False)
+        else:
+            frame.to_feather(self.output_file)
+
+
+class NPZWriter:
+    """Accumulate result arrays and write them to a `.npz` file when closed.
+
+    The file contains, for n images and k results:
+
+    - "image_names": (n,) strings
+    - "studies_index", "terms_index": (n, k) int64 row positions in the
+      search's `studies_info` and `terms_info` tables
+    - "studies_similarity", "terms_similarity": (n, k) float32
+    - "studies_pmid": (n, k) int64 PubMed IDs of the studies, so the file can
+      be used without the search data
+    - "metadata": JSON string describing the tables the indices refer to
+
+    Only requires NumPy; use `read_npz_results` to get DataFrames back.
+    """
+
+    kind = "top_arrays"
+
+    def __init__(self, output_file, search):
+        self.output_file = Path(output_file)
+        self._studies_pmid = np.asarray(
+            search.studies_info["pmid"], dtype=np.int64
+        )
+        self._n_studies, self._n_terms = search.n_studies, search.n_terms
+        self._names = []
+        self._arrays = {}
+
+    def write_arrays(self, arrays, image_names):
+        """Add results for several images, as computed by the search."""
+        self._names.extend(image_names)
+        studies_pmid = self._studies_pmid[arrays["studies_index"]]
+        for name, array in [
+            ("studies_index", arrays["studies_index"].astype(np.int64)),
+            ("studies_similarity", arrays["studies_similarity"]),
+            ("studies_pmid", studies_pmid),
+            ("terms_index", arrays["terms_index"].astype(np.int64)),
+            ("terms_similarity", arrays["terms_similarity"]),
+        ]:
+            if "similarity" in name:
+                array = np.asarray(array, dtype=np.float32)
+            self._arrays.setdefault(name, []).append(array)
+
+    def close(self):
+        arrays = {
+            name: np.concatenate(chunks)
+            for name, chunks in self._arrays.items()
+        }
+        for name in (
+            "studies_index",
+            "studies_similarity",
+            "studies_pmid",
+            "terms_index",
+            "terms_similarity",
+        ):
+            if name not in arrays:
+                dtype = np.float32 if "similarity" in name else np.int64
+                arrays[name] = np.empty((0, 0), dtype=dtype)
+        metadata = {
+            "format_version": _NPZ_FORMAT_VERSION,
+            "studies_table": "studies_info",
+            "terms_table": "document_frequencies",
+            "n_studies": self._n_studies,
+            "n_terms": self._n_terms,
+        }
+        np.savez(
+            self.output_file,
+            image_names=np.asarray(self._names, dtype=str),
+            metadata=np.asarray(json.dumps(metadata)),
+            **arrays,
+        )
+
+
+class ScoreMatrixWriter:
+    """Write the similarities of all images with all studies to a `.npy` file.
+
+    The matrix has shape (n images, n studies) and dtype float32; row `i`
+    corresponds to the `i`-th query image and column `j` to the `j`-th row of
+    the search's `studies_info` table. It is written through a memory
+    map, so it does not need to fit in memory, and can be opened with
+    `np.load(output_file, mmap_mode="r")`. Rows of images that could not be
+    searched are NaN. The names of all the images are written, one per line,
+    next to the matrix in a text file with the suffix "_images.txt".
+    """
+
+    kind = "similarities"
+
+    def __init__(self, output_file, search, image_names):
+        self.output_file = Path(output_file)
+        self._names = list(image_names)
+        n_images = len(self._names)
+        self._matrix = np.lib.format.open_memmap(
+            str(self.output_file),
+            mode="w+",
+            dtype=np.float32,
+            shape=(n_images, search.n_studies),
+        )
+        self._matrix[:] = np.nan
+
+    def write_similarities(self, similarities, rows):
+        """Store similarities for the images at positions `rows`."""
+        self._matrix[rows] = similarities["studies"]
+
+    def close(self):
+        self._matrix.flush()
+        del self._matrix
+        names_file = self.output_file.with_name(
+            f"{self.output_file.stem}_images.txt"
+        )
+        names_file.write_text("".join(f"{name}\n" for name in self._names))
+
+
+def read_npz_results(npz_file, search):
+    """Load results written by `NPZWriter` as DataFrames.
+
+    Parameters
+    ----------
+    npz_file : path to the `.npz` file
+
+    search : `NeuroQueryImageSearch` with the data (and segments) the
+        results were computed with, whose metadata tables the file refers to.
+
+    Returns
+    -------
+    image_names : list of str
+
+    all_results : list of dicts with keys "studies" and "terms", as returned
+        by `NeuroQueryImageSearch`.
+
+    """
+    with np.load(npz_file) as npz:
+        arrays = {name: npz[name] for name in npz.files}
+    metadata = json.loads(str(arrays["metadata"]))
+    if (metadata["n_studies"], metadata["n_terms"]) != (
+        search.n_studies,
+        search.n_terms,
+    ):
+        raise ValueError(
+            f"{npz_file} was written with different search data: "
+            f"{metadata['n_studies']} studies and {metadata['n_terms']} terms"
+        )
+    all_results = [{} for _ in arrays["image_names"]]
+    for key, table in [
+        ("studies", search.studies_info),
+        ("terms", search.terms_info),
+    ]:
+        for results, index, similarity in zip(
+            all_results, arrays[f"{key}_index"], arrays[f"{key}_similarity"]
+        ):
+            results[key] = SearchHits(table, index, similarity).to_dataframe()
+    return [str(name) for name in arrays["image_names"]], all_results
+
+
+def _require_arrow(output_file):
+    modules = ["pyarrow"]
+    if Path(output_file).suffix == ".parquet":
+        modules.append("fastparquet")
+    if not any(importlib.util.find_spec(module) for module in modules):
+        raise ImportError(
+            f"Writing {Path(output_file).suffix} files requires "
+            f"{' or '.join(modules)}; use a .npz or .jsonl file instead."
+        )
+
+
+def open_writer(output, search, output_format="json", image_names=None):
+    """Create the writer for the output file or directory `output`.
+
+    `image_names`, the names of all query images, are needed for ".npy"
+    outputs.
+    """
+    suffix = Path(output).suffix
+    if suffix == ".npy":
+        return ScoreMatrixWriter(output, search, image_names)
+    if suffix == ".jsonl":
+        return JSONLinesWriter(output)
+    if suffix == ".npz":
+        return NPZWriter(output, search)
+    if suffix in (".parquet", ".arrow", ".feather"):
+        _require_arrow(output)
+        return FrameWriter(output)
+    return DirectoryWriter(output, output_format)
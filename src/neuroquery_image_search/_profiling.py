@@ -0,0 +1,215 @@
+"""Opt-in timing (and allocation tracking) of the stages of a search.
+
+Pass a `Profiler` to `NeuroQueryImageSearch(profiler=...)` (or to
+`fetch_data`): each stage of a search is recorded as a `StageTiming` with its
+wall-clock time and, if `trace_allocations`, the memory it allocated. The
+stages are:
+
+- "fetch_data/<file>": loading each data file
+- "load": loading the query images
+- "mask": masking (and resampling) them
+- "transform": applying the absolute value / positive part
+- "project": projecting the masked images on the atlas
+- "score_studies", "score_terms": computing the similarities
+- "top_k": selecting the most similar studies and terms
+- "dataframes": building the results DataFrames
+
+With an approximate index or quantized loadings, selecting the most similar
+studies is part of scoring them. With several shards, the times of shards
+running in parallel threads are added, so they can exceed the wall-clock
+time of the search.
+
+Records can be read from `Profiler.records`, summarized with `totals`,
+`to_dataframe` or `report`, or received as they are made by callbacks.
+
+"""
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+
+class StageTiming:
+    """Time and memory used by one run of a stage.
+
+    Attributes
+    ----------
+    stage : name of the stage
+
+    seconds : wall-clock duration
+
+    allocated : net bytes allocated during the stage (and still allocated at
+        its end), or `None` if allocations are not traced
+
+    peak : largest number of bytes allocated at any point during the stage,
+        relative to its start, or `None` if allocations are not traced
+
+    """
+
+    def __init__(self, stage, seconds, allocated=None, peak=None):
+        self.stage = stage
+        self.seconds = seconds
+        self.allocated = allocated
+        self.peak = peak
+
+    def __repr__(self):
+        return (
+            f"StageTiming(stage={self.stage!r}, seconds={self.seconds:.6f}, "
+            f"allocated={self.allocated}, peak={self.peak})"
+        )
+
+
+class _Stage:
+    """Context manager recording one stage in a `Profiler`."""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._enter()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        self.profiler._exit(self.name, seconds)
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(profiler, name):
+    """Context manager timing stage `name`; does nothing if `profiler` is None."""
+    if profiler is None:
+        return _NULL_STAGE
+    return profiler.stage(name)
+
+
+class Profiler:
+    """Records the duration and allocations of the stages of searches.
+
+    Parameters
+    ----------
+    trace_allocations : if `True`, memory allocations are traced with
+        `tracemalloc` (started if it is not running), which slows down
+        Python code but not NumPy computations much.
+
+    callbacks : list of functions called with each `StageTiming` as soon as
+        it is recorded (e.g. to send metrics to a monitoring system).
+
+    Attributes
+    ----------
+    records : list of `StageTiming`, in the order in which stages ended
+
+    """
+
+    def __init__(self, trace_allocations=False, callbacks=()):
+        self.trace_allocations = trace_allocations
+        self.callbacks = list(callbacks)
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stage(self, name):
+        """Context manager recording the stage `name`."""
+        return _Stage(self, name)
+
+    def _enter(self):
+        if not self.trace_allocations:
+            return
+        stack = self._local.__dict__.setdefault("stack", [])
+        current, traced_peak = tracemalloc.get_traced_memory()
+        if stack:
+            # keep the peak reached so far by the enclosing stage
+            stack[-1][1] = max(stack[-1][1], traced_peak)
+        _reset_peak()
+        stack.append([current, current])
+
+    def _exit(self, name, seconds):
+        allocated, peak = None, None
+        if self.trace_allocations:
+            stack = self._local.stack
+            start, peak = stack.pop()
+            current, traced_peak = tracemalloc.get_traced_memory()
+            peak = max(peak, traced_peak)
+            allocated, peak = current - start, peak - start
+            if stack:
+                stack[-1][1] = max(stack[-1][1], start + peak)
+        record = StageTiming(name, seconds, allocated, peak)
+        with self._lock:
+            self.records.append(record)
+        for callback in self.callbacks:
+            callback(record)
+
+    def clear(self):
+        """Remove all records."""
+        with self._lock:
+            self.records = []
+
+    def totals(self):
+        """Total time, number of runs and largest peak of each stage.
+
+        Returns
+        -------
+        totals : dict mapping stage names, in the order in which they were
+            first recorded, to dicts with keys "seconds", "count", "peak".
+
+        """
+        totals = {}
+        for record in list(self.records):
+            total = totals.setdefault(
+                record.stage, {"seconds": 0.0, "count": 0, "peak": None}
+            )
+            total["seconds"] += record.seconds
+            total["count"] += 1
+            if record.peak is not None:
+                total["peak"] = max(total["peak"] or 0, record.peak)
+        return totals
+
+    def to_dataframe(self):
+        """The records as a DataFrame with one row per stage run."""
+        return pd.DataFrame(
+            [
+                {
+                    "stage": record.stage,
+                    "seconds": record.seconds,
+                    "allocated": record.allocated,
+                    "peak": record.peak,
+                }
+                for record in list(self.records)
+            ],
+            columns=["stage", "seconds", "allocated", "peak"],
+        )
+
+    def report(self):
+        """A table of the totals, as a string."""
+        lines = [f"{'stage':<36} {'count':>6} {'seconds':>10} {'peak MB':>9}"]
+        for name, total in self.totals().items():
+            peak = (
+                "" if total["peak"] is None else f"{total['peak'] / 1e6:.1f}"
+            )
+            lines.append(
+                f"{name:<36} {total['count']:>6} "
+                f"{total['seconds']:>10.4f} {peak:>9}"
+            )
+        return "\n".join(lines)
+
+
+def _reset_peak():
+    # tracemalloc.reset_peak is not available before Python 3.9; the peak
+    # then includes allocations made before the stage started
+    reset_peak = getattr(tracemalloc, "reset_peak", None)
+    if reset_peak is not None:
+        reset_peak()
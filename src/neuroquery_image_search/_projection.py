@@ -0,0 +1,260 @@
+from collections import OrderedDict
+import threading
+import warnings
+
+import numpy as np
+from scipy import sparse
+
+from neuroquery_image_search._caching import _sample_rows
+
+PROJECTIONS = ("auto", "factored", "fold_loadings", "fold_atlas")
+
+# above this size the atlas is never folded into a dense matrix
+_MAX_DENSE_ATLAS_BYTES = 2**28
+
+# queries with nonzero values in at most this fraction of the voxels are
+# projected through the atlas columns of those voxels only
+_SPARSE_QUERY_FRACTION = 0.25
+
+
+class Projection:
+    """Precomputed operators mapping masked images to similarities.
+
+    The similarity between a masked image `x` and the studies is
+    `studies_loadings @ atlas_inv_covar @ atlas_maps @ x`. The fixed matrices
+    can be composed once so that each query does less work:
+
+    - "factored": nothing is precomputed; each query is multiplied by the
+      (sparse) atlas and then by the inverse covariance.
+    - "fold_loadings": the inverse covariance is folded into the studies and
+      terms loadings, so each query only needs the sparse atlas product.
+    - "fold_atlas": the inverse covariance is folded into the atlas, giving a
+      dense (n components, n voxels) matrix.
+
+    Queries that are zero in most voxels (thresholded maps, regions of
+    interest) are projected through the atlas columns of their nonzero voxels
+    only, so the cost is proportional to the number of active voxels rather
+    than to the size of the mask. The column-sliced operators of explicit
+    regions of interest (see `project`) are cached.
+
+    Parameters
+    ----------
+    data : dict as returned by `fetch_data` or `load_index`
+
+    projection : one of "auto", "factored", "fold_loadings", "fold_atlas".
+        "auto" chooses the strategy with the fewest operations per query,
+        without copying memory-mapped loadings.
+
+    dtype : floating-point type of the precomputed operators, `np.float64` or
+        `np.float32`.
+
+    max_cached_columns : maximum number of column-sliced operators kept for
+        regions of interest; the least recently used ones are discarded
+        first.
+
+    Attributes
+    ----------
+    strategy : the chosen projection strategy
+
+    atlas_operator : sparse or dense matrix applied to masked images
+
+    inv_covar : matrix applied after `atlas_operator`, or `None`
+
+    studies_loadings, terms_loadings : matrices multiplied by the projected
+        queries to obtain similarities
+
+    """
+
+    def __init__(
+        self, data, projection="auto", dtype=np.float64, max_cached_columns=32
+    ):
+        if projection not in PROJECTIONS:
+            raise ValueError(
+                f"projection must be one of {PROJECTIONS}, got {projection}"
+            )
+        self.dtype = np.dtype(dtype)
+        if projection == "auto":
+            projection = _choose_projection(data)
+        self.strategy = projection
+        atlas_maps = data["atlas_maps"]
+        inv_covar = data["atlas_inv_covar"]
+        studies_loadings = data["studies_loadings"]
+        terms_loadings = data["terms_loadings"]
+        self.inv_covar = None
+        self._loadings_inv_covar = None
+        if projection == "factored":
+            self.inv_covar = _as_dtype(inv_covar, self.dtype)
+        elif projection == "fold_atlas":
+            atlas_maps = sparse.csr_matrix(atlas_maps).T.dot(inv_covar.T).T
+        else:
+            self._loadings_inv_covar = inv_covar
+            studies_loadings = data.get("folded_studies_loadings")
+            if studies_loadings is None:
+                studies_loadings = np.dot(data["studies_loadings"], inv_covar)
+            terms_loadings = data.get("folded_terms_loadings")
+            if terms_loadings is None:
+                terms_loadings = np.dot(data["terms_loadings"], inv_covar)
+        self.atlas_operator = _as_dtype(atlas_maps, self.dtype)
+        self.studies_loadings = _as_dtype(studies_loadings, self.dtype)
+        self.terms_loadings = _as_dtype(terms_loadings, self.dtype)
+        self.max_cached_columns = max_cached_columns
+        self._atlas_columns = None
+        self._column_operators = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prepare_loadings(self, loadings):
+        """Transform loadings of new studies or terms like the corpus ones.
+
+        `loadings` has shape (n rows, n components), like
+        `data["studies_loadings"]`; the result can be stacked with
+        `studies_loadings`.
+        """
+        loadings = np.asarray(loadings)
+        if self._loadings_inv_covar is not None:
+            loadings = np.dot(loadings, self._loadings_inv_covar)
+        return _as_dtype(loadings, self.dtype)
+
+    def project(self, masked_imgs, columns=None):
+        """Project masked images: (n images, n voxels) -> (n images, n comp.)
+
+        Parameters
+        ----------
+        masked_imgs : array of shape (n images, n voxels)
+
+        columns : `None` or sorted array of voxel positions. If provided, the
+            images are assumed to be zero outside of these voxels (e.g. a
+            region of interest), and the atlas restricted to them is cached
+            for later queries with the same `columns`. Otherwise, if the
+            images are zero in most voxels, the atlas is restricted to their
+            nonzero voxels for this query only.
+
+        """
+        masked_imgs = np.asarray(masked_imgs)
+        if columns is None:
+            columns = _active_columns(masked_imgs)
+            operator = self.atlas_operator
+            if columns is not None:
+                operator = self._slice_columns(columns)
+        else:
+            operator = self.columns_operator(columns)
+        if columns is not None:
+            masked_imgs = masked_imgs[:, columns]
+        masked_imgs = np.asarray(masked_imgs, dtype=self.dtype)
+        queries = operator.dot(masked_imgs.T)
+        if self.inv_covar is not None:
+            queries = self.inv_covar.dot(queries)
+        return np.asarray(queries).T
+
+    def columns_operator(self, columns):
+        """The atlas operator restricted to `columns`, cached."""
+        columns = np.asarray(columns, dtype=np.intp)
+        key = columns.tobytes()
+        with self._lock:
+            if key in self._column_operators:
+                self._column_operators.move_to_end(key)
+                return self._column_operators[key]
+        operator = self._slice_columns(columns)
+        with self._lock:
+            self._column_operators[key] = operator
+            if len(self._column_operators) > self.max_cached_columns:
+                self._column_operators.popitem(last=False)
+        return operator
+
+    def _slice_columns(self, columns):
+        if not sparse.issparse(self.atlas_operator):
+            return self.atlas_operator[:, columns]
+        if self._atlas_columns is None:
+            # CSC format, in which selecting columns only reads their
+            # nonzero elements
+            self._atlas_columns = sparse.csc_matrix(self.atlas_operator)
+        return self._atlas_columns[:, columns]
+
+    def check(self, data, rtol=None, n_rows=64):
+        """Check that similarities agree with the unfolded float64 formula.
+
+        Returns `True` if similarities computed for a random image with the
+        precomputed operators are close to the reference ones. Only `n_rows`
+        evenly spaced studies and terms are compared, so that the check does
+        not read all the (possibly memory-mapped) loadings.
+        """
+        if rtol is None:
+            rtol = 1e-3 if self.dtype.itemsize < 8 else 1e-7
+        n_voxels = data["atlas_maps"].shape[1]
+        probe = np.random.default_rng(0).standard_normal((1, n_voxels))
+        reference_queries = (
+            data["atlas_inv_covar"].dot(data["atlas_maps"].dot(probe.T)).T
+        )
+        queries = self.project(probe)
+        for loadings, reference_loadings in [
+            (self.studies_loadings, data["studies_loadings"]),
+            (self.terms_loadings, data["terms_loadings"]),
+        ]:
+            rows = _sample_rows(loadings.shape[0], n_rows)
+            loadings = loadings[rows]
+            reference_loadings = reference_loadings[rows]
+            reference = reference_queries.dot(reference_loadings.T)
+            similarities = queries.dot(loadings.T)
+            atol = rtol * np.abs(reference).max(initial=0)
+            if not np.allclose(similarities, reference, rtol=rtol, atol=atol):
+                return False
+        return True
+
+
+def _as_dtype(matrix, dtype):
+    if matrix.dtype == dtype:
+        return matrix
+    return matrix.astype(dtype)
+
+
+def _active_columns(masked_imgs):
+    """Voxels that are nonzero in any image, or `None` if there are many."""
+    if not masked_imgs.size:
+        return None
+    active = masked_imgs.any(axis=0)
+    n_active = np.count_nonzero(active)
+    if n_active > _SPARSE_QUERY_FRACTION * masked_imgs.shape[1]:
+        return None
+    return np.flatnonzero(active)
+
+
+def _choose_projection(data):
+    """Choose the projection strategy with the fewest operations per query.
+
+    Sparse products are counted as twice as expensive as dense ones per
+    nonzero element. Loadings that are memory-mapped are not folded, as that
+    would replace shared pages with a private copy in each process.
+    """
+    if "folded_studies_loadings" in data and "folded_terms_loadings" in data:
+        return "fold_loadings"
+    atlas_maps = data["atlas_maps"]
+    n_components, n_voxels = atlas_maps.shape
+    nnz = atlas_maps.nnz if sparse.issparse(atlas_maps) else atlas_maps.size
+    costs = {"factored": 2 * nnz + n_components**2}
+    if n_components * n_voxels * 8 <= _MAX_DENSE_ATLAS_BYTES:
+        costs["fold_atlas"] = n_components * n_voxels
+    if not any(
+        isinstance(data[key], np.memmap)
+        for key in ("studies_loadings", "terms_loadings")
+    ):
+        costs["fold_loadings"] = 2 * nnz
+    return min(costs, key=costs.get)
+
+
+def prepare_projection(data, projection="auto", dtype=np.float64):
+    """Create a `Projection`, checking it against the reference formula.
+
+    If the precomputed operators don't give the same similarities as the
+    unfolded float64 computation, a warning is issued and the "factored"
+    float64 projection is used instead.
+    """
+    prepared = Projection(data, projection, dtype)
+    if prepared.strategy == "factored" and prepared.dtype == np.float64:
+        return prepared
+    if prepared.check(data):
+        return prepared
+    warnings.warn(
+        f"Projection '{prepared.strategy}' with dtype {prepared.dtype} does "
+        "not agree with the reference computation; "
+        "falling back to 'factored' float64 projection."
+    )
+    return Projection(data, "factored", np.float64)
@@ -0,0 +1,170 @@
+"""Compressed copies of the loadings for faster, memory-bound scoring.
+
+Scoring a query is a product with the (n studies, n components) loadings
+matrix, which is limited by memory bandwidth: storing the loadings in
+float32, float16 or int8 (with one scale per row) reads 2, 4 or 8 times less
+memory than float64. The compressed scores are only used to find candidates:
+each row's quantization error gives a bound on the error of its score, and
+all rows that could be among the top k are re-scored with the exact
+loadings. The ranking and the similarities are therefore those of the exact
+computation.
+
+NumPy converts float16 to float32 in software, so "float16" mostly saves
+memory; "int8" also gives the fastest scoring.
+
+"""
+import numpy as np
+
+from neuroquery_image_search._ranking import top_k, rescale_selected
+
+QUANTIZATIONS = ("float32", "float16", "int8")
+
+# rows converted to float32 and multiplied at once; small enough for the
+# converted block to stay in cache
+_CHUNK_SIZE = 1024
+
+
+class QuantizedLoadings:
+    """Loadings stored in a compact type, with exact re-scoring of the top k.
+
+    Parameters
+    ----------
+    loadings : array of shape (n rows, n components); the exact loadings. A
+        reference is kept (not a copy) to re-score candidates, so if it is
+        memory-mapped only the rows of the candidates are read.
+
+    quantization : one of "float32", "float16", "int8". For "int8", each row
+        is divided by its own scale (its maximum absolute value / 127) before
+        rounding.
+
+    weights : optional array of shape (n rows,) of nonnegative weights by which
+        the scores are multiplied (e.g. the terms weights).
+
+    """
+
+    def __init__(self, loadings, quantization="int8", weights=None):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(
+                f"quantization must be one of {QUANTIZATIONS}, "
+                f"got {quantization}"
+            )
+        self.quantization = quantization
+        self.loadings = loadings
+        self.weights = None if weights is None else np.asarray(weights)
+        n_rows, n_components = loadings.shape
+        self.scales = None
+        if quantization == "int8":
+            self.codes = np.empty((n_rows, n_components), dtype=np.int8)
+            self.scales = np.empty(n_rows, dtype=np.float32)
+        else:
+            self.codes = np.empty((n_rows, n_components), dtype=quantization)
+        # bound on |q.x - q.x_quantized| / |q| for each row
+        self.error_bounds = np.empty(n_rows)
+        rounding = n_components * np.finfo(np.float32).eps
+        for start in range(0, n_rows, _CHUNK_SIZE):
+            chunk = slice(start, start + _CHUNK_SIZE)
+            rows = np.asarray(loadings[chunk], dtype=np.float64)
+            if self.scales is not None:
+                scales = np.abs(rows).max(axis=1) / 127
+                scales[scales == 0] = 1
+                self.scales[chunk] = scales
+                self.codes[chunk] = np.rint(rows / scales[:, None])
+            else:
+                self.codes[chunk] = rows
+            error = rows - self._dequantize(chunk)
+            self.error_bounds[chunk] = np.linalg.norm(
+                error, axis=1
+            ) + rounding * np.linalg.norm(rows, axis=1)
+        if self.weights is not None:
+            self.error_bounds *= self.weights
+
+    @property
+    def nbytes(self):
+        scales = 0 if self.scales is None else self.scales.nbytes
+        return self.codes.nbytes + scales
+
+    def _dequantize(self, rows):
+        values = self.codes[rows].astype(np.float32, copy=False)
+        if self.scales is not None:
+            values = values * self.scales[rows, None]
+        return values
+
+    def approximate_scores(self, queries):
+        """Scores computed with the compact loadings, in float32."""
+        queries = np.asarray(queries, dtype=np.float32)
+        n_rows = self.codes.shape[0]
+        scores = np.empty((len(queries), n_rows), dtype=np.float32)
+        for start in range(0, n_rows, _CHUNK_SIZE):
+            chunk = slice(start, start + _CHUNK_SIZE)
+            codes = self.codes[chunk].astype(np.float32, copy=False)
+            scores[:, chunk] = queries.dot(codes.T)
+        # per-row scales are applied to the scores rather than the codes
+        if self.scales is not None:
+            scores *= self.scales
+        if self.weights is not None:
+            scores *= self.weights
+        return scores
+
+    def exact_scores(self, query, rows):
+        """Scores of one query computed with the exact loadings."""
+        scores = np.asarray(self.loadings[rows]).dot(query)
+        if self.weights is not None:
+            scores *= self.weights[rows]
+        return scores
+
+    def top_k(self, queries, k, rescale_similarities=False):
+        """The `k` rows with the largest exact scores for each query.
+
+        Returns
+        -------
+        indices : array of shape (n queries, min(k, n rows)), by decreasing
+            score; ties are broken by increasing index.
+
+        similarities : exact scores of the selected rows, rescaled to [0, 1]
+            with the exact minimum and maximum over all rows if
+            `rescale_similarities`.
+
+        """
+        indices, similarities, low, high = self.top_k_with_range(queries, k)
+        if rescale_similarities:
+            similarities = rescale_selected(similarities, low, high)
+        return indices, similarities
+
+    def top_k_with_range(self, queries, k):
+        """Like `top_k`, also returning the exact range of all scores.
+
+        Returns
+        -------
+        indices, similarities : see `top_k`; similarities are not rescaled.
+
+        low, high : arrays of shape (n queries,), exact minimum and maximum
+            score over all rows.
+
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float64))
+        n_rows = self.codes.shape[0]
+        k = max(0, min(k, n_rows))
+        indices = np.empty((len(queries), k), dtype=int)
+        similarities = np.empty((len(queries), k))
+        low = np.full(len(queries), np.nan)
+        high = np.full(len(queries), np.nan)
+        if not n_rows:
+            return indices, similarities, low, high
+        approximate = self.approximate_scores(queries)
+        for i, query in enumerate(queries):
+            errors = np.linalg.norm(query) * self.error_bounds
+            lower, upper = approximate[i] - errors, approximate[i] + errors
+            # rows whose score may be above the kth largest lower bound
+            # (at least the largest, to find the maximum score)
+            kth = n_rows - max(k, 1)
+            threshold = np.partition(lower, kth)[kth]
+            candidates = np.flatnonzero(upper >= threshold)
+            scores = self.exact_scores(query, candidates)
+            selected = top_k(scores, k)
+            indices[i] = candidates[selected]
+            similarities[i] = scores[selected]
+            high[i] = scores.max()
+            # rows whose score may be the smallest one
+            candidates = np.flatnonzero(lower <= upper.min())
+            low[i] = self.exact_scores(query, candidates).min()
+        return indices, similarities, low, high
@@ -0,0 +1,130 @@
+import numpy as np
+
+
+def top_k(scores, k):
+    """Indices of the `k` largest scores, in decreasing order of score.
+
+    Uses a partial partition of the scores so that only the `k` selected
+    items are sorted. Ties are broken by increasing index, and NaNs are ranked
+    after all other values.
+
+    Parameters
+    ----------
+    scores : 1D array of similarities
+
+    k : number of items to select; clipped to `len(scores)`
+
+    Returns
+    -------
+    indices : 1D integer array of length `min(k, len(scores))`
+
+    """
+    scores = np.asarray(scores)
+    n_items = scores.shape[0]
+    k = max(0, min(k, n_items))
+    if k == 0:
+        return np.empty(0, dtype=int)
+    candidates = np.arange(n_items)
+    if k < n_items:
+        selected = np.argpartition(-scores, k - 1)[:k]
+        threshold = scores[selected].min()
+        if not np.isnan(threshold):
+            # all items tied with the kth one are candidates so that ties are
+            # resolved by index rather than by the partition algorithm
+            candidates = np.flatnonzero(scores >= threshold)
+    order = np.lexsort((candidates, -scores[candidates]))[:k]
+    return candidates[order]
+
+
+def top_k_rows(scores, k):
+    """Indices of the `k` largest scores in each row of a 2D array.
+
+    Batched version of `top_k`: row `i` of the result is
+    `top_k(scores[i], k)`.
+
+    Parameters
+    ----------
+    scores : 2D array of shape (n queries, n items)
+
+    k : number of items to select for each row; clipped to `n items`
+
+    Returns
+    -------
+    indices : 2D integer array of shape (n queries, min(k, n items))
+
+    """
+    scores = np.asarray(scores)
+    n_rows, n_items = scores.shape
+    k = max(0, min(k, n_items))
+    if k == 0:
+        return np.empty((n_rows, 0), dtype=int)
+    if k < n_items:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.tile(np.arange(n_items), (n_rows, 1))
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.lexsort((candidates, -candidate_scores), axis=1)
+    indices = np.take_along_axis(candidates, order, axis=1)
+    if k < n_items:
+        threshold = candidate_scores.min(axis=1)
+        n_above = (scores >= threshold[:, None]).sum(axis=1)
+        # rows with ties at the boundary (or NaNs among the selected items)
+        # are resolved one by one
+        for row in np.flatnonzero((n_above != k) | np.isnan(threshold)):
+            indices[row] = top_k(scores[row], k)
+    return indices
+
+
+def rescale_selected(selected_scores, low, high):
+    """Rescale selected scores to [0, 1] using the range of all the scores.
+
+    Parameters
+    ----------
+    selected_scores : 2D array of shape (n queries, k)
+
+    low, high : arrays of shape (n queries,); minimum and maximum over all
+        items (not only the selected ones) of each query's scores.
+
+    Returns
+    -------
+    rescaled : `(selected_scores - low) / (high - low)`, except for rows whose
+        scores are all 0, which are left unchanged.
+
+    """
+    selected_scores = np.asarray(selected_scores, dtype=float)
+    low = np.asarray(low, dtype=float)[:, None]
+    high = np.asarray(high, dtype=float)[:, None]
+    all_zero = (low == 0) & (high == 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rescaled = (selected_scores - low) / (high - low)
+    return np.where(all_zero, selected_scores, rescaled)
+
+
+def merge_top_k(candidates, candidate_scores, k):
+    """Select the `k` best of candidates gathered from several top-k lists.
+
+    Parameters
+    ----------
+    candidates : 2D integer array of shape (n queries, n candidates); item
+        indices, each appearing at most once per row, in any order
+
+    candidate_scores : array of the same shape, the scores of the candidates
+
+    k : number of items to select for each row
+
+    Returns
+    -------
+    indices, scores : 2D arrays of shape (n queries, min(k, n candidates)),
+        the selected items by decreasing score, with ties broken by
+        increasing item index as in `top_k_rows`.
+
+    """
+    # sort candidates by index so that ties are broken as in `top_k_rows`
+    order = np.argsort(candidates, axis=1, kind="stable")
+    candidates = np.take_along_axis(candidates, order, axis=1)
+    candidate_scores = np.take_along_axis(candidate_scores, order, axis=1)
+    selected = top_k_rows(candidate_scores, k)
+    return (
+        np.take_along_axis(candidates, selected, axis=1),
+        np.take_along_axis(candidate_scores, selected, axis=1),
+    )
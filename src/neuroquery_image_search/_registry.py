@@ -0,0 +1,238 @@
+"""Process-wide registry of the search data, shared between search objects.
+
+`get_data` loads the NeuroQuery data once per process (and data directory):
+all `NeuroQueryImageSearch` objects created without an explicit `data`, in
+any thread, share the same masker, arrays and tables, and the same prepared
+projections (see `get_projection`).
+
+To share the data between processes without copying it, `publish_data` writes it
+in a `multiprocessing.shared_memory` block, in the layout of the binary index
+(see `_index`), so it contains the folded loadings and columnar tables too.
+Other processes `attach_data` to the block by name and get arrays that are views
+on the same physical memory. By default `publish_data` also sets the environment
+variable `NEUROQUERY_IMAGE_SEARCH_SHARED_DATA` to the name of the block, so
+that `get_data` in worker processes started afterwards (forked or spawned)
+attaches to it instead of loading the data again:
+
+>>> shared = publish_data()                   # in the parent process
+>>> search = NeuroQueryImageSearch()          # in each worker
+
+Before Python 3.13, processes that attach to a block register it with
+their `multiprocessing` resource tracker, which unlinks it when it exits:
+attaching processes should therefore be started from the publishing process
+(as workers of a pre-fork server or a `multiprocessing` pool are), so that
+they share its resource tracker.
+
+"""
+import functools
+import os
+import secrets
+import threading
+
+import numpy as np
+
+from neuroquery_image_search._datasets import (
+    fetch_data,
+    get_neuroquery_data_dir,
+)
+from neuroquery_image_search._index import (
+    _serialize,
+    _write_to_buffer,
+    read_index_buffer,
+)
+from neuroquery_image_search._projection import prepare_projection
+
+SHARED_DATA_ENV = "NEUROQUERY_IMAGE_SEARCH_SHARED_DATA"
+
+_LOCK = threading.RLock()
+# (data directory, lazy) or shared memory block name -> _Entry
+_ENTRIES = {}
+
+
+class _Entry:
+    def __init__(self, data, block=None):
+        self.data = data
+        self.block = block
+        self.projections = {}
+
+
+def get_data(lazy=False, profiler=None):
+    """The search data, loaded once per process.
+
+    If the environment variable `NEUROQUERY_IMAGE_SEARCH_SHARED_DATA` is set,
+    the data is attached from the shared memory block it names (see
+    `publish_data`). Otherwise `fetch_data(lazy=lazy)` is called the first time
+    and its result is returned by later calls with the same `lazy` and data
+    directory.
+
+    Parameters
+    ----------
+    lazy : see `fetch_data`
+
+    profiler : `_profiling.Profiler` or `None`, passed to `fetch_data` when
+        the data is loaded.
+
+    """
+    shared_name = os.environ.get(SHARED_DATA_ENV)
+    if shared_name:
+        return attach_data(shared_name)
+    key = (str(get_neuroquery_data_dir()), bool(lazy))
+    with _LOCK:
+        entry = _ENTRIES.get(key)
+        if entry is None:
+            entry = _Entry(fetch_data(lazy=lazy, profiler=profiler))
+            _ENTRIES[key] = entry
+        return entry.data
+
+
+def get_projection(data, projection="auto", dtype=np.float64):
+    """Prepared `Projection` of `data`, shared if `data` is registered.
+
+    For data returned by `get_data` or `attach_data`, the projection is computed
+    once for each `projection` and `dtype`; for other data
+    `prepare_projection` is called.
+    """
+    with _LOCK:
+        entry = _find_entry(data)
+        if entry is None:
+            return prepare_projection(data, projection, dtype)
+        key = (projection, np.dtype(dtype).str)
+        prepared = entry.projections.get(key)
+        if prepared is None:
+            prepared = prepare_projection(data, projection, dtype)
+            entry.projections[key] = prepared
+        return prepared
+
+
+def _find_entry(data):
+    for entry in _ENTRIES.values():
+        if entry.data is data:
+            return entry
+    return None
+
+
+def clear():
+    """Forget all registered data; it is loaded again by `get_data`."""
+    with _LOCK:
+        _ENTRIES.clear()
+
+
+@functools.lru_cache(maxsize=None)
+def _shared_block_class():
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise RuntimeError("Sharing data between processes needs Python 3.8")
+
+    class SharedBlock(shared_memory.SharedMemory):
+        def close(self):
+            try:
+                super().close()
+            except BufferError:
+                # arrays still use the memory; it is unmapped when they are
+                # garbage-collected
+                pass
+
+    return SharedBlock
+
+
+class SharedData:
+    """Search data published in a shared memory block by `publish_data`.
+
+    Attributes
+    ----------
+    name : name of the shared memory block, to pass to `attach_data`
+
+    size : size of the block in bytes
+
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def unpublish(self):
+        """Remove the block; it is freed when no process uses it anymore."""
+        with _LOCK:
+            entry = _ENTRIES.pop(self.name, None)
+        if os.environ.get(SHARED_DATA_ENV) == self.name:
+            del os.environ[SHARED_DATA_ENV]
+        if entry is not None:
+            entry.block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.unpublish()
+
+
+def publish_data(data=None, name=None, export=True):
+    """Copy the search data in a shared memory block.
+
+    Parameters
+    ----------
+    data : dict as returned by `fetch_data` or `load_index`. If `None`,
+        `get_data()` is used.
+
+    name : name of the shared memory block; by default a random name.
+
+    export : if `True` (the default), `NEUROQUERY_IMAGE_SEARCH_SHARED_DATA`
+        is set to the name of the block, so that `get_data` (and therefore
+        `NeuroQueryImageSearch()`) in this process and in processes started
+        from it afterwards use the shared data.
+
+    Returns
+    -------
+    shared : `SharedData`; call `shared.unpublish()` when the data is no
+        longer needed.
+
+    """
+    block_class = _shared_block_class()
+    if data is None:
+        data = get_data()
+    if name is None:
+        name = f"nqis_{os.getpid()}_{secrets.token_hex(4)}"
+    header, arrays, array_info, size = _serialize(data)
+    block = block_class(name=name, create=True, size=size)
+    try:
+        _write_to_buffer(block.buf, header, arrays, array_info)
+        shared_data = read_index_buffer(
+            block.buf, f"shared memory block {name!r}"
+        )
+    except Exception:
+        block.unlink()
+        raise
+    with _LOCK:
+        _ENTRIES[name] = _Entry(shared_data, block)
+    if export:
+        os.environ[SHARED_DATA_ENV] = name
+    return SharedData(name, size)
+
+
+def attach_data(name):
+    """Search data published with `publish_data`, without copying it.
+
+    The arrays are read-only views on the shared memory block; in the
+    publishing process and in processes forked from it after publishing, the
+    same data object is returned.
+    """
+    with _LOCK:
+        entry = _ENTRIES.get(name)
+        if entry is None:
+            block = _open_block(name)
+            entry = _Entry(
+                read_index_buffer(block.buf, f"shared memory block {name!r}"),
+                block,
+            )
+            _ENTRIES[name] = entry
+        return entry.data
+
+
+def _open_block(name):
+    block_class = _shared_block_class()
+    try:
+        return block_class(name=name, track=False)
+    except TypeError:
+        # `track` was added in Python 3.13
+        return block_class(name=name)
@@ -0,0 +1,117 @@
+from collections import OrderedDict
+import itertools
+import threading
+
+import numpy as np
+from scipy import sparse
+
+INTERPOLATIONS = ("linear", "nearest")
+
+
+class ResamplingCache:
+    """Resample images onto the mask voxels with cached sparse operators.
+
+    For each source geometry (affine and shape) and interpolation, a sparse
+    matrix mapping the source voxels to the mask voxels is built once. Images
+    sharing that geometry are then resampled with a single sparse matrix
+    product. Values outside of the source image are 0; as for
+    `nilearn.image.resample_img` no interpolation is done beyond its edges.
+
+    Parameters
+    ----------
+    mask_affine : affine of the mask image
+
+    mask_voxels : tuple of 3 arrays, the (i, j, k) coordinates of the mask
+        voxels
+
+    interpolation : "linear" or "nearest"
+
+    max_size : maximum number of operators kept in the cache; the least
+        recently used ones are discarded first.
+
+    """
+
+    def __init__(
+        self, mask_affine, mask_voxels, interpolation="linear", max_size=32
+    ):
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError(
+                f"interpolation must be one of {INTERPOLATIONS}, "
+                f"got {interpolation}"
+            )
+        self.mask_affine = np.asarray(mask_affine)
+        self.mask_voxels = mask_voxels
+        self.interpolation = interpolation
+        self.max_size = max_size
+        self._operators = OrderedDict()
+        self._lock = threading.Lock()
+
+    def operator(self, affine, shape):
+        """Sparse (n mask voxels, n source voxels) resampling matrix.
+
+        Source voxels are raveled in Fortran order.
+        """
+        shape = tuple(shape[:3])
+        key = (np.asarray(affine).tobytes(), shape, self.interpolation)
+        with self._lock:
+            if key in self._operators:
+                self._operators.move_to_end(key)
+                return self._operators[key]
+        operator = self._build_operator(np.asarray(affine), shape)
+        with self._lock:
+            self._operators[key] = operator
+            if len(self._operators) > self.max_size:
+                self._operators.popitem(last=False)
+        return operator
+
+    def _build_operator(self, affine, shape):
+        mask_coords = np.vstack(
+            self.mask_voxels + (np.ones(len(self.mask_voxels[0])),)
+        )
+        coords = np.linalg.inv(affine).dot(self.mask_affine).dot(mask_coords)
+        coords = coords[:3].T
+        upper = np.asarray(shape) - 1
+        inside = np.all((coords >= 0) & (coords <= upper), axis=1)
+        rows = np.flatnonzero(inside)
+        coords = coords[inside]
+        if self.interpolation == "nearest":
+            neighbors = [np.minimum(np.floor(coords + 0.5), upper)]
+            weights = [np.ones(len(coords))]
+        else:
+            floor = np.floor(coords)
+            frac = coords - floor
+            neighbors, weights = [], []
+            for offset in itertools.product([0, 1], repeat=3):
+                offset = np.asarray(offset)
+                neighbors.append(np.minimum(floor + offset, upper))
+                weights.append(
+                    np.prod(np.where(offset, frac, 1 - frac), axis=1)
+                )
+        columns = [
+            np.ravel_multi_index(tuple(n.astype(int).T), shape, order="F")
+            for n in neighbors
+        ]
+        operator = sparse.csr_matrix(
+            (
+                np.concatenate(weights),
+                (np.tile(rows, len(weights)), np.concatenate(columns)),
+            ),
+            shape=(len(self.mask_voxels[0]), int(np.prod(shape))),
+        )
+        operator.eliminate_zeros()
+        return operator
+
+    def transform(self, img):
+        """Resample a 3D or 4D image and return the mask voxel values.
+
+        Returns
+        -------
+        masked : array of shape (n mask voxels,) for 3D images, or
+            (n mask voxels, n volumes) for 4D images.
+
+        """
+        data = np.asanyarray(img.dataobj)
+        operator = self.operator(img.affine, img.shape)
+        if data.ndim == 3:
+            return operator.dot(data.ravel(order="F"))
+        return operator.dot(data.reshape((-1, data.shape[3]), order="F"))
@@ -0,0 +1,107 @@
+"""Compact search results, converted to DataFrames only when needed.
+
+Building a DataFrame for each query image (selecting rows of the metadata,
+resetting the index, adding the similarity column) costs more than scoring
+when few results are requested. `SearchHits` holds only the positions and
+similarities of the selected rows and a reference to the metadata table;
+metadata columns are looked up when they are first accessed, and
+`to_dataframe` builds the usual DataFrame on demand.
+
+"""
+import numpy as np
+import pandas as pd
+
+
+class SearchHits:
+    """Most similar studies (or terms) found for one query image.
+
+    Parameters
+    ----------
+    table : metadata of all the studies (or terms): a DataFrame or a table
+        of `_tables`
+
+    index : 1D array, positions in `table` of the selected rows, by
+        decreasing similarity
+
+    similarity : 1D array, similarities of the selected rows
+
+    Attributes
+    ----------
+    index, similarity : see above
+
+    """
+
+    __slots__ = ("table", "index", "similarity", "_metadata")
+
+    def __init__(self, table, index, similarity, metadata=None):
+        self.table = table
+        self.index = index
+        self.similarity = similarity
+        self._metadata = metadata
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return f"<SearchHits: {len(self)} results>"
+
+    @property
+    def columns(self):
+        return list(self.metadata()) + ["similarity"]
+
+    def metadata(self):
+        """Metadata of the selected rows, as a dict of column arrays."""
+        if self._metadata is None:
+            self._metadata = _take_columns(self.table, self.index)
+        return self._metadata
+
+    def __getitem__(self, column):
+        """Values of `column` (a metadata column or "similarity")."""
+        if column == "similarity":
+            return self.similarity
+        return self.metadata()[column]
+
+    def to_dataframe(self):
+        """The results as a DataFrame, with a "similarity" column."""
+        frame = pd.DataFrame(self.metadata())
+        frame["similarity"] = self.similarity
+        return frame
+
+    def to_dict(self):
+        """The results in the format of `DataFrame.to_dict()`."""
+        return {
+            column: dict(enumerate(np.asarray(self[column]).tolist()))
+            for column in self.columns
+        }
+
+    def copy(self):
+        return SearchHits(
+            self.table,
+            self.index.copy(),
+            self.similarity.copy(),
+            None if self._metadata is None else dict(self._metadata),
+        )
+
+    def __getstate__(self):
+        # the metadata of the selected rows is pickled rather than the table
+        return self.index, self.similarity, self.metadata()
+
+    def __setstate__(self, state):
+        self.table = None
+        self.index, self.similarity, self._metadata = state
+
+
+def _take_columns(table, rows):
+    if isinstance(table, pd.DataFrame):
+        return {
+            column: table[column].to_numpy()[rows] for column in table.columns
+        }
+    selected = table.take(rows)
+    return {column: selected[column].to_numpy() for column in selected.columns}
+
+
+def as_dataframe(results):
+    """`results.to_dataframe()` for `SearchHits`; DataFrames are returned."""
+    if isinstance(results, pd.DataFrame):
+        return results
+    return results.to_dataframe()
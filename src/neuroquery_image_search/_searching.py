@@ -1,11 +1,71 @@
+import base64
+import functools
+import io
 from pathlib import Path
 from string import Template
 import json
+import sys
 
 import numpy as np
-from nilearn import plotting, datasets, image
 
-from neuroquery_image_search._datasets import fetch_data
+from neuroquery_image_search._ann import IVFIndex
+from neuroquery_image_search._caching import corpus_fingerprint
+from neuroquery_image_search._index import load_index
+from neuroquery_image_search._masking import QueryMasker
+from neuroquery_image_search._profiling import stage, Profiler
+from neuroquery_image_search._registry import get_data, get_projection
+from neuroquery_image_search._results import SearchHits, as_dataframe
+from neuroquery_image_search._quantization import QuantizedLoadings
+from neuroquery_image_search._ranking import (
+    rescale_selected,
+    merge_top_k,
+)
+from neuroquery_image_search._sharding import ShardedScorer
+from neuroquery_image_search._segments import (
+    _check_part,
+    list_segments,
+    read_segment,
+    write_segment,
+    compact_segments,
+)
+from neuroquery_image_search._tables import ConcatenatedTable
+
+
+def _similarity_cells(similarities, bar_width):
+    """HTML cells showing similarities as numbers on top of a bar chart.
+
+    Similarities are formatted with 2 decimals and drawn as a light green bar
+    whose length is proportional to the similarity, the longest bar taking
+    `bar_width` percent of the cell.
+    """
+    similarities = np.asarray(similarities, dtype=float)
+    vmax = similarities.max(initial=0.0)
+    if vmax > 0:
+        widths = np.clip(bar_width * similarities / vmax, 0, bar_width)
+    else:
+        widths = np.zeros(similarities.shape)
+    widths = np.char.mod("%.1f", widths).astype(object)
+    return (
+        "<td style='width: 10em; background: linear-gradient(90deg, "
+        "lightgreen "
+        + widths
+        + "%, transparent "
+        + widths
+        + "%)'>"
+        + np.char.mod("%.2f", similarities).astype(object)
+        + "</td>"
+    )
+
+
+def _html_table(header, rows, table_class):
+    """Assemble an HTML table from a list of column headers and rows."""
+    head = "".join(f"<th>{name}</th>" for name in header)
+    body = "\n".join(f"    <tr>{row}</tr>" for row in rows)
+    return (
+        f'<table class="{table_class}">\n'
+        f"  <thead>\n    <tr>{head}</tr>\n  </thead>\n"
+        f"  <tbody>\n{body}\n  </tbody>\n</table>\n"
+    )
 
 
 def studies_to_html_table(studies):
@@ -13,7 +73,7 @@ def studies_to_html_table(studies):
 
     Parameters
     ----------
-    studies : pandas DataFrame, as returned by
+    studies : pandas DataFrame (or `_results.SearchHits`), as returned by
         `NeuroQueryImageSearch()(img)["studies"]`
 
     Returns
@@ -21,25 +81,16 @@ def studies_to_html_table(studies):
     table : a `str` containing an HTML table.
 
     """
-    studies["Title"] = [
-        f"<a href='{link}' target='_blank'>{text}</a>"
-        for link, text in studies.loc[:, ["pubmed_url", "title"]].values
-    ]
-    studies = studies.loc[
-        :, ["Title", "similarity", "pmid", "title", "pubmed_url"]
-    ]
-    studies.rename(columns={"similarity": "Similarity"}, inplace=True)
-    table = (
-        studies.style.bar(
-            subset=["Similarity"], color="lightgreen", width=98, vmin=0.0
-        )
-        .hide(axis=0)
-        .hide(["pmid", "title", "pubmed_url"], axis=1)
-        .format({"Similarity": "{:.2f}"})
-        .set_table_attributes('class="studies-table"')
-        .to_html()
+    studies = as_dataframe(studies)
+    titles = (
+        "<td><a href='"
+        + studies["pubmed_url"].astype(str).values.astype(object)
+        + "' target='_blank'>"
+        + studies["title"].astype(str).values.astype(object)
+        + "</a></td>"
     )
-    return table
+    rows = titles + _similarity_cells(studies["similarity"].values, 98)
+    return _html_table(["Title", "Similarity"], rows, "studies-table")
 
 
 def terms_to_html_table(terms):
@@ -47,7 +98,7 @@ def terms_to_html_table(terms):
 
     Parameters
     ----------
-    terms : pandas DataFrame, as returned by
+    terms : pandas DataFrame (or `_results.SearchHits`), as returned by
         `NeuroQueryImageSearch()(img)["terms"]`
 
     Returns
@@ -55,27 +106,49 @@ def terms_to_html_table(terms):
     table : a `str` containing an HTML table.
 
     """
-    nq_url = (
-        "<a href='https://neuroquery.org/query?text={}' target='_blank'>{}</a>"
-    )
-    terms["Term"] = [
-        nq_url.format(t.replace(" ", "+"), t) for t in terms["term"]
-    ]
-    terms = terms.loc[:, ["Term", "similarity"]]
-    terms.rename(columns={"similarity": "Similarity"}, inplace=True)
-    table = (
-        terms.style.bar(
-            subset=["Similarity"], color="lightgreen", width=95, vmin=0.0
-        )
-        .hide(axis=0)
-        .format({"Similarity": "{:.2f}"})
-        .set_table_attributes('class="terms-table"')
-        .to_html()
+    terms = as_dataframe(terms)
+    term_names = terms["term"].astype(str).values.astype(object)
+    links = (
+        "<td><a href='https://neuroquery.org/query?text="
+        + np.char.replace(term_names.astype(str), " ", "+").astype(object)
+        + "' target='_blank'>"
+        + term_names
+        + "</a></td>"
+    )
+    rows = links + _similarity_cells(terms["similarity"].values, 95)
+    return _html_table(["Term", "Similarity"], rows, "terms-table")
+
+
+@functools.lru_cache(maxsize=None)
+def _get_results_template():
+    return Template(
+        Path(__file__)
+        .parent.joinpath("data", "search_results_template.html")
+        .read_text()
+    )
+
+
+def _static_img_display(img):
+    """Glass brain plot of `img` as an inline PNG."""
+    import matplotlib.pyplot as plt
+    from nilearn import image, plotting
+
+    data = np.abs(image.get_data(img))
+    threshold = np.percentile(data[data != 0], 95) if data.any() else None
+    display = plotting.plot_glass_brain(
+        img, threshold=threshold, plot_abs=False
     )
-    return table
+    buffer = io.BytesIO()
+    display.frame_axes.figure.savefig(buffer, format="png")
+    display.close()
+    plt.close("all")
+    encoded = base64.b64encode(buffer.getvalue()).decode("ascii")
+    return f"<img src='data:image/png;base64,{encoded}' style='width: 100%'/>"
 
 
-def results_to_html(results, title="NeuroQuery Image Search"):
+def results_to_html(
+    results, title="NeuroQuery Image Search", img_display="viewer"
+):
     """Create an HTML page displaying results of NeuroQueryImageSearch
 
     Parameters
@@ -84,6 +157,11 @@ def results_to_html(results, title="NeuroQuery Image Search"):
 
     title : str, title of the resulting page
 
+    img_display : {"viewer", "static", "none"}
+        How the input image is shown: an interactive brain viewer ("viewer",
+        the default), a static glass brain picture ("static"), which is much
+        smaller and faster to create, or not at all ("none").
+
     Returns
     -------
     html : nilearn.plotting.html_document.HTMLDocument
@@ -91,20 +169,27 @@ def results_to_html(results, title="NeuroQuery Image Search"):
        `save_as_html` and `open_in_browser`.
 
     """
+    from nilearn import plotting
+
     studies_table = studies_to_html_table(results["studies"])
     terms_table = terms_to_html_table(results["terms"])
-    img_display = plotting.view_img(
-        results["image"], threshold="95%"
-    ).get_iframe()
-    template = (
-        Path(__file__)
-        .parent.joinpath("data", "search_results_template.html")
-        .read_text()
-    )
-    html = Template(template).safe_substitute(
+    if img_display == "viewer":
+        img_html = plotting.view_img(
+            results["image"], threshold="95%"
+        ).get_iframe()
+    elif img_display == "static":
+        img_html = _static_img_display(results["image"])
+    elif img_display == "none":
+        img_html = ""
+    else:
+        raise ValueError(
+            "img_display must be 'viewer', 'static' or 'none', "
+            f"got {img_display}"
+        )
+    html = _get_results_template().safe_substitute(
         {
             "title": title,
-            "img_display": img_display,
+            "img_display": img_html,
             "studies_table": studies_table,
             "terms_table": terms_table,
         }
@@ -119,12 +204,12 @@ class _JSONEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-def _rescale_similarities(similarities):
-    if (similarities == 0).all():
-        return similarities
-    similarities = similarities - similarities.min()
-    similarities = similarities / similarities.max()
-    return similarities
+def _results_to_json(results):
+    """Serialize search results, except for the input image, to JSON."""
+    return json.dumps(
+        {key: value for key, value in results.items() if key != "image"},
+        cls=_JSONEncoder,
+    )
 
 
 class NeuroQueryImageSearch:
@@ -140,10 +225,306 @@ class NeuroQueryImageSearch:
     Returns a dict containing "terms" and "studies" DataFrames as well as
     "image" (`nibabel.Nifti1Image` containing the input image).
 
+    Parameters
+    ----------
+    lazy : if `True`, the data arrays are memory-mapped and the studies and
+        terms metadata are read only for the rows that are returned. See
+        `fetch_data` for details.
+
+    data : dict as returned by `fetch_data` or `load_index`. If `None` (the
+        default), the data is loaded with `fetch_data` the first time and
+        shared by all search objects of the process; see `_registry`.
+
+    projection : {"auto", "factored", "fold_loadings", "fold_atlas"}
+        How the atlas inverse covariance is combined with the other fixed
+        matrices when the search object is created, to reduce the work done
+        for each query. "auto" (the default) picks the cheapest option for
+        the data shapes. See `_projection.Projection` for details.
+
+    dtype : floating-point type used for the projection and scoring, either
+        `np.float64` (the default) or `np.float32`.
+
+    interpolation : `None`, "linear" or "nearest". How images that are not in
+        the space of the mask are resampled. If `None` (the default), the
+        nilearn masker resamples each image. Otherwise a sparse resampling
+        operator is computed once for each image geometry and reused for
+        all images that share it.
+
+    cache : `ResultCache` or `None`. If provided, results are cached and
+        searching again with the same image and parameters returns the cached
+        results without projecting and scoring the image.
+
+    ann : `None` (the default) or dict of parameters for `_ann.IVFIndex`,
+        e.g. `{"n_probe": 16}`. If provided, an approximate nearest-neighbour
+        index is built over the studies loadings and the most similar studies
+        are searched among a subset of them. This is faster for very large
+        corpora, but may miss some of the most similar studies; with
+        `rescale_similarities` the minimum and maximum are those of the
+        scanned studies. The index is stored in the `ann_index` attribute, and
+        its `n_probe` can be changed to trade speed for recall. Building the
+        index reads all the studies loadings, which costs more than an exact
+        search with one image; data loaded with `load_index` holds prebuilt
+        lists, which are used unless other parameters than `n_probe` are
+        given. Otherwise the index is built once per search object.
+
+    quantization : `None` (the default), "float32", "float16" or "int8".
+        If provided, compact copies of the studies and terms loadings are
+        used to score all studies and terms, and only the candidates that
+        may be among the most similar ones are re-scored with the exact
+        loadings, so results are unchanged. This reduces the memory read for
+        each query; combined with `lazy=True` or an index (see `load_index`),
+        the exact loadings stay memory-mapped and only the candidates' rows
+        are read. See `_quantization.QuantizedLoadings`.
+
+    segments_dir : `None` (the default) or directory of segments of studies
+        and terms added to the NeuroQuery data (see `_segments`). If
+        provided, the studies and terms of all segments are searched too,
+        and `add_segment` writes new segments in this directory.
+
+    n_shards : number of row blocks of the studies and terms loadings scored
+        in parallel threads, each keeping its own top results before they
+        are merged. 1 (the default) scores all rows at once; -1 uses one
+        shard per CPU. Results do not depend on `n_shards`. See
+        `_sharding.ShardedScorer`.
+
+    profiler : `_profiling.Profiler` or `None` (the default). If provided,
+        the time (and optionally the memory) taken by each stage of loading
+        the data and searching is recorded in it. It can also be set later
+        with the `profiler` attribute.
+
+    Attributes
+    ----------
+    studies_info, terms_info : tables of the studies and terms that are
+        searched, those of the data followed by those of the segments.
+
     """
 
-    def __init__(self):
-        self.data = fetch_data()
+    def __init__(
+        self,
+        lazy=False,
+        data=None,
+        projection="auto",
+        dtype=np.float64,
+        interpolation=None,
+        cache=None,
+        ann=None,
+        quantization=None,
+        segments_dir=None,
+        n_shards=1,
+        profiler=None,
+    ):
+        if data is None:
+            data = get_data(lazy=lazy, profiler=profiler)
+        self.data = data
+        self.projection = get_projection(data, projection, dtype)
+        self._masker = QueryMasker(data["masker"], interpolation)
+        self.cache = cache
+        self.ann_index = None
+        if ann is not None:
+            self.ann_index = IVFIndex(
+                self.projection.studies_loadings,
+                lists=_saved_ann_lists(data, self.projection, ann),
+                **ann,
+            )
+        self._terms_weights = np.log(
+            1 + data["document_frequencies"]["document_frequency"].values
+        )
+        self._studies_quantized, self._terms_quantized = None, None
+        if quantization is not None:
+            self._studies_quantized = QuantizedLoadings(
+                self.projection.studies_loadings, quantization
+            )
+            self._terms_quantized = QuantizedLoadings(
+                self.projection.terms_loadings,
+                quantization,
+                weights=self._terms_weights,
+            )
+        self._studies_scorer = ShardedScorer(
+            self.projection.studies_loadings, n_shards, name="studies"
+        )
+        self._terms_scorer = ShardedScorer(
+            self.projection.terms_loadings,
+            n_shards,
+            weights=self._terms_weights,
+            name="terms",
+        )
+        self.profiler = profiler
+        self.segments_dir = segments_dir
+        self._studies_tables = [data["studies_info"]]
+        self._terms_tables = [data["document_frequencies"]]
+        self._segments_studies_loadings = None
+        self._segments_terms_loadings = None
+        self._segments_terms_weights = None
+        self._fingerprint = None
+        if segments_dir is not None:
+            for segment_dir in list_segments(segments_dir):
+                self._add_segment_data(read_segment(segment_dir, lazy=lazy))
+
+    def close(self):
+        """Stop the threads scoring shards (see `n_shards`).
+
+        They are started again if the object is used after `close`. The
+        search object can also be used as a context manager, which closes it
+        on exit.
+        """
+        self._studies_scorer.close()
+        self._terms_scorer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def profiler(self):
+        return self._profiler
+
+    @profiler.setter
+    def profiler(self, profiler):
+        self._profiler = profiler
+        self._studies_scorer.profiler = profiler
+        self._terms_scorer.profiler = profiler
+
+    @property
+    def studies_info(self):
+        if len(self._studies_tables) == 1:
+            return self._studies_tables[0]
+        return ConcatenatedTable(self._studies_tables)
+
+    @property
+    def terms_info(self):
+        if len(self._terms_tables) == 1:
+            return self._terms_tables[0]
+        return ConcatenatedTable(self._terms_tables)
+
+    @property
+    def n_studies(self):
+        return sum(len(table) for table in self._studies_tables)
+
+    @property
+    def n_terms(self):
+        return sum(len(table) for table in self._terms_tables)
+
+    def add_segment(
+        self,
+        studies_loadings=None,
+        studies_info=None,
+        terms_loadings=None,
+        document_frequencies=None,
+    ):
+        """Add studies and terms to the searched corpus.
+
+        The data arrays are not modified: the new studies and terms are
+        scored separately and their results merged with those of the
+        NeuroQuery data. If `segments_dir` was provided, they are written
+        there as a new segment, so that search objects created later with the
+        same `segments_dir` find them too. Cached results are cleared.
+
+        Parameters
+        ----------
+        studies_loadings : array of shape (n new studies, n components), in
+            the same components as `data["studies_loadings"]`
+
+        studies_info : DataFrame with the same columns as
+            `data["studies_info"]` ("pmid", "title", "pubmed_url")
+
+        terms_loadings : array of shape (n new terms, n components)
+
+        document_frequencies : DataFrame with the same columns as
+            `data["document_frequencies"]` ("term", "document_frequency")
+
+        """
+        segment = {
+            "studies_loadings": studies_loadings,
+            "studies_info": studies_info,
+            "terms_loadings": terms_loadings,
+            "document_frequencies": document_frequencies,
+        }
+        if self.segments_dir is None:
+            self._add_segment_data(segment)
+            return
+        self._check_segment(segment)
+        segment_dir = write_segment(self.segments_dir, **segment)
+        self._add_segment_data(read_segment(segment_dir))
+
+    def compact_segments(self):
+        """Merge the segments in `segments_dir` into one segment.
+
+        Search results are not changed; this only reduces the number of files
+        read by search objects created later.
+        """
+        if self.segments_dir is None:
+            raise ValueError("No segments_dir to compact")
+        return compact_segments(self.segments_dir)
+
+    def _check_segment(self, segment):
+        """Raise a `ValueError` if `segment` doesn't match the data."""
+        for kind, loadings_key, info_key, tables in [
+            (
+                "studies",
+                "studies_loadings",
+                "studies_info",
+                self._studies_tables,
+            ),
+            (
+                "terms",
+                "terms_loadings",
+                "document_frequencies",
+                self._terms_tables,
+            ),
+        ]:
+            loadings, info = segment[loadings_key], segment[info_key]
+            columns = list(tables[0].columns)
+            if not _check_part(loadings, info, columns, kind):
+                continue
+            if set(info.columns) != set(columns):
+                raise ValueError(
+                    f"{info_key} of the segment have columns "
+                    f"{list(info.columns)}, expected {columns}"
+                )
+            n_components = self.data[loadings_key].shape[1]
+            if np.shape(loadings)[1] != n_components:
+                raise ValueError(
+                    f"{kind} loadings of the segment have "
+                    f"{np.shape(loadings)[1]} components, expected "
+                    f"{n_components}"
+                )
+
+    def _add_segment_data(self, segment):
+        self._check_segment(segment)
+        # prepare all arrays before changing the search object, so that it is
+        # unchanged if this fails
+        studies_loadings, terms_loadings = None, None
+        if segment["studies_loadings"] is not None:
+            studies_loadings = _stack(
+                self._segments_studies_loadings,
+                self.projection.prepare_loadings(segment["studies_loadings"]),
+            )
+        if segment["terms_loadings"] is not None:
+            terms_loadings = _stack(
+                self._segments_terms_loadings,
+                self.projection.prepare_loadings(segment["terms_loadings"]),
+            )
+            terms_weights = _stack(
+                self._segments_terms_weights,
+                np.log(
+                    1
+                    + np.asarray(
+                        segment["document_frequencies"]["document_frequency"]
+                    )
+                ),
+            )
+        if studies_loadings is not None:
+            self._segments_studies_loadings = studies_loadings
+            self._studies_tables.append(segment["studies_info"])
+        if terms_loadings is not None:
+            self._segments_terms_loadings = terms_loadings
+            self._segments_terms_weights = terms_weights
+            self._terms_tables.append(segment["document_frequencies"])
+        self._fingerprint = None
+        if self.cache is not None:
+            self.cache.clear()
 
     def __call__(
         self,
@@ -152,6 +533,9 @@ class NeuroQueryImageSearch:
         n_terms=20,
         transform="absolute_value",
         rescale_similarities=True,
+        compact=False,
+        roi=None,
+        threshold=None,
     ):
         """Search for studies and terms with activation maps similar to an image
 
@@ -173,6 +557,27 @@ class NeuroQueryImageSearch:
         rescale_similarities : if `True` (the default), similarities are
             rescaled to span the range [0, 1]
 
+        compact : if `True`, "studies" and "terms" are `_results.SearchHits`
+            rather than DataFrames: they hold the positions and similarities
+            of the results, look up the metadata only when it is accessed,
+            and are converted with `to_dataframe()`. This avoids building
+            DataFrames when the results are serialized directly, e.g. to JSON.
+            Default is `False`.
+
+        roi : `None` (the default), path or `nibabel.Nifti1Image`; a region
+            of interest. If provided, voxels where it is 0 are ignored, and
+            the image is projected through the atlas restricted to the
+            region, which is faster for small regions. The restricted atlas
+            is cached, so searching again with the same region is faster.
+
+        threshold : `None` (the default) or float. If provided, voxels whose
+            absolute value (after `transform`) is below `threshold` are
+            ignored.
+
+            Images that are zero in most voxels (e.g. thresholded maps) are
+            always projected through the atlas restricted to their nonzero
+            voxels; see `_projection.Projection`.
+
         Returns
         -------
         results : dictionary with keys "image", "studies", "terms".
@@ -185,55 +590,404 @@ class NeuroQueryImageSearch:
              columns: ['term', 'document_frequency', 'similarity'].
 
         """
-        total_n_studies = self.data["studies_loadings"].shape[0]
-        total_n_terms = self.data["terms_loadings"].shape[0]
+        return self.search_many(
+            [query_img],
+            n_studies=n_studies,
+            n_terms=n_terms,
+            transform=transform,
+            rescale_similarities=rescale_similarities,
+            compact=compact,
+            roi=roi,
+            threshold=threshold,
+        )[0]
+
+    def search_many(
+        self,
+        query_imgs,
+        n_studies=50,
+        n_terms=20,
+        transform="absolute_value",
+        rescale_similarities=True,
+        compact=False,
+        roi=None,
+        threshold=None,
+    ):
+        """Search for studies and terms similar to each of several images.
+
+        All images are masked, projected and scored together, which is much
+        faster than calling the search object once per image.
+
+        Parameters
+        ----------
+        query_imgs : list of paths or `nibabel.Nifti1Image`, or a 4D image;
+            the input images
+
+        n_studies, n_terms, transform, rescale_similarities, compact, roi,
+        threshold : see `NeuroQueryImageSearch.__call__`
+
+        Returns
+        -------
+        results : list of dictionaries, one for each input image, as returned
+            by `NeuroQueryImageSearch.__call__`.
+
+        """
         print(
-            f"Searching in {total_n_studies:,} studies "
-            f"and {total_n_terms:,} terms "
+            f"Searching in {self.n_studies:,} studies "
+            f"and {self.n_terms:,} terms "
             "for similar activation patterns"
         )
-        query_img = image.load_img(query_img)
-        masked_query_img = self.data["masker"].transform(query_img).ravel()
-        if transform == "absolute_value":
-            masked_query_img = np.abs(masked_query_img)
-        elif transform == "positive_part":
-            masked_query_img = np.maximum(0, masked_query_img)
-        query = self.data["atlas_inv_covar"].dot(
-            self.data["atlas_maps"].dot(masked_query_img)
+        query_imgs = self._load(query_imgs)
+        if not query_imgs:
+            return []
+        masked_query_imgs, columns = self._restrict(
+            self._mask(query_imgs, transform), roi, threshold
+        )
+        all_results = self._search_masked(
+            masked_query_imgs,
+            columns,
+            n_studies=n_studies,
+            n_terms=n_terms,
+            transform=transform,
+            rescale_similarities=rescale_similarities,
         )
+        if not compact:
+            with stage(self.profiler, "dataframes"):
+                for results in all_results:
+                    results["studies"] = as_dataframe(results["studies"])
+                    results["terms"] = as_dataframe(results["terms"])
+        for results, img in zip(all_results, query_imgs):
+            results["image"] = img
+        return all_results
 
-        results = {}
+    def similarities(
+        self,
+        query_imgs,
+        transform="absolute_value",
+        rescale_similarities=False,
+        roi=None,
+        threshold=None,
+    ):
+        """Similarities of each image with all the studies and terms.
 
-        similarities = self.data["studies_loadings"].dot(query)
-        most_similar = np.argsort(similarities)[::-1][:n_studies]
+        Unlike `search_many`, all similarities are returned, as arrays, so
+        results can be selected with any cutoff without searching again.
 
-        if rescale_similarities:
-            similarities = _rescale_similarities(similarities)
-        study_results = (
-            self.data["studies_info"]
-            .iloc[most_similar]
-            .reset_index(drop=True, inplace=False)
+        Parameters
+        ----------
+        query_imgs : list of paths or `nibabel.Nifti1Image`, or a 4D image;
+            the input images
+
+        transform, roi, threshold : see `NeuroQueryImageSearch.__call__`
+
+        rescale_similarities : if `True`, similarities are rescaled to span
+            the range [0, 1] for each image. `False` by default.
+
+        Returns
+        -------
+        similarities : dictionary with keys "studies", "terms".
+           - "studies" is a float32 array of shape (n images, n studies) whose
+             columns correspond to the rows of `self.studies_info`
+
+           - "terms" is a float32 array of shape (n images, n terms) whose
+             columns correspond to the rows of `self.terms_info`
+
+        """
+        query_imgs = self._load(query_imgs)
+        if query_imgs:
+            masked_query_imgs = self._mask(query_imgs, transform)
+        else:
+            masked_query_imgs = np.empty((0, self._masker.n_voxels))
+        masked_query_imgs, columns = self._restrict(
+            masked_query_imgs, roi, threshold
         )
-        study_results["similarity"] = similarities[most_similar]
-        results["studies"] = study_results
+        return self._compute_similarities(
+            masked_query_imgs, rescale_similarities, columns
+        )
+
+    def _load(self, query_imgs):
+        with stage(self.profiler, "load"):
+            return _load_imgs(query_imgs)
 
-        similarities = self.data["terms_loadings"].dot(query)
-        similarities *= np.log(
-            1 + self.data["document_frequencies"]["document_frequency"].values
+    def _mask(self, query_imgs, transform):
+        """Masked and transformed images, of shape (n images, n voxels)."""
+        with stage(self.profiler, "mask"):
+            masked_query_imgs = self._masker.transform(query_imgs)
+        with stage(self.profiler, "transform"):
+            return _transform_masked_imgs(masked_query_imgs, transform)
+
+    def _restrict(self, masked_query_imgs, roi, threshold):
+        """Set the voxels outside of `roi` or below `threshold` to 0.
+
+        Returns the restricted images and the positions of the mask voxels
+        in `roi`, or `None` if there is no region of interest.
+        """
+        if threshold is not None:
+            masked_query_imgs[np.abs(masked_query_imgs) < threshold] = 0
+        if roi is None:
+            return masked_query_imgs, None
+        from nilearn import image
+
+        with stage(self.profiler, "mask"):
+            roi_img = image.load_img(roi)
+            columns = np.flatnonzero(self._masker.transform([roi_img])[0])
+        restricted = np.zeros_like(masked_query_imgs)
+        restricted[:, columns] = masked_query_imgs[:, columns]
+        return restricted, columns
+
+    def _corpus_fingerprint(self):
+        """Fingerprint of the searched loadings and metadata, for the cache."""
+        if self._fingerprint is None:
+            self._fingerprint = corpus_fingerprint(
+                [
+                    loadings
+                    for loadings in (
+                        self.projection.studies_loadings,
+                        self.projection.terms_loadings,
+                        self._segments_studies_loadings,
+                        self._segments_terms_loadings,
+                    )
+                    if loadings is not None
+                ],
+                [self.studies_info, self.terms_info],
+            )
+        return self._fingerprint
+
+    def _search_masked(self, masked_query_imgs, columns=None, **params):
+        """Search with masked, transformed images, using the cache if any.
+
+        `columns` are the voxels of a region of interest outside of which
+        the images are 0 (see `_projection.Projection.project`); they do not
+        change the results, so they are not part of the cache key.
+
+        Returns a list of dicts with keys "studies" and "terms".
+        """
+        if self.cache is None:
+            return self._compute_results(masked_query_imgs, columns, **params)
+        corpus = (
+            self.n_studies,
+            self.n_terms,
+            self.projection.studies_loadings.shape[1],
+            self.projection.strategy,
+            self.projection.dtype.str,
+            None if self.ann_index is None else self.ann_index.n_probe,
+            self._corpus_fingerprint(),
         )
-        most_similar = np.argsort(similarities)[::-1][:n_terms]
+        keys = [
+            self.cache.key(masked, dict(params, corpus=corpus))
+            for masked in masked_query_imgs
+        ]
+        all_results = [self.cache.get(key) for key in keys]
+        missing = [
+            i for i, results in enumerate(all_results) if results is None
+        ]
+        if not missing:
+            return all_results
+        computed = self._compute_results(
+            masked_query_imgs[missing], columns, **params
+        )
+        for i, results in zip(missing, computed):
+            self.cache.put(keys[i], results)
+            all_results[i] = results
+        return all_results
+
+    def _compute_results(
+        self,
+        masked_query_imgs,
+        columns,
+        n_studies,
+        n_terms,
+        transform,
+        rescale_similarities,
+    ):
+        arrays = self._compute_top_arrays(
+            masked_query_imgs,
+            n_studies,
+            n_terms,
+            rescale_similarities,
+            columns,
+        )
+        return [
+            {
+                "studies": SearchHits(self.studies_info, *studies),
+                "terms": SearchHits(self.terms_info, *terms),
+            }
+            for studies, terms in zip(
+                zip(arrays["studies_index"], arrays["studies_similarity"]),
+                zip(arrays["terms_index"], arrays["terms_similarity"]),
+            )
+        ]
+
+    def _compute_top_arrays(
+        self,
+        masked_query_imgs,
+        n_studies,
+        n_terms,
+        rescale_similarities,
+        columns=None,
+    ):
+        """Positions and similarities of the most similar studies and terms.
+
+        Returns a dict with keys "studies_index", "studies_similarity",
+        "terms_index", "terms_similarity", each an array of shape
+        (n images, n results); indices are row positions in
+        `self.studies_info` and `self.terms_info`.
+        """
+        with stage(self.profiler, "project"):
+            queries = self.projection.project(masked_query_imgs, columns)
+        # the sharded scorers record their own scoring and top-k stages
+        if self.ann_index is not None:
+            with stage(self.profiler, "score_studies"):
+                studies = self.ann_index.search_with_range(queries, n_studies)
+        elif self._studies_quantized is not None:
+            with stage(self.profiler, "score_studies"):
+                studies = self._studies_quantized.top_k_with_range(
+                    queries, n_studies
+                )
+        else:
+            studies = self._studies_scorer.top_k_with_range(queries, n_studies)
+        if self._segments_studies_loadings is not None:
+            studies = self._merge_segments(
+                studies, queries, n_studies, "studies"
+            )
+        if self._terms_quantized is not None:
+            with stage(self.profiler, "score_terms"):
+                terms = self._terms_quantized.top_k_with_range(
+                    queries, n_terms
+                )
+        else:
+            terms = self._terms_scorer.top_k_with_range(queries, n_terms)
+        if self._segments_terms_loadings is not None:
+            terms = self._merge_segments(terms, queries, n_terms, "terms")
         if rescale_similarities:
-            similarities = _rescale_similarities(similarities)
-        term_results = (
-            self.data["document_frequencies"]
-            .iloc[most_similar]
-            .reset_index(drop=True, inplace=False)
+            with stage(self.profiler, "top_k"):
+                studies = studies[0], rescale_selected(*studies[1:])
+                terms = terms[0], rescale_selected(*terms[1:])
+        return {
+            "studies_index": studies[0],
+            "studies_similarity": studies[1],
+            "terms_index": terms[0],
+            "terms_similarity": terms[1],
+        }
+
+    def _merge_segments(self, top, queries, n_results, kind):
+        """Merge top results of the data with those of the segments."""
+        with stage(self.profiler, f"score_{kind}"):
+            segments_similarities = self._score_segments(queries, kind)
+        with stage(self.profiler, "top_k"):
+            return _merge_top_k(
+                top,
+                segments_similarities,
+                len(getattr(self.projection, f"{kind}_loadings")),
+                n_results,
+            )
+
+    def _score_segments(self, queries, kind):
+        if kind == "studies":
+            return queries.dot(self._segments_studies_loadings.T)
+        return (
+            queries.dot(self._segments_terms_loadings.T)
+            * self._segments_terms_weights
         )
-        term_results["similarity"] = similarities[most_similar]
-        results["terms"] = term_results
-        results["image"] = query_img
 
-        return results
+    def _score(self, masked_query_imgs, columns=None):
+        """Similarities of masked images with all studies and all terms."""
+        with stage(self.profiler, "project"):
+            queries = self.projection.project(masked_query_imgs, columns)
+        studies = self._studies_scorer.scores(queries)
+        if self._segments_studies_loadings is not None:
+            with stage(self.profiler, "score_studies"):
+                studies = np.hstack(
+                    [studies, self._score_segments(queries, "studies")]
+                )
+        terms = self._terms_scorer.scores(queries)
+        if self._segments_terms_loadings is not None:
+            with stage(self.profiler, "score_terms"):
+                terms = np.hstack(
+                    [terms, self._score_segments(queries, "terms")]
+                )
+        return studies, terms
+
+    def _compute_similarities(
+        self, masked_query_imgs, rescale_similarities, columns=None
+    ):
+        all_similarities = self._score(masked_query_imgs, columns)
+        result = {}
+        for key, similarities in zip(("studies", "terms"), all_similarities):
+            if rescale_similarities and similarities.shape[1]:
+                similarities = rescale_selected(
+                    similarities, similarities.min(1), similarities.max(1)
+                )
+            result[key] = similarities.astype(np.float32, copy=False)
+        return result
+
+
+def _saved_ann_lists(data, projection, ann):
+    """IVF lists saved in `data` by `build_index`, if they can be used.
+
+    They were built over the folded studies loadings, so they are used only
+    with the "fold_loadings" projection and the default clustering
+    parameters.
+    """
+    keys = ("centroids", "row_ids", "list_offsets")
+    if any(f"ann_{key}" not in data for key in keys):
+        return None
+    if projection.strategy != "fold_loadings" or set(ann) - {"n_probe"}:
+        return None
+    return {key: data[f"ann_{key}"] for key in keys}
+
+
+def _stack(stacked, rows):
+    return rows if stacked is None else np.concatenate([stacked, rows])
+
+
+def _merge_top_k(top, extra_similarities, n_rows, n_results):
+    """Merge top results with the similarities of rows appended after them.
+
+    `top` is the (indices, similarities, low, high) of the top results for
+    the first `n_rows` rows, and `extra_similarities` are the similarities of
+    the rows that follow.
+    """
+    indices, similarities, low, high = top
+    n_queries, n_extra = extra_similarities.shape
+    if not n_extra:
+        return top
+    candidates = np.hstack(
+        [indices, np.tile(np.arange(n_rows, n_rows + n_extra), (n_queries, 1))]
+    )
+    candidate_similarities = np.hstack([similarities, extra_similarities])
+    indices, similarities = merge_top_k(
+        candidates, candidate_similarities, n_results
+    )
+    return (
+        indices,
+        similarities,
+        np.fmin(low, extra_similarities.min(axis=1)),
+        np.fmax(high, extra_similarities.max(axis=1)),
+    )
+
+
+def _load_imgs(query_imgs):
+    """Load query images as a list of 3D images."""
+    from nilearn import image
+
+    if not isinstance(query_imgs, (list, tuple)):
+        query_imgs = [query_imgs]
+    imgs = []
+    for img in query_imgs:
+        img = image.load_img(img)
+        if len(img.shape) == 3:
+            imgs.append(img)
+        else:
+            imgs.extend(image.iter_img(img))
+    return imgs
+
+
+def _transform_masked_imgs(masked_query_imgs, transform):
+    if transform == "absolute_value":
+        return np.abs(masked_query_imgs)
+    if transform == "positive_part":
+        return np.maximum(0, masked_query_imgs)
+    return masked_query_imgs
 
 
 def _get_parser():
@@ -244,11 +998,19 @@ def _get_parser():
     )
     parser.add_argument(
         "query_img",
-        nargs="?",
+        nargs="*",
         type=str,
-        default=None,
+        default=[],
         help="Nifti image with which to query the dataset. "
-        "If not provided, an example image is downloaded from neurovault.org.",
+        "If not provided, an example image is downloaded from neurovault.org. "
+        "Several images, directories or glob patterns can be given to search "
+        "with many images at once; then '--output' is required.",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help="Text file listing images to search with, one path per line",
     )
     parser.add_argument(
         "--n_studies",
@@ -269,7 +1031,83 @@ def _get_parser():
         default=None,
         help="File in which to store the output. If not specified, "
         "output is displayed in a web browser. Output format depends "
-        "on the filename extension (.html or .json)",
+        "on the filename extension (.html or .json). Results for one or "
+        "several images can be written in one .jsonl, .npz, .parquet or "
+        ".arrow file (the last two require pyarrow). With a .npy file, "
+        "the similarities with all studies are written as an "
+        "(images x studies) matrix. When searching with "
+        "several images, it can also be a directory in which one file per "
+        "image is written.",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=["json", "html"],
+        default="json",
+        help="Format of the files written for each image when searching "
+        "with several images and '--output' is a directory",
+    )
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=1,
+        help="Number of processes loading and masking images when searching "
+        "with several images",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=64,
+        help="Number of images scored together when searching with several "
+        "images",
+    )
+    parser.add_argument(
+        "--ann_n_probe",
+        type=int,
+        default=None,
+        help="Search studies with an approximate nearest-neighbour index, "
+        "scanning this many clusters of studies for each image (more is "
+        "slower and more accurate). By default all studies are scanned. "
+        "Building the index takes longer than an exact search, so it is "
+        "saved in the --index file; without --index, it is built each time "
+        "the data is loaded and the option is only allowed with --serve or "
+        "several images.",
+    )
+    parser.add_argument(
+        "--quantization",
+        type=str,
+        choices=["float32", "float16", "int8"],
+        default=None,
+        help="Score studies and terms with compact copies of the loadings, "
+        "re-scoring the best candidates exactly (results are unchanged)",
+    )
+    parser.add_argument(
+        "--n_shards",
+        type=int,
+        default=1,
+        help="Number of row blocks of the studies and terms scored in "
+        "parallel threads (-1: one per CPU)",
+    )
+    parser.add_argument(
+        "--segments",
+        type=str,
+        default=None,
+        help="Directory of segments of studies and terms added to the "
+        "NeuroQuery data, which are searched too",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="time",
+        choices=["time", "memory"],
+        default=None,
+        help="Print the time spent in each stage of loading the data and "
+        "searching; with 'memory', also the memory allocated",
+    )
+    parser.add_argument(
+        "--lazy",
+        action="store_true",
+        help="Memory-map the search data rather than loading it in memory",
     )
     parser.add_argument(
         "--transform",
@@ -286,26 +1124,169 @@ def _get_parser():
         help="Disable rescaling the similarities. "
         "By default they are mapped to the [0, 1] range.",
     )
+    parser.add_argument(
+        "--index",
+        type=str,
+        default=None,
+        help="Binary index from which to load the search data, which is much "
+        "faster than loading the default data files. If the file does not "
+        "exist it is created.",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Instead of searching with one image, load the data once and "
+        "run an HTTP server answering search requests with JSON results. "
+        "See neuroquery_image_search._server for the API.",
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="Address on which the server listens (with --serve)",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8000,
+        help="Port on which the server listens (with --serve)",
+    )
+    parser.add_argument(
+        "--allow_paths",
+        action="store_true",
+        help="Let clients search with the path of an image on the server's "
+        "filesystem rather than uploading it (with --serve). Only use it if "
+        "all clients are trusted, as they can make the server read any file.",
+    )
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        default=None,
+        help="Number of threads computing searches (with --serve)",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=1,
+        help="If greater than 1, concurrent requests are scored together in "
+        "batches of at most this size (with --serve)",
+    )
+    parser.add_argument(
+        "--max_batch_delay",
+        type=float,
+        default=5.0,
+        help="Maximum time in milliseconds a request waits for others "
+        "to form a batch (with --serve)",
+    )
     return parser
 
 
 def image_search(args=None):
     parser = _get_parser()
     args = parser.parse_args(args=args)
-    img = args.query_img
+    profiler = None
+    if args.profile is not None:
+        profiler = Profiler(trace_allocations=(args.profile == "memory"))
+    try:
+        _image_search(parser, args, profiler)
+    finally:
+        if profiler is not None:
+            print(profiler.report(), file=sys.stderr)
+
+
+def _fetch_example_img():
+    """Motor task map from NeuroVault, searched when no image is given."""
+    from nilearn import datasets
+
+    return datasets.fetch_neurovault_motor_task()["images"][0]
+
+
+def _image_search(parser, args, profiler):
+    data = None if args.index is None else load_index(args.index)
+    if data is None and args.lazy:
+        data = get_data(lazy=True, profiler=profiler)
+    search_params = {
+        "data": data,
+        "ann": None
+        if args.ann_n_probe is None
+        else {"n_probe": args.ann_n_probe},
+        "quantization": args.quantization,
+        "segments_dir": args.segments,
+        "lazy": args.lazy,
+        "n_shards": args.n_shards,
+        "profiler": profiler,
+    }
+    if args.serve:
+        from neuroquery_image_search._server import serve
+
+        serve(
+            NeuroQueryImageSearch(**search_params),
+            host=args.host,
+            port=args.port,
+            allow_paths=args.allow_paths,
+            max_workers=args.n_workers,
+            max_batch_size=args.max_batch_size,
+            max_batch_delay=args.max_batch_delay / 1000,
+        )
+        return
+    from neuroquery_image_search import _batch_search
+
+    if _batch_search.is_batch(args.query_img, args.manifest, args.output):
+        if args.output is None:
+            parser.error("--output is required with several images")
+        output = Path(args.output)
+        if (
+            output.suffix
+            and output.suffix not in _batch_search._COMBINED_SUFFIXES
+            and not output.is_dir()
+        ):
+            parser.error(
+                f"cannot write results for several images to "
+                f"{output.suffix} file {args.output}: use a directory or "
+                f"one of {', '.join(_batch_search._COMBINED_SUFFIXES)}"
+            )
+        query_imgs = _batch_search.expand_query_imgs(
+            args.query_img, args.manifest
+        )
+        if not query_imgs:
+            query_imgs = [_fetch_example_img()]
+        failed = _batch_search.batch_search(
+            NeuroQueryImageSearch(**search_params),
+            query_imgs,
+            args.output,
+            n_studies=args.n_studies,
+            n_terms=args.n_terms,
+            transform=args.transform,
+            rescale_similarities=(not args.no_rescaling),
+            output_format=args.output_format,
+            n_jobs=args.n_jobs,
+            batch_size=args.batch_size,
+        )
+        print(
+            f"Saved results for {len(query_imgs) - len(failed)} of "
+            f"{len(query_imgs)} images in {args.output}"
+        )
+        if failed:
+            sys.exit(1)
+        return
+    if args.ann_n_probe is not None and args.index is None:
+        parser.error(
+            "--ann_n_probe requires --index when searching with one image"
+        )
+    img = args.query_img[0] if args.query_img else None
     if img is None:
-        img = datasets.fetch_neurovault_motor_task()["images"][0]
+        img = _fetch_example_img()
     try:
         image_name = Path(img).name
     except Exception:
         image_name = "Image"
-    search = NeuroQueryImageSearch()
+    search = NeuroQueryImageSearch(**search_params)
     results = search(
         img,
         n_studies=args.n_studies,
         n_terms=args.n_terms,
         transform=args.transform,
-        rescale_similarities=(not args.no_rescaling)
+        rescale_similarities=(not args.no_rescaling),
     )
     if args.output is None:
         results_to_html(results, image_name).open_in_browser()
@@ -317,5 +1298,4 @@ def image_search(args=None):
     if output_file.suffix in [".html", ".htm"]:
         results_to_html(results, image_name).save_as_html(output_file)
         return
-    results.pop("image")
-    output_file.write_text(json.dumps(results, cls=_JSONEncoder))
+    output_file.write_text(_results_to_json(results))
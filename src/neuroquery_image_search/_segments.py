@@ -0,0 +1,237 @@
+"""Append-only segments of studies and terms added to the search data.
+
+A segment is a directory holding new studies and/or new terms, in the same
+formats as the NeuroQuery data:
+
+- `projections.npy` and `articles-info.csv`: loadings (in the same
+  components as the NeuroQuery data's `projections.npy`) and metadata
+  ("pmid", "title", "pubmed_url") of new studies
+- `term_projections.npy` and `document_frequencies.csv`: loadings and
+  metadata ("term", "document_frequency") of new terms
+- `segment.json`: the number of studies and terms, and the segments that
+  this one replaces
+
+Segments are written in a temporary directory that is then renamed, so
+readers never see a partial segment, and are never modified. Compacting
+merges all segments into a new one that lists them in "replaces"; segments
+that are replaced are ignored by readers even before they are deleted.
+
+"""
+import json
+import os
+from pathlib import Path
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from neuroquery_image_search._datasets import (
+    get_neuroquery_data_dir,
+    _file_lock,
+)
+from neuroquery_image_search._tables import LazyCSVTable
+
+_STUDIES_FILES = ("projections.npy", "articles-info.csv")
+_TERMS_FILES = ("term_projections.npy", "document_frequencies.csv")
+_SEGMENT_PREFIX = "segment_"
+
+
+def get_default_segments_dir():
+    return Path(get_neuroquery_data_dir()).joinpath(
+        "extra", "neuroquery_image_search_segments"
+    )
+
+
+def _segment_id(segment_dir):
+    return int(Path(segment_dir).name[len(_SEGMENT_PREFIX) :])
+
+
+def _read_segment_info(segment_dir):
+    return json.loads((Path(segment_dir) / "segment.json").read_text())
+
+
+def list_segments(segments_dir=None):
+    """Directories of the segments in `segments_dir`, oldest first.
+
+    Segments replaced by a compacted segment are not listed.
+    """
+    if segments_dir is None:
+        segments_dir = get_default_segments_dir()
+    segments_dir = Path(segments_dir)
+    if not segments_dir.is_dir():
+        return []
+    segments = sorted(
+        (
+            path
+            for path in segments_dir.iterdir()
+            if path.name.startswith(_SEGMENT_PREFIX) and path.is_dir()
+        ),
+        key=_segment_id,
+    )
+    replaced = set()
+    for segment_dir in segments:
+        replaced.update(_read_segment_info(segment_dir)["replaces"])
+    return [
+        segment_dir
+        for segment_dir in segments
+        if _segment_id(segment_dir) not in replaced
+    ]
+
+
+def _check_part(loadings, info, required_columns, kind):
+    if (loadings is None) != (info is None):
+        raise ValueError(
+            f"Both the loadings and the metadata of {kind} needed"
+        )
+    if loadings is None:
+        return 0
+    if np.ndim(loadings) != 2 or len(loadings) != len(info):
+        raise ValueError(
+            f"{kind} loadings must be a 2D array with one row for each row "
+            f"of the {kind} metadata"
+        )
+    missing = set(required_columns).difference(info.columns)
+    if missing:
+        raise ValueError(f"{kind} metadata lacks columns {sorted(missing)}")
+    return len(loadings)
+
+
+def write_segment(
+    segments_dir=None,
+    studies_loadings=None,
+    studies_info=None,
+    terms_loadings=None,
+    document_frequencies=None,
+    replaces=(),
+):
+    """Write a new segment and return its directory.
+
+    Parameters
+    ----------
+    segments_dir : directory containing the segments; by default, in the
+        NeuroQuery data directory.
+
+    studies_loadings : array of shape (n new studies, n components)
+
+    studies_info : DataFrame with columns "pmid", "title", "pubmed_url"
+
+    terms_loadings : array of shape (n new terms, n components)
+
+    document_frequencies : DataFrame with columns "term", "document_frequency"
+
+    replaces : ids of the segments that this one replaces (used by
+        `compact_segments`).
+
+    """
+    n_studies = _check_part(
+        studies_loadings,
+        studies_info,
+        ("pmid", "title", "pubmed_url"),
+        "studies",
+    )
+    n_terms = _check_part(
+        terms_loadings,
+        document_frequencies,
+        ("term", "document_frequency"),
+        "terms",
+    )
+    if segments_dir is None:
+        segments_dir = get_default_segments_dir()
+    segments_dir = Path(segments_dir)
+    segments_dir.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=".tmp_", dir=str(segments_dir)))
+    try:
+        for (loadings_file, info_file), loadings, info in [
+            (_STUDIES_FILES, studies_loadings, studies_info),
+            (_TERMS_FILES, terms_loadings, document_frequencies),
+        ]:
+            if loadings is not None:
+                np.save(str(tmp_dir / loadings_file), np.asarray(loadings))
+                pd.DataFrame(info).to_csv(tmp_dir / info_file, index=False)
+        with _file_lock(segments_dir / ".lock"):
+            existing = [
+                _segment_id(path)
+                for path in segments_dir.glob(f"{_SEGMENT_PREFIX}*")
+            ]
+            segment_id = max(existing, default=0) + 1
+            (tmp_dir / "segment.json").write_text(
+                json.dumps(
+                    {
+                        "n_studies": n_studies,
+                        "n_terms": n_terms,
+                        "replaces": sorted(replaces),
+                    }
+                )
+            )
+            segment_dir = segments_dir / f"{_SEGMENT_PREFIX}{segment_id:06d}"
+            os.replace(str(tmp_dir), str(segment_dir))
+    finally:
+        shutil.rmtree(str(tmp_dir), ignore_errors=True)
+    return segment_dir
+
+
+def read_segment(segment_dir, lazy=False):
+    """Load a segment.
+
+    Returns
+    -------
+    segment : dict with keys "studies_loadings", "studies_info",
+        "terms_loadings", "document_frequencies"; values are `None` for
+        parts the segment does not contain. If `lazy`, arrays are
+        memory-mapped and metadata are `LazyCSVTable` objects.
+
+    """
+    segment_dir = Path(segment_dir)
+    read_table = LazyCSVTable if lazy else pd.read_csv
+    segment = {}
+    for (loadings_file, info_file), loadings_key, info_key in [
+        (_STUDIES_FILES, "studies_loadings", "studies_info"),
+        (_TERMS_FILES, "terms_loadings", "document_frequencies"),
+    ]:
+        segment[loadings_key], segment[info_key] = None, None
+        if (segment_dir / loadings_file).is_file():
+            segment[loadings_key] = np.load(
+                str(segment_dir / loadings_file),
+                mmap_mode="r" if lazy else None,
+            )
+            segment[info_key] = read_table(str(segment_dir / info_file))
+    return segment
+
+
+def compact_segments(segments_dir=None):
+    """Merge all segments into one, and delete the merged segments.
+
+    Returns the directory of the new segment, or `None` if there were fewer
+    than two segments.
+    """
+    if segments_dir is None:
+        segments_dir = get_default_segments_dir()
+    segments = list_segments(segments_dir)
+    if len(segments) < 2:
+        return None
+    loaded = [read_segment(segment_dir) for segment_dir in segments]
+    merged = {}
+    for key in (
+        "studies_loadings",
+        "studies_info",
+        "terms_loadings",
+        "document_frequencies",
+    ):
+        parts = [
+            segment[key] for segment in loaded if segment[key] is not None
+        ]
+        if not parts:
+            merged[key] = None
+        elif key.endswith("loadings"):
+            merged[key] = np.concatenate(parts)
+        else:
+            merged[key] = pd.concat(parts, ignore_index=True)
+    compacted = write_segment(
+        segments_dir,
+        replaces=[_segment_id(segment_dir) for segment_dir in segments],
+        **merged,
+    )
+    for segment_dir in segments:
+        shutil.rmtree(str(segment_dir), ignore_errors=True)
+    return compacted
@@ -0,0 +1,274 @@
+"""HTTP server answering image search requests with JSON results.
+
+The search data is loaded once when the server starts. Endpoints:
+
+- `GET /health`: `{"status": "ok", "n_studies": ..., "n_terms": ...}`
+- `GET /metrics`: batch size and queueing delay metrics, when requests are
+  batched (see `BatchScheduler`)
+- `POST /search`: the request body is either the content of a NIfTI file
+  (`.nii` or `.nii.gz`), or, if the server allows paths (`allow_paths`, or
+  `--allow_paths` on the command line), a JSON object
+  `{"path": "/path/to/img.nii.gz"}` (with `Content-Type: application/json`).
+  Search parameters `n_studies`,
+  `n_terms`, `transform`, `rescale_similarities` and `threshold` can be passed
+  in the query string or in the JSON object. The response is the same JSON as
+  the one written by `neuroquery_image_search -o results.json`.
+
+Searches are computed in a pool of worker threads (NumPy releases the GIL
+during matrix products) so the event loop keeps accepting connections. If
+`max_batch_size > 1`, concurrent requests are grouped into batches scored
+together.
+
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import gzip
+import json
+from urllib.parse import urlsplit, parse_qs
+
+import nibabel
+from nibabel.filebasedimages import ImageFileError
+
+from neuroquery_image_search._batching import BatchScheduler
+from neuroquery_image_search._searching import (
+    NeuroQueryImageSearch,
+    _results_to_json,
+)
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    500: "Internal Server Error",
+}
+_MAX_BODY_SIZE = 2**30
+
+
+class _RequestError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _load_nifti_bytes(content):
+    if content[:2] == b"\x1f\x8b":
+        content = gzip.decompress(content)
+    return nibabel.Nifti1Image.from_bytes(content)
+
+
+def _load_query_img(query_img):
+    """Load an uploaded image (bytes) or the header of an image file."""
+    if isinstance(query_img, bytes):
+        try:
+            img = _load_nifti_bytes(query_img)
+        except Exception as e:
+            raise _RequestError(f"Could not read NIfTI image: {e}")
+    else:
+        try:
+            img = nibabel.load(str(query_img))
+        except (OSError, ValueError, TypeError, ImageFileError) as e:
+            raise _RequestError(f"Could not read image: {e}")
+    if len(img.shape) != 3:
+        raise _RequestError(f"Expected a 3D image, got shape {img.shape}")
+    return img
+
+
+def _parse_search_params(params):
+    parsed = {}
+    try:
+        for name in "n_studies", "n_terms":
+            if name in params:
+                parsed[name] = int(params[name])
+        if "threshold" in params:
+            parsed["threshold"] = float(params["threshold"])
+    except (ValueError, TypeError) as e:
+        raise _RequestError(f"Invalid search parameter: {e}")
+    if "transform" in params:
+        if params["transform"] not in (
+            "absolute_value",
+            "identity",
+            "positive_part",
+        ):
+            raise _RequestError(f"Unknown transform: {params['transform']}")
+        parsed["transform"] = params["transform"]
+    if "rescale_similarities" in params:
+        parsed["rescale_similarities"] = str(
+            params["rescale_similarities"]
+        ).lower() not in ("0", "false", "no")
+    return parsed
+
+
+class SearchServer:
+    """Asyncio HTTP server wrapping a `NeuroQueryImageSearch`.
+
+    Parameters
+    ----------
+    search : `NeuroQueryImageSearch`. If `None`, one is created.
+
+    max_workers : number of threads computing searches.
+
+    allow_paths : whether requests can give the path of an image on the
+        server's filesystem rather than uploading it. `False` by default, as
+        it lets clients make the server read any file it has access to.
+
+    max_batch_size : if greater than 1, concurrent requests are grouped in
+        batches of at most this size by a `BatchScheduler`.
+
+    max_batch_delay : maximum time, in seconds, that a request waits for
+        other requests to form a batch.
+
+    """
+
+    def __init__(
+        self,
+        search=None,
+        max_workers=None,
+        allow_paths=False,
+        max_batch_size=1,
+        max_batch_delay=0.005,
+    ):
+        if search is None:
+            search = NeuroQueryImageSearch()
+        self.search = search
+        self.allow_paths = allow_paths
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.scheduler = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._server = None
+        self.port = None
+
+    async def start(self, host="127.0.0.1", port=8000):
+        """Start listening; `port=0` picks a free port (see `self.port`)."""
+        if self.max_batch_size > 1:
+            self.scheduler = BatchScheduler(
+                self.search,
+                max_batch_size=self.max_batch_size,
+                max_delay=self.max_batch_delay,
+                executor=self._executor,
+            )
+            self.scheduler.start()
+        self._server = await asyncio.start_server(self._handle, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self.scheduler is not None:
+            await self.scheduler.close()
+        self._executor.shutdown(wait=True)
+
+    async def _run_search(self, query_img, params):
+        # results are serialized directly, without building DataFrames
+        params = dict(params, compact=True)
+        if self.scheduler is not None:
+            results = await self.scheduler.submit(query_img, **params)
+        else:
+            results = await asyncio.get_event_loop().run_in_executor(
+                self._executor,
+                functools.partial(self.search, query_img, **params),
+            )
+        return _results_to_json(results)
+
+    async def _search(self, headers, query, body):
+        params = {key: values[-1] for key, values in parse_qs(query).items()}
+        if headers.get("content-type", "").startswith("application/json"):
+            try:
+                request = json.loads(body.decode("utf-8"))
+            except ValueError as e:
+                raise _RequestError(f"Invalid JSON: {e}")
+            if not isinstance(request, dict):
+                raise _RequestError("Expected a JSON object")
+            if not self.allow_paths:
+                raise _RequestError("Image paths are not allowed")
+            if "path" not in request:
+                raise _RequestError("Missing 'path'")
+            query_img = request.pop("path")
+            params.update(request)
+        else:
+            query_img = body
+        params = _parse_search_params(params)
+        # decompressing and parsing a large upload would block the event loop
+        query_img = await asyncio.get_event_loop().run_in_executor(
+            self._executor, _load_query_img, query_img
+        )
+        try:
+            return await self._run_search(query_img, params)
+        except (OSError, ValueError, TypeError, ImageFileError) as e:
+            raise _RequestError(f"Search failed: {e}")
+
+    async def _dispatch(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            raise _RequestError("Malformed request line")
+        method, target, _ = request_line
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        content_length = int(headers.get("content-length", 0))
+        if content_length > _MAX_BODY_SIZE:
+            raise _RequestError("Request body too large")
+        body = await reader.readexactly(content_length)
+        url = urlsplit(target)
+        if url.path == "/health" and method == "GET":
+            return json.dumps(
+                {
+                    "status": "ok",
+                    "n_studies": self.search.n_studies,
+                    "n_terms": self.search.n_terms,
+                }
+            )
+        if url.path == "/metrics" and method == "GET":
+            if self.scheduler is None:
+                return json.dumps({})
+            return json.dumps(self.scheduler.metrics.summary())
+        if url.path == "/search" and method == "POST":
+            return await self._search(headers, url.query, body)
+        raise _RequestError(f"Not found: {method} {url.path}", 404)
+
+    async def _handle(self, reader, writer):
+        try:
+            status, response = 200, await self._dispatch(reader)
+        except _RequestError as e:
+            status, response = e.status, json.dumps({"error": str(e)})
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, response = 400, json.dumps({"error": str(e)})
+        except Exception as e:
+            status, response = 500, json.dumps({"error": str(e)})
+        content = response.encode("utf-8")
+        writer.write(
+            (
+                f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(content)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("latin-1")
+            + content
+        )
+        await writer.drain()
+        writer.close()
+
+
+def serve(search=None, host="127.0.0.1", port=8000, **server_params):
+    """Run a `SearchServer` until interrupted.
+
+    `server_params` are passed to `SearchServer`.
+    """
+    server = SearchServer(search, **server_params)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(server.start(host, port))
+    print(f"Serving NeuroQuery image search on http://{host}:{server.port}")
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.close())
+        loop.close()
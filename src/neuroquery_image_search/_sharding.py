@@ -0,0 +1,173 @@
+"""Scoring the studies or terms loadings in row blocks on several threads.
+
+The loadings are split into contiguous blocks of rows ("shards"). Each shard
+is scored and reduced to its own top k in a thread pool; NumPy releases the
+GIL during the matrix product and the partial sort, so shards run in
+parallel. The per-shard top-k lists, which hold at most `n_shards * k`
+candidates, are then merged. Results are identical to scoring all rows at
+once, including the order of ties.
+
+Shards are views of the loadings (no copy), so memory-mapped loadings stay
+memory-mapped. When each shard runs on its own thread, BLAS should use a
+single thread (e.g. `OMP_NUM_THREADS=1`) to avoid oversubscribing the cores.
+
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+
+from neuroquery_image_search._profiling import stage
+from neuroquery_image_search._ranking import (
+    top_k_rows,
+    merge_top_k,
+    rescale_selected,
+)
+
+
+def _get_n_shards(n_shards):
+    if n_shards is None or n_shards == -1:
+        return os.cpu_count() or 1
+    if n_shards < 1:
+        raise ValueError(
+            f"n_shards must be a positive integer or -1, got {n_shards}"
+        )
+    return n_shards
+
+
+class ShardedScorer:
+    """Scores queries against row blocks of loadings in a thread pool.
+
+    Parameters
+    ----------
+    loadings : array of shape (n rows, n components)
+
+    n_shards : number of row blocks, each scored by its own thread. `-1` or
+        `None` means one shard per CPU. It is clipped to the number of rows.
+
+    weights : optional array of shape (n rows,) by which the scores are
+        multiplied (e.g. the terms weights).
+
+    name : name of the scored items, e.g. "studies". Scoring and selecting
+        the top k are recorded as "score_<name>" and "top_k" stages of the
+        `profiler` attribute (see `_profiling`) if it is not `None`.
+
+    """
+
+    def __init__(self, loadings, n_shards=-1, weights=None, name="rows"):
+        self.loadings = loadings
+        self.name = name
+        self.profiler = None
+        self.weights = None if weights is None else np.asarray(weights)
+        n_rows = loadings.shape[0]
+        self.n_shards = max(1, min(_get_n_shards(n_shards), n_rows))
+        self.shard_offsets = np.linspace(0, n_rows, self.n_shards + 1).astype(
+            int
+        )
+        self._executor = None
+
+    @property
+    def n_rows(self):
+        return self.loadings.shape[0]
+
+    def _map(self, func):
+        """Apply `func(start, stop)` to each shard, in the thread pool."""
+        bounds = list(zip(self.shard_offsets[:-1], self.shard_offsets[1:]))
+        if self.n_shards == 1:
+            return [func(*bounds[0])]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.n_shards)
+        return list(self._executor.map(lambda b: func(*b), bounds))
+
+    def _shard_scores(self, queries, start, stop):
+        with stage(self.profiler, f"score_{self.name}"):
+            scores = queries.dot(self.loadings[start:stop].T)
+            if self.weights is not None:
+                scores *= self.weights[start:stop]
+        return scores
+
+    def scores(self, queries):
+        """Scores of each query with all rows, shape (n queries, n rows)."""
+        queries = np.atleast_2d(queries)
+        if self.n_shards == 1:
+            return self._shard_scores(queries, 0, self.n_rows)
+        all_scores = np.empty(
+            (len(queries), self.n_rows),
+            dtype=np.result_type(queries, self.loadings),
+        )
+
+        def score_shard(start, stop):
+            all_scores[:, start:stop] = self._shard_scores(
+                queries, start, stop
+            )
+
+        self._map(score_shard)
+        return all_scores
+
+    def top_k(self, queries, k, rescale_similarities=False):
+        """The `k` rows with the largest scores for each query.
+
+        Returns
+        -------
+        indices : array of shape (n queries, min(k, n rows)), by decreasing
+            score; ties are broken by increasing index.
+
+        similarities : scores of the selected rows, rescaled to [0, 1] with
+            the minimum and maximum over all rows if `rescale_similarities`.
+
+        """
+        indices, similarities, low, high = self.top_k_with_range(queries, k)
+        if rescale_similarities:
+            similarities = rescale_selected(similarities, low, high)
+        return indices, similarities
+
+    def top_k_with_range(self, queries, k):
+        """Like `top_k`, also returning the range of all scores.
+
+        Returns
+        -------
+        indices, similarities : see `top_k`; similarities are not rescaled.
+
+        low, high : arrays of shape (n queries,), minimum and maximum score
+            over all rows.
+
+        """
+        queries = np.atleast_2d(queries)
+        n_queries = len(queries)
+        if not self.n_rows:
+            return (
+                np.empty((n_queries, 0), dtype=int),
+                np.empty((n_queries, 0)),
+                np.full(n_queries, np.nan),
+                np.full(n_queries, np.nan),
+            )
+
+        def shard_top_k(start, stop):
+            scores = self._shard_scores(queries, start, stop)
+            with stage(self.profiler, "top_k"):
+                selected = top_k_rows(scores, k)
+                return (
+                    selected + start,
+                    np.take_along_axis(scores, selected, axis=1),
+                    scores.min(axis=1),
+                    scores.max(axis=1),
+                )
+
+        shards = self._map(shard_top_k)
+        if len(shards) == 1:
+            return shards[0]
+        with stage(self.profiler, "top_k"):
+            indices, similarities = merge_top_k(
+                np.hstack([shard[0] for shard in shards]),
+                np.hstack([shard[1] for shard in shards]),
+                k,
+            )
+        low = np.minimum.reduce([shard[2] for shard in shards])
+        high = np.maximum.reduce([shard[3] for shard in shards])
+        return indices, similarities, low, high
+
+    def close(self):
+        """Shut down the thread pool; it is re-created if needed."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -0,0 +1,264 @@
+import io
+import mmap
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+class _RowIndexer:
+    def __init__(self, table):
+        self._table = table
+
+    def __getitem__(self, rows):
+        return self._table.take(rows)
+
+
+class LazyCSVTable:
+    """Read-only table backed by a CSV file, loaded only when needed.
+
+    Provides the subset of the `pandas.DataFrame` interface used by
+    `NeuroQueryImageSearch`: `len`, `columns`, `iloc[rows]` and
+    `table[column]`. Rows are parsed only when they are selected with `iloc`,
+    and a full column is parsed (once) only when it is accessed with
+    `table[column]`. The file is memory-mapped, so several processes reading
+    the same table share the page cache.
+
+    Parameters
+    ----------
+    csv_file : path to a CSV file with a header line
+
+    """
+
+    def __init__(self, csv_file):
+        self.csv_file = Path(csv_file)
+        self._line_starts = None
+        self._columns = {}
+        self._dtypes = None
+
+    @property
+    def iloc(self):
+        return _RowIndexer(self)
+
+    @property
+    def columns(self):
+        return self.dtypes.index
+
+    @property
+    def dtypes(self):
+        if self._dtypes is None:
+            self._dtypes = pd.read_csv(str(self.csv_file), nrows=1000).dtypes
+        return self._dtypes
+
+    @property
+    def shape(self):
+        return (len(self), len(self.columns))
+
+    def __len__(self):
+        return len(self._get_line_starts()) - 2
+
+    def __getitem__(self, column):
+        if column not in self._columns:
+            self._columns[column] = pd.read_csv(
+                str(self.csv_file), usecols=[column]
+            )[column]
+        return self._columns[column]
+
+    def _get_line_starts(self):
+        """Offsets of the start of each line, plus one past the last line.
+
+        Newlines inside quoted fields do not start a new line.
+        """
+        if self._line_starts is not None:
+            return self._line_starts
+        with open(self.csv_file, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                raw = np.frombuffer(content, dtype=np.uint8)
+                in_quotes = np.bitwise_xor.accumulate(raw == ord('"'))
+                line_ends = np.flatnonzero((raw == ord("\n")) & ~in_quotes)
+                size = len(raw)
+                del raw, in_quotes
+        line_starts = np.concatenate(([0], line_ends + 1))
+        if line_starts[-1] != size:
+            line_starts = np.append(line_starts, size)
+        self._line_starts = line_starts
+        return line_starts
+
+    def take(self, rows):
+        """Parse the selected rows and return them as a DataFrame.
+
+        The index of the result contains the row positions.
+        """
+        line_starts = self._get_line_starts()
+        rows = np.arange(len(self))[rows]
+        with open(self.csv_file, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                header = content[line_starts[0] : line_starts[1]]
+                lines = [
+                    content[line_starts[row + 1] : line_starts[row + 2]]
+                    for row in rows
+                ]
+        if lines and not lines[-1].endswith(b"\n"):
+            lines[-1] += b"\n"
+        string_columns = {
+            name: str for name, dtype in self.dtypes.items() if dtype == object
+        }
+        selected = pd.read_csv(
+            io.BytesIO(header + b"".join(lines)), dtype=string_columns
+        )
+        selected.index = rows
+        return selected
+
+    def to_dataframe(self):
+        """Load the whole table in a `pandas.DataFrame`."""
+        return pd.read_csv(str(self.csv_file))
+
+
+class ColumnarTable:
+    """Read-only table stored as one array per column.
+
+    Provides the same interface as `LazyCSVTable`. Numeric columns are plain
+    arrays; string columns are stored as the concatenated UTF-8 bytes of all
+    values, the offsets of each value and a boolean array marking missing
+    values, and strings are decoded only for the rows that are selected.
+
+    Parameters
+    ----------
+    columns : dict mapping column names to either a 1D array (numeric
+        columns) or a tuple `(offsets, bytes, missing)` (string columns)
+
+    n_rows : number of rows in the table
+
+    """
+
+    def __init__(self, columns, n_rows):
+        self._data = columns
+        self._n_rows = n_rows
+
+    @property
+    def iloc(self):
+        return _RowIndexer(self)
+
+    @property
+    def columns(self):
+        return pd.Index(list(self._data.keys()))
+
+    @property
+    def shape(self):
+        return (len(self), len(self._data))
+
+    def __len__(self):
+        return self._n_rows
+
+    def __getitem__(self, column):
+        return pd.Series(self._column(column, slice(None)), name=column)
+
+    def _column(self, column, rows):
+        values = self._data[column]
+        if not isinstance(values, tuple):
+            return values[rows]
+        offsets, raw, missing = values
+        rows = np.arange(self._n_rows)[rows]
+        decoded = np.empty(len(rows), dtype=object)
+        for i, row in enumerate(rows):
+            if missing[row]:
+                decoded[i] = np.nan
+            else:
+                decoded[i] = (
+                    raw[offsets[row] : offsets[row + 1]]
+                    .tobytes()
+                    .decode("utf-8")
+                )
+        return decoded
+
+    def take(self, rows):
+        """Return the selected rows as a DataFrame.
+
+        The index of the result contains the row positions.
+        """
+        rows = np.arange(self._n_rows)[rows]
+        return pd.DataFrame(
+            {column: self._column(column, rows) for column in self._data},
+            index=rows,
+        )
+
+    def to_dataframe(self):
+        """Load the whole table in a `pandas.DataFrame`."""
+        return pd.DataFrame(
+            {
+                column: self._column(column, slice(None))
+                for column in self._data
+            }
+        )
+
+
+class ConcatenatedTable:
+    """Read-only table made of several tables, one after the other.
+
+    Provides the same interface as `LazyCSVTable`, without copying the
+    tables: rows selected with `iloc` are taken from the table they belong
+    to. The tables can be DataFrames or other tables of this module, and
+    must have the same columns.
+
+    Parameters
+    ----------
+    tables : list of tables
+
+    """
+
+    def __init__(self, tables):
+        self.tables = list(tables)
+        self._offsets = np.cumsum([0] + [len(table) for table in self.tables])
+
+    @property
+    def iloc(self):
+        return _RowIndexer(self)
+
+    @property
+    def columns(self):
+        return self.tables[0].columns
+
+    @property
+    def shape(self):
+        return (len(self), len(self.columns))
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def __getitem__(self, column):
+        return pd.concat(
+            [pd.Series(table[column]) for table in self.tables],
+            ignore_index=True,
+        ).rename(column)
+
+    def take(self, rows):
+        """Return the selected rows as a DataFrame.
+
+        The index of the result contains the row positions.
+        """
+        rows = np.arange(len(self))[rows]
+        table_ids = np.searchsorted(self._offsets, rows, side="right") - 1
+        parts, positions = [], []
+        for table_id in np.unique(table_ids):
+            in_table = np.flatnonzero(table_ids == table_id)
+            table_rows = rows[in_table] - self._offsets[table_id]
+            parts.append(self.tables[table_id].iloc[table_rows])
+            positions.append(in_table)
+        if not parts:
+            return self.tables[0].iloc[[]]
+        selected = pd.concat(parts, ignore_index=True, sort=False)
+        selected = selected.iloc[np.argsort(np.concatenate(positions))]
+        selected.index = rows
+        return selected
+
+    def to_dataframe(self):
+        """Load the whole table in a `pandas.DataFrame`."""
+        return pd.concat(
+            [
+                table
+                if isinstance(table, pd.DataFrame)
+                else table.to_dataframe()
+                for table in self.tables
+            ],
+            ignore_index=True,
+        )
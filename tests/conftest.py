@@ -1,3 +1,4 @@
+import hashlib
 from pathlib import Path
 import tempfile
 from unittest.mock import MagicMock
@@ -12,6 +13,8 @@ from nilearn.datasets import _testing
 
 from nilearn.datasets._testing import request_mocker  # noqa: F401
 
+from neuroquery_image_search import _datasets
+
 
 def make_fake_img():
     rng = np.random.default_rng(0)
@@ -81,10 +84,12 @@ def temp_data_dir(tmp_path_factory, monkeypatch):
 
 
 @pytest.fixture(autouse=True, scope="function")
-def map_mock_requests(request_mocker):
-    request_mocker.url_mapping[
-        "https://osf.io/mx3t4/download"
-    ] = make_fake_data()
+def map_mock_requests(request_mocker, monkeypatch):
+    archive = make_fake_data()
+    request_mocker.url_mapping["https://osf.io/mx3t4/download"] = archive
+    monkeypatch.setattr(
+        _datasets, "_DATA_SHA256", hashlib.sha256(archive).hexdigest()
+    )
     return request_mocker
 
 
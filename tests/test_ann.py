@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+from neuroquery_image_search import _ann, _searching
+from neuroquery_image_search._ranking import top_k_rows
+
+
+def _make_vectors(n_rows=500, n_components=16, seed=0):
+    rng = np.random.default_rng(seed)
+    topics = rng.standard_normal((10, n_components))
+    vectors = topics[rng.integers(10, size=n_rows)]
+    return vectors + 0.3 * rng.standard_normal((n_rows, n_components))
+
+
+def test_ivf_index():
+    vectors = _make_vectors()
+    queries = _make_vectors(20, seed=1)
+    index = _ann.IVFIndex(vectors, n_lists=20, n_probe=3)
+    assert index.list_offsets[-1] == len(vectors)
+    assert sorted(index.row_ids) == list(range(len(vectors)))
+    assert index.vectors is vectors
+    expected = top_k_rows(queries.dot(vectors.T), 10)
+    indices, similarities = index.search(queries, 10, exact=True)
+    assert (indices == expected).all()
+    assert np.allclose(
+        similarities, np.take_along_axis(queries.dot(vectors.T), indices, 1)
+    )
+    indices, similarities = index.search(queries, 10)
+    assert indices.shape == (20, 10)
+    assert np.allclose(
+        similarities, np.take_along_axis(queries.dot(vectors.T), indices, 1)
+    )
+    assert (np.diff(similarities, axis=1) <= 0).all()
+    recalls = []
+    for n_probe in [1, 5, 20]:
+        index.n_probe = n_probe
+        recalls.append(_ann.recall_at_k(index, queries, 10))
+    assert recalls == sorted(recalls)
+    assert recalls[-1] == 1.0
+    assert recalls[1] > 0.8
+
+
+def test_ivf_index_saved_lists(monkeypatch):
+    vectors = _make_vectors()
+    queries = _make_vectors(20, seed=1)
+    index = _ann.IVFIndex(vectors, n_lists=20, n_probe=3)
+    lists = _ann.build_lists(vectors, n_lists=20)
+    monkeypatch.setattr(_ann, "build_lists", None)
+    loaded = _ann.IVFIndex(vectors, n_probe=3, lists=lists)
+    assert loaded.n_lists == 20
+    for result, expected in zip(
+        loaded.search(queries, 10), index.search(queries, 10)
+    ):
+        assert np.allclose(result, expected)
+    with pytest.raises(ValueError):
+        _ann.IVFIndex(vectors[:10], lists=lists)
+
+
+def test_ivf_index_small_lists():
+    vectors = _make_vectors(30)
+    index = _ann.IVFIndex(vectors, n_lists=30, n_probe=1)
+    indices, _ = index.search(vectors[:2], 12)
+    # lists are added until there are enough candidates
+    assert indices.shape == (2, 12)
+    assert len(set(indices[0])) == 12
+    indices, _ = index.search(vectors[:2], 100)
+    assert indices.shape == (2, 30)
+
+
+def test_ivf_rescaling():
+    vectors = _make_vectors(100)
+    query = _make_vectors(1, seed=3)
+    index = _ann.IVFIndex(vectors, n_lists=4, n_probe=4)
+    _, similarities = index.search(query, 100, rescale_similarities=True)
+    assert similarities.max() == pytest.approx(1.0)
+    assert similarities.min() == pytest.approx(0.0)
+    index.n_probe = 1
+    _, similarities = index.search(query, 5, rescale_similarities=True)
+    assert similarities[0, 0] == pytest.approx(1.0)
+
+
+def test_search_with_ann(fake_img):
+    exact = _searching.NeuroQueryImageSearch()(fake_img, 5, 3)
+    search = _searching.NeuroQueryImageSearch(ann={"n_lists": 3, "n_probe": 3})
+    results = search(fake_img, 5, 3)
+    for key, column in [("studies", "pmid"), ("terms", "term")]:
+        assert results[key][column].equals(exact[key][column])
+        assert np.allclose(
+            results[key]["similarity"], exact[key]["similarity"]
+        )
+    search.ann_index.n_probe = 1
+    results = search(fake_img, 5, 3)
+    assert len(results["studies"]) == 5
+    assert results["terms"].equals(exact["terms"])
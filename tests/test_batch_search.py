@@ -0,0 +1,110 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from neuroquery_image_search import _batch_search, _searching
+
+
+@pytest.fixture()
+def img_dir(tmp_path, fake_img):
+    img_dir = tmp_path / "imgs"
+    img_dir.mkdir()
+    for i in range(3):
+        fake_img.__class__(
+            np.asarray(fake_img.dataobj) * (i + 1), fake_img.affine
+        ).to_filename(str(img_dir / f"img_{i}.nii.gz"))
+    (img_dir / "notes.txt").write_text("not an image")
+    return img_dir
+
+
+def test_expand_query_imgs(tmp_path, img_dir):
+    paths = _batch_search.expand_query_imgs([str(img_dir)])
+    assert [p.split("/")[-1] for p in paths] == [
+        f"img_{i}.nii.gz" for i in range(3)
+    ]
+    assert _batch_search.expand_query_imgs([str(img_dir / "*_1.nii*")]) == [
+        paths[1]
+    ]
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text("# images\nimgs/img_2.nii.gz\n\n")
+    assert _batch_search.expand_query_imgs([paths[0]], str(manifest)) == [
+        paths[0],
+        str(tmp_path / "imgs" / "img_2.nii.gz"),
+    ]
+    with pytest.raises(FileNotFoundError):
+        _batch_search.expand_query_imgs([str(tmp_path / "*.nii")])
+    assert _batch_search.is_batch([str(img_dir)])
+    assert not _batch_search.is_batch([paths[0]])
+    assert _batch_search.image_names(["a/x.nii.gz", "b/x.nii", "y"]) == [
+        "x",
+        "x_1",
+        "y",
+    ]
+
+
+@pytest.mark.parametrize(
+    "n_jobs, pool_initializer", [(1, True), (2, True), (2, False)]
+)
+def test_batch_search(
+    tmp_path, img_dir, n_jobs, pool_initializer, monkeypatch
+):
+    monkeypatch.setattr(_batch_search, "_POOL_INITIALIZER", pool_initializer)
+    search = _searching.NeuroQueryImageSearch()
+    paths = _batch_search.expand_query_imgs([str(img_dir)])
+    output = tmp_path / "results.jsonl"
+    failed = _batch_search.batch_search(
+        search,
+        paths + [str(tmp_path / "missing.nii.gz")],
+        output,
+        n_studies=4,
+        n_terms=2,
+        n_jobs=n_jobs,
+        batch_size=2,
+    )
+    assert list(failed) == [str(tmp_path / "missing.nii.gz")]
+    lines = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [line["image"] for line in lines] == ["img_0", "img_1", "img_2"]
+    expected = search(paths[1], n_studies=4, n_terms=2)
+    assert (
+        pd.DataFrame(lines[1]["studies"])["pmid"].tolist()
+        == expected["studies"]["pmid"].tolist()
+    )
+
+
+def test_batch_search_directory_output(tmp_path, img_dir):
+    output = tmp_path / "out"
+    _searching.image_search(
+        [str(img_dir), "-o", str(output), "--output_format", "html"]
+    )
+    assert sorted(p.name for p in output.iterdir()) == [
+        f"img_{i}.html" for i in range(3)
+    ]
+    _searching.image_search(
+        [str(img_dir / "img_*.nii.gz"), "-o", str(output), "--n_studies", "3"]
+    )
+    results = json.loads((output / "img_0.json").read_text())
+    assert len(pd.DataFrame(results["studies"])) == 3
+    with pytest.raises(SystemExit):
+        _searching.image_search([str(img_dir)])
+    with pytest.raises(SystemExit):
+        _searching.image_search(
+            [str(img_dir), "-o", str(tmp_path / "results.json")]
+        )
+    assert not (tmp_path / "results.json").exists()
+    output_dir = tmp_path / "out.d"
+    output_dir.mkdir()
+    _searching.image_search([str(img_dir), "-o", str(output_dir)])
+    assert len(list(output_dir.iterdir())) == 3
+
+
+def test_batch_search_parquet(tmp_path, img_dir):
+    pytest.importorskip("pyarrow")
+    output = tmp_path / "results.parquet"
+    _searching.image_search(
+        [str(img_dir), "-o", str(output), "--n_studies", "3", "--n_terms", "2"]
+    )
+    results = pd.read_parquet(output)
+    assert len(results) == 3 * (3 + 2)
+    assert set(results["result_type"]) == {"study", "term"}
@@ -0,0 +1,48 @@
+import asyncio
+
+import numpy as np
+from nilearn import image
+
+from neuroquery_image_search import _batching, _searching
+
+
+def test_batch_scheduler(fake_img):
+    search = _searching.NeuroQueryImageSearch()
+    imgs = [
+        image.new_img_like(fake_img, image.get_data(fake_img) * sign)
+        for sign in [1.0, -1.0, 2.0]
+    ]
+
+    async def run():
+        scheduler = _batching.BatchScheduler(
+            search, max_batch_size=8, max_delay=0.5
+        )
+        scheduler.start()
+        try:
+            requests = [
+                scheduler.submit(img, n_studies=4, transform="identity")
+                for img in imgs
+            ]
+            requests.append(scheduler.submit(imgs[0], n_studies=2))
+            requests.append(scheduler.submit(image.concat_imgs(imgs)))
+            return scheduler, await asyncio.gather(
+                *requests, return_exceptions=True
+            )
+        finally:
+            await scheduler.close()
+
+    scheduler, all_results = asyncio.new_event_loop().run_until_complete(run())
+    for img, results in zip(imgs, all_results):
+        expected = search(img, n_studies=4, transform="identity")
+        assert (
+            results["studies"]["pmid"] == expected["studies"]["pmid"]
+        ).all()
+        assert np.allclose(
+            results["studies"]["similarity"], expected["studies"]["similarity"]
+        )
+    assert all_results[3]["studies"].shape[0] == 2
+    assert isinstance(all_results[4], ValueError)
+    metrics = scheduler.metrics.summary()
+    assert metrics["n_requests"] == 5
+    assert metrics["n_batches"] == 1
+    assert metrics["max_batch_size"] == 5
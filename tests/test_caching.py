@@ -0,0 +1,103 @@
+from concurrent.futures import ThreadPoolExecutor
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+from nilearn import image
+import pytest
+
+from neuroquery_image_search import _caching, _searching
+
+
+def test_result_cache(tmp_path):
+    cache = _caching.ResultCache(max_size=2, directory=tmp_path / "cache")
+    results = {"studies": pd.DataFrame({"a": [1, 2]})}
+    keys = [cache.key(np.arange(3.0) * i, {"n_studies": 3}) for i in range(3)]
+    assert cache.key(np.arange(3.0), {"n_studies": 4}) != keys[1]
+    assert cache.get(keys[0]) is None
+    for key in keys:
+        cache.put(key, results)
+    assert len(cache) == 2
+    cached = cache.get(keys[2])
+    assert cached["studies"].equals(results["studies"])
+    cached["studies"]["b"] = 0
+    assert "b" not in cache.get(keys[2])["studies"]
+    new_cache = _caching.ResultCache(directory=tmp_path / "cache")
+    assert new_cache.get(keys[0])["studies"].equals(results["studies"])
+    assert new_cache.stats() == {"hits": 1, "misses": 0, "size": 1}
+    new_cache.clear()
+    assert new_cache.get(keys[1]) is None
+    expiring = _caching.ResultCache(ttl=0.01)
+    expiring.put(keys[0], results)
+    time.sleep(0.02)
+    assert expiring.get(keys[0]) is None
+
+
+def test_search_with_cache(fake_img, monkeypatch):
+    cache = _caching.ResultCache()
+    search = _searching.NeuroQueryImageSearch(cache=cache)
+    expected = search(fake_img, 5, 3)
+    assert cache.stats() == {"hits": 0, "misses": 1, "size": 1}
+    project = search.projection.project
+    monkeypatch.setattr(search.projection, "project", None)
+    results = search(fake_img, 5, 3)
+    assert cache.hits == 1
+    assert results["image"] is not None
+    for key in "studies", "terms":
+        assert results[key].equals(expected[key])
+    monkeypatch.setattr(search.projection, "project", project)
+    neg_img = image.math_img("-img", img=fake_img)
+    # same image after taking the absolute value
+    search.search_many([neg_img, fake_img], 5, 3)
+    assert cache.stats() == {"hits": 3, "misses": 1, "size": 1}
+    search(fake_img, 6, 3)
+    assert cache.misses == 2
+
+
+def test_bad_disk_cache_file(tmp_path):
+    cache = _caching.ResultCache(directory=tmp_path)
+    key = cache.key(np.arange(3.0), {})
+    (tmp_path / f"{key}.pkl").write_bytes(b"\x80\x04cno_such_module\nX\n.")
+    assert cache.get(key) is None
+    assert not (tmp_path / f"{key}.pkl").exists()
+
+
+def test_disk_cache_concurrent_puts(tmp_path):
+    cache = _caching.ResultCache(directory=tmp_path / "cache")
+    key = cache.key(np.arange(3.0), {})
+    results = {"studies": pd.DataFrame({"a": [1, 2]})}
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda _: cache.put(key, results), range(32)))
+    assert [p.name for p in (tmp_path / "cache").iterdir()] == [f"{key}.pkl"]
+    new_cache = _caching.ResultCache(directory=tmp_path / "cache")
+    assert new_cache.get(key)["studies"].equals(results["studies"])
+
+
+def test_disk_cache_errors_are_ignored(tmp_path):
+    cache = _caching.ResultCache(directory=tmp_path / "cache")
+    key = cache.key(np.arange(3.0), {})
+    results = {"studies": pd.DataFrame({"a": [1, 2]})}
+    shutil.rmtree(tmp_path / "cache")
+    with pytest.warns(UserWarning, match="Disk cache error"):
+        cache.put(key, results)
+    assert cache.get(key)["studies"].equals(results["studies"])
+
+
+def test_disk_cache_data_changed(fake_img, tmp_path):
+    data = _searching.get_data()
+    search = _searching.NeuroQueryImageSearch(
+        cache=_caching.ResultCache(directory=tmp_path)
+    )
+    search(fake_img, 5, 3)
+    changed = dict(data, studies_loadings=data["studies_loadings"][::-1])
+    changed_search = _searching.NeuroQueryImageSearch(
+        data=changed, cache=_caching.ResultCache(directory=tmp_path)
+    )
+    changed_search(fake_img, 5, 3)
+    assert changed_search.cache.misses == 1
+    same_search = _searching.NeuroQueryImageSearch(
+        cache=_caching.ResultCache(directory=tmp_path)
+    )
+    same_search(fake_img, 5, 3)
+    assert same_search.cache.hits == 1
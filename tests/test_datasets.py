@@ -1,5 +1,25 @@
+import hashlib
+import http.server
+import json
+import os
+import re
+import shutil
+import socketserver
+import threading
+import time
+
+import numpy as np
+import requests
+
+import pytest
+
 from neuroquery_image_search import _datasets
 
+from .conftest import make_fake_data
+
+# the real requests, before they are replaced by the request_mocker fixture
+_REQUESTS_SEND = requests.Session.send
+
 
 def test_fetch_data(request_mocker):
 
@@ -15,3 +35,168 @@ def test_fetch_data(request_mocker):
     }
     data = _datasets.fetch_data()
     assert request_mocker.url_count == 1
+
+
+def test_fetch_data_lazy():
+    data = _datasets.fetch_data()
+    lazy_data = _datasets.fetch_data(lazy=True)
+    for key in "atlas_inv_covar", "studies_loadings", "terms_loadings":
+        assert isinstance(lazy_data[key], np.memmap)
+        assert (lazy_data[key] == data[key]).all()
+    for key in "studies_info", "document_frequencies":
+        table, lazy_table = data[key], lazy_data[key]
+        assert len(lazy_table) == len(table)
+        assert (lazy_table.columns == table.columns).all()
+        rows = [3, 0, 7, 3]
+        assert lazy_table.iloc[rows].equals(table.iloc[rows])
+        assert lazy_table.iloc[2:4].equals(table.iloc[2:4])
+        for column in table.columns:
+            assert lazy_table[column].equals(table[column])
+        assert lazy_table.to_dataframe().equals(table)
+
+
+class _RangeHandler(http.server.BaseHTTPRequestHandler):
+    content = b""
+    n_interrupted = 0
+
+    def do_GET(self):
+        content, status = self.content, 200
+        match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match and int(match.group(1)) >= len(content):
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{len(content)}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if match:
+            content, status = content[int(match.group(1)) :], 206
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if type(self).n_interrupted > 0:
+            type(self).n_interrupted -= 1
+            content = content[: len(content) // 2]
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadingHTTPServer(
+    socketserver.ThreadingMixIn, http.server.HTTPServer
+):
+    # http.server.ThreadingHTTPServer needs Python 3.7
+    daemon_threads = True
+
+
+@pytest.fixture()
+def archive_server(monkeypatch):
+    monkeypatch.setattr(requests.Session, "send", _REQUESTS_SEND)
+    _RangeHandler.content = make_fake_data()
+    server = _ThreadingHTTPServer(("127.0.0.1", 0), _RangeHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/data.tar.gz"
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_data(archive_server, tmp_path):
+    content = _RangeHandler.content
+    sha256 = hashlib.sha256(content).hexdigest()
+    data_dir = tmp_path / "extra"
+    data_dir.mkdir()
+    partial = data_dir / "neuroquery_image_search_data.tar.gz.part"
+    partial.write_bytes(content[:100])
+    _RangeHandler.n_interrupted = 1
+    _datasets._download_data(data_dir, url=archive_server, sha256=sha256)
+    assert (data_dir / "neuroquery_image_search_data").is_dir()
+    assert (data_dir / "neuroquery_image_search_data.tar.gz").read_bytes() == (
+        content
+    )
+    assert not partial.exists()
+    assert not (data_dir / "neuroquery_image_search_data.lock").exists()
+    assert sorted(p.name for p in data_dir.iterdir()) == [
+        "neuroquery_image_search_data",
+        "neuroquery_image_search_data.tar.gz",
+        "neuroquery_image_search_data.tar.gz.sha256",
+    ]
+
+
+def test_download_data_checksum(archive_server, tmp_path):
+    with pytest.raises(OSError, match="SHA-256"):
+        _datasets._download_data(tmp_path, url=archive_server, sha256="0")
+    assert not (tmp_path / "neuroquery_image_search_data").exists()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_download_data_range_not_satisfiable(archive_server, tmp_path):
+    content = _RangeHandler.content
+    sha256 = hashlib.sha256(content).hexdigest()
+    archive = tmp_path / "neuroquery_image_search_data.tar.gz"
+    partial = archive.with_name(f"{archive.name}.part")
+    # complete partial file
+    partial.write_bytes(content)
+    _datasets._download_data(tmp_path, url=archive_server, sha256=sha256)
+    assert archive.read_bytes() == content
+    shutil.rmtree(tmp_path / "neuroquery_image_search_data")
+    archive.unlink()
+    # partial file longer than the archive
+    partial.write_bytes(content + b"extra")
+    _datasets._download_data(tmp_path, url=archive_server, sha256=sha256)
+    assert archive.read_bytes() == content
+
+
+def test_download_data_published_sha256(request_mocker, monkeypatch):
+    archive = request_mocker.url_mapping["https://osf.io/mx3t4/download"]
+    metadata_url = "https://api.osf.io/v2/files/mx3t4/"
+    monkeypatch.setattr(_datasets, "_DATA_SHA256", None)
+    hashes = {"sha256": "0"}
+    metadata = {"data": {"attributes": {"extra": {"hashes": hashes}}}}
+    request_mocker.url_mapping[metadata_url] = json.dumps(metadata)
+    with pytest.raises(OSError, match="SHA-256"):
+        _datasets.fetch_data()
+    hashes["sha256"] = hashlib.sha256(archive).hexdigest()
+    request_mocker.url_mapping[metadata_url] = json.dumps(metadata)
+    assert "studies_loadings" in _datasets.fetch_data()
+    request_mocker.url_mapping[metadata_url] = "not json"
+    with pytest.raises(OSError, match="Could not get the SHA-256"):
+        _datasets._published_sha256()
+
+
+def test_download_data_lock(archive_server, tmp_path, monkeypatch):
+    lock_file = tmp_path / "neuroquery_image_search_data.lock"
+    lock_file.touch()
+    os.utime(lock_file, (0, 0))
+    _datasets._download_data(tmp_path, url=archive_server)
+    assert (tmp_path / "neuroquery_image_search_data").is_dir()
+    assert not lock_file.exists()
+
+
+def test_file_lock(tmp_path):
+    lock_file = tmp_path / "data.lock"
+    with _datasets._file_lock(lock_file) as lock:
+        os.utime(lock_file, (0, 0))
+        lock.refresh()
+        assert time.time() - lock_file.stat().st_mtime < 60
+        assert lock.is_held()
+    assert not lock_file.exists()
+    with _datasets._file_lock(lock_file) as lock:
+        # removed as stale and taken by another process
+        lock_file.write_text("123 other")
+        assert not lock.is_held()
+    assert lock_file.read_text() == "123 other"
+
+
+def test_download_data_reuses_archive(archive_server, tmp_path):
+    _datasets._download_data(tmp_path, url=archive_server)
+    target_dir = tmp_path / "neuroquery_image_search_data"
+    archive = tmp_path / "neuroquery_image_search_data.tar.gz"
+    shutil.rmtree(target_dir)
+    _datasets._download_data(tmp_path, url="http://127.0.0.1:1/unreachable")
+    assert target_dir.is_dir()
+    shutil.rmtree(target_dir)
+    archive.write_bytes(b"corrupted")
+    _datasets._download_data(tmp_path, url=archive_server)
+    assert archive.read_bytes() == _RangeHandler.content
+    assert target_dir.is_dir()
@@ -0,0 +1,44 @@
+import json
+import subprocess
+import sys
+
+# imported only when they are first used: plotting, downloads, and nilearn
+# (which imports scikit-learn and requests)
+_LAZY_MODULES = [
+    "matplotlib",
+    "nilearn",
+    "nilearn.plotting",
+    "pandas.io.formats.style",
+    "requests",
+    "sklearn",
+]
+
+
+def _imported_modules(code):
+    script = (
+        f"import json, sys\n{code}\n"
+        f"print(json.dumps([m for m in {_LAZY_MODULES!r} "
+        "if m in sys.modules]))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+    return json.loads(output.strip().split("\n")[-1])
+
+
+def test_import_is_lazy():
+    assert _imported_modules("import neuroquery_image_search") == []
+
+
+def test_cli_help_is_lazy():
+    code = (
+        "from neuroquery_image_search import _searching\n"
+        "try:\n"
+        "    _searching.image_search(['--help'])\n"
+        "except SystemExit:\n"
+        "    pass"
+    )
+    assert _imported_modules(code) == []
@@ -0,0 +1,90 @@
+import numpy as np
+
+import pytest
+
+from neuroquery_image_search import _ann, _index, _datasets, _searching
+
+
+def test_build_and_load_index(tmp_path):
+    data = _datasets.fetch_data()
+    index_file = _index.build_index(tmp_path / "index.bin", data=data)
+    index = _index.load_index(index_file)
+    assert set(data.keys()).issubset(index.keys())
+    assert (
+        index["masker"].mask_img_.get_fdata()
+        == data["masker"].mask_img_.get_fdata()
+    ).all()
+    assert (index["atlas_maps"] != data["atlas_maps"]).nnz == 0
+    for key in "atlas_inv_covar", "studies_loadings", "terms_loadings":
+        assert (index[key] == data[key]).all()
+        assert not index[key].flags.writeable
+    assert np.allclose(
+        index["folded_studies_loadings"],
+        data["studies_loadings"].dot(data["atlas_inv_covar"]),
+    )
+    for key in "studies_info", "document_frequencies":
+        assert index[key].to_dataframe().equals(data[key])
+        rows = [4, 1, 1]
+        assert index[key].iloc[rows].equals(data[key].iloc[rows])
+    assert sorted(index["ann_row_ids"]) == list(
+        range(len(data["studies_info"]))
+    )
+    assert index["ann_list_offsets"][-1] == len(index["ann_row_ids"])
+    (tmp_path / "not_an_index.bin").write_bytes(b"abc" * 10)
+    with pytest.raises(ValueError):
+        _index.load_index(tmp_path / "not_an_index.bin")
+
+
+def test_search_with_index(fake_img, tmp_path):
+    results = _searching.NeuroQueryImageSearch()(fake_img, 5, 3)
+    data = _index.load_index()
+    assert _index.get_default_index_file().is_file()
+    index_results = _searching.NeuroQueryImageSearch(data=data)(fake_img, 5, 3)
+    for key in "studies", "terms":
+        assert np.allclose(
+            results[key]["similarity"], index_results[key]["similarity"]
+        )
+        assert (
+            results[key]
+            .drop(columns="similarity")
+            .equals(index_results[key].drop(columns="similarity"))
+        )
+    index_file = tmp_path / "cli_index.bin"
+    output_file = tmp_path / "results.json"
+    _searching.image_search(
+        ["-o", str(output_file), "--index", str(index_file)]
+    )
+    assert index_file.is_file()
+    assert output_file.is_file()
+
+
+def test_search_with_index_ann(fake_img, tmp_path, monkeypatch):
+    data = _index.load_index(tmp_path / "index.bin")
+    exact = _searching.NeuroQueryImageSearch(data=data)(fake_img, 5, 3)
+    build_lists = _ann.build_lists
+    monkeypatch.setattr(_ann, "build_lists", None)
+    search = _searching.NeuroQueryImageSearch(data=data, ann={"n_probe": 100})
+    assert search.ann_index.row_ids is data["ann_row_ids"]
+    results = search(fake_img, 5, 3)
+    assert results["studies"]["pmid"].equals(exact["studies"]["pmid"])
+    monkeypatch.setattr(_ann, "build_lists", build_lists)
+    search = _searching.NeuroQueryImageSearch(data=data, ann={"n_lists": 2})
+    assert search.ann_index.n_lists == 2
+    search = _searching.NeuroQueryImageSearch(
+        data=data, projection="factored", ann={"n_probe": 100}
+    )
+    assert search.ann_index.row_ids is not data["ann_row_ids"]
+    output_file = tmp_path / "results.json"
+    with pytest.raises(SystemExit):
+        _searching.image_search(["-o", str(output_file), "--ann_n_probe", "2"])
+    _searching.image_search(
+        [
+            "-o",
+            str(output_file),
+            "--ann_n_probe",
+            "2",
+            "--index",
+            str(tmp_path / "index.bin"),
+        ]
+    )
+    assert output_file.is_file()
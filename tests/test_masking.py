@@ -0,0 +1,43 @@
+import numpy as np
+from nilearn import image
+
+from neuroquery_image_search import _masking, _datasets
+
+
+def test_query_masker(fake_img):
+    masker = _datasets.fetch_data()["masker"]
+    query_masker = _masking.QueryMasker(masker)
+    neg_img = image.new_img_like(fake_img, -image.get_data(fake_img))
+    shifted_img = image.new_img_like(
+        fake_img, image.get_data(fake_img), affine=2 * np.eye(4)
+    )
+    imgs = [fake_img, shifted_img, neg_img, shifted_img]
+    masked = query_masker.transform(imgs)
+    assert masked.shape == (4, masker.transform(fake_img).shape[1])
+    for img, masked_img in zip(imgs, masked):
+        assert np.allclose(masked_img, masker.transform(img).ravel())
+    assert query_masker.in_mask_space(fake_img)
+    assert not query_masker.in_mask_space(shifted_img)
+    assert len(query_masker._geometries) == 2
+
+
+def test_query_masker_non_finite(fake_img):
+    masker = _datasets.fetch_data()["masker"]
+    data = image.get_data(fake_img).copy()
+    data[1, 1, 1] = np.nan
+    data[2, 1, 3] = np.inf
+    nan_img = image.new_img_like(fake_img, data)
+    expected = masker.transform(nan_img).ravel()
+    assert np.isfinite(expected).all()
+    masked = _masking.QueryMasker(masker).transform([nan_img])
+    assert np.allclose(masked[0], expected)
+    shifted_img = image.new_img_like(
+        fake_img, data, affine=np.diag([1.1, 1, 1, 1])
+    )
+    finite_img = image.new_img_like(
+        fake_img, np.nan_to_num(data, posinf=0), affine=shifted_img.affine
+    )
+    query_masker = _masking.QueryMasker(masker, interpolation="linear")
+    masked = query_masker.transform([shifted_img, finite_img])
+    assert np.isfinite(masked).all()
+    assert np.allclose(masked[0], masked[1])
@@ -0,0 +1,98 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from neuroquery_image_search import _output, _searching
+
+
+def test_npz_output(tmp_path, fake_img):
+    search = _searching.NeuroQueryImageSearch()
+    output = tmp_path / "results.npz"
+    _searching.image_search(
+        ["-o", str(output), "--n_studies", "5", "--n_terms", "3"]
+    )
+    with np.load(output) as npz:
+        assert npz["studies_index"].shape == (1, 5)
+        assert npz["studies_similarity"].dtype == np.float32
+        assert npz["terms_index"].shape == (1, 3)
+        assert json.loads(str(npz["metadata"]))["n_studies"] == 12
+        pmids = npz["studies_pmid"]
+    names, all_results = _output.read_npz_results(output, search)
+    assert names == ["Image"]
+    expected = search(fake_img, n_studies=5, n_terms=3)
+    for key in "studies", "terms":
+        assert np.allclose(
+            all_results[0][key]["similarity"], expected[key]["similarity"]
+        )
+        pd.testing.assert_frame_equal(
+            all_results[0][key].drop(columns="similarity"),
+            expected[key].drop(columns="similarity"),
+        )
+    assert (pmids[0] == expected["studies"]["pmid"].values).all()
+    search.add_segment(
+        search.data["studies_loadings"][:2], search.data["studies_info"][:2]
+    )
+    with pytest.raises(ValueError, match="different search data"):
+        _output.read_npz_results(output, search)
+
+
+def test_empty_npz_output(tmp_path):
+    search = _searching.NeuroQueryImageSearch()
+    output = tmp_path / "results.npz"
+    _output.NPZWriter(output, search).close()
+    names, all_results = _output.read_npz_results(output, search)
+    assert names == [] and all_results == []
+
+
+def test_results_to_frame(fake_img):
+    search = _searching.NeuroQueryImageSearch()
+    results = search(fake_img, n_studies=4, n_terms=2)
+    frame = _output.results_to_frame([results, results], ["a", "b"])
+    assert len(frame) == 2 * (4 + 2)
+    studies = frame[
+        (frame["image"] == "b") & (frame["result_type"] == "study")
+    ]
+    assert studies["rank"].tolist() == list(range(4))
+    assert studies["pmid"].tolist() == results["studies"]["pmid"].tolist()
+    assert list(_output.results_to_frame([], []).columns) == [
+        "image",
+        "result_type",
+        "rank",
+        "similarity",
+    ]
+
+
+def test_open_writer(tmp_path, monkeypatch):
+    assert isinstance(
+        _output.open_writer(tmp_path / "r.jsonl", None),
+        _output.JSONLinesWriter,
+    )
+    assert isinstance(
+        _output.open_writer(tmp_path / "out", None), _output.DirectoryWriter
+    )
+    with pytest.raises(ValueError):
+        _output.open_writer(tmp_path / "out", None, "csv")
+    monkeypatch.setattr(_output.importlib.util, "find_spec", lambda name: None)
+    with pytest.raises(ImportError, match="requires pyarrow"):
+        _output.open_writer(tmp_path / "r.arrow", None)
+
+
+def test_score_matrix_output(tmp_path, fake_img):
+    search = _searching.NeuroQueryImageSearch()
+    img_path = tmp_path / "img.nii.gz"
+    fake_img.to_filename(str(img_path))
+    output = tmp_path / "scores.npy"
+    with pytest.raises(SystemExit):
+        _searching.image_search(
+            [str(img_path), str(tmp_path / "missing.nii"), "-o", str(output)]
+        )
+    scores = np.load(output, mmap_mode="r")
+    assert scores.shape == (2, 12)
+    assert scores.dtype == np.float32
+    expected = search.similarities(fake_img, rescale_similarities=True)
+    assert np.allclose(scores[0], expected["studies"][0])
+    assert np.isnan(scores[1]).all()
+    names = (tmp_path / "scores_images.txt").read_text().splitlines()
+    assert names == ["img", "missing"]
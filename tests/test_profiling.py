@@ -0,0 +1,78 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from neuroquery_image_search import _profiling, _searching
+
+
+def test_profiler():
+    received = []
+    profiler = _profiling.Profiler(
+        trace_allocations=True, callbacks=[received.append]
+    )
+    with profiler.stage("outer"):
+        with profiler.stage("inner"):
+            data = np.ones(10**6)
+        del data
+    with _profiling.stage(profiler, "inner"):
+        pass
+    with _profiling.stage(None, "ignored"):
+        pass
+    assert [record.stage for record in profiler.records] == [
+        "inner",
+        "outer",
+        "inner",
+    ]
+    assert received == profiler.records
+    inner, outer, _ = profiler.records
+    assert inner.allocated >= 8 * 10**6
+    assert outer.peak >= inner.peak >= 8 * 10**6
+    assert outer.allocated < 10**6
+    assert outer.seconds >= inner.seconds
+    totals = profiler.totals()
+    assert list(totals) == ["inner", "outer"]
+    assert totals["inner"]["count"] == 2
+    assert profiler.to_dataframe().shape == (3, 4)
+    assert "outer" in profiler.report()
+    profiler.clear()
+    assert profiler.records == []
+    assert profiler.to_dataframe().shape == (0, 4)
+    tracemalloc.stop()
+
+
+@pytest.mark.parametrize("params", [{}, {"n_shards": 2}, {"ann": {}}])
+def test_search_profiling(fake_img, params):
+    profiler = _profiling.Profiler()
+    search = _searching.NeuroQueryImageSearch(profiler=profiler, **params)
+    loaded = {record.stage for record in profiler.records}
+    assert "fetch_data/projections.npy" in loaded
+    assert "fetch_data/articles-info.csv" in loaded
+    profiler.clear()
+    search(fake_img)
+    stages = set(profiler.totals())
+    assert stages == {
+        "load",
+        "mask",
+        "transform",
+        "project",
+        "score_studies",
+        "score_terms",
+        "top_k",
+        "dataframes",
+    }
+    search.profiler = None
+    search(fake_img)
+    assert set(profiler.totals()) == stages
+    assert profiler.totals()["load"]["count"] == 1
+
+
+def test_image_search_profile(tmp_path, fake_img, capsys):
+    img_path = str(tmp_path / "img.nii.gz")
+    fake_img.to_filename(img_path)
+    _searching.image_search(
+        [img_path, "-o", str(tmp_path / "results.json"), "--profile"]
+    )
+    report = capsys.readouterr().err
+    assert "score_studies" in report
+    assert "fetch_data/mask.nii.gz" in report
@@ -0,0 +1,98 @@
+import numpy as np
+
+import pytest
+
+from neuroquery_image_search import _projection, _datasets, _searching
+
+
+@pytest.mark.parametrize(
+    "strategy", ["factored", "fold_loadings", "fold_atlas"]
+)
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_projection(strategy, dtype):
+    data = _datasets.fetch_data()
+    projection = _projection.Projection(data, strategy, dtype)
+    assert projection.strategy == strategy
+    assert projection.studies_loadings.dtype == dtype
+    assert projection.check(data)
+    masked = np.random.default_rng(0).random((3, data["atlas_maps"].shape[1]))
+    expected = (
+        data["atlas_inv_covar"]
+        .dot(data["atlas_maps"].dot(masked.T))
+        .T.dot(data["studies_loadings"].T)
+    )
+    similarities = projection.project(masked).dot(
+        projection.studies_loadings.T
+    )
+    assert np.allclose(similarities, expected, rtol=1e-4)
+
+
+def test_choose_projection():
+    data = _datasets.fetch_data()
+    assert _projection.Projection(data).strategy != "factored"
+    lazy_data = _datasets.fetch_data(lazy=True)
+    assert _projection.Projection(lazy_data).strategy != "fold_loadings"
+    data["folded_studies_loadings"] = data["studies_loadings"]
+    data["folded_terms_loadings"] = data["terms_loadings"]
+    assert _projection.Projection(data).strategy == "fold_loadings"
+    with pytest.raises(ValueError):
+        _projection.Projection(data, "unknown")
+
+
+def test_prepare_projection_fallback():
+    data = _datasets.fetch_data()
+    data["folded_studies_loadings"] = data["studies_loadings"]
+    data["folded_terms_loadings"] = data["terms_loadings"]
+    with pytest.warns(UserWarning, match="falling back"):
+        projection = _projection.prepare_projection(data)
+    assert projection.strategy == "factored"
+
+
+def test_check_samples_rows():
+    data = _datasets.fetch_data()
+    projection = _projection.Projection(data, "fold_loadings")
+    # only the first and last rows are compared
+    projection.studies_loadings[1:-1] = 0
+    assert projection.check(data, n_rows=2)
+    projection.studies_loadings[-1] = 0
+    assert not projection.check(data, n_rows=2)
+
+
+@pytest.mark.parametrize(
+    "strategy", ["factored", "fold_loadings", "fold_atlas"]
+)
+def test_search_projections(strategy, fake_img):
+    expected = _searching.NeuroQueryImageSearch(projection="factored")(
+        fake_img, 5, 3
+    )
+    results = _searching.NeuroQueryImageSearch(
+        projection=strategy, dtype=np.float32
+    )(fake_img, 5, 3)
+    for key in "studies", "terms":
+        assert np.allclose(
+            results[key]["similarity"], expected[key]["similarity"], atol=1e-4
+        )
+    assert (results["studies"]["pmid"] == expected["studies"]["pmid"]).all()
+
+
+@pytest.mark.parametrize(
+    "strategy", ["factored", "fold_loadings", "fold_atlas"]
+)
+def test_sparse_projection(strategy):
+    data = _datasets.fetch_data()
+    projection = _projection.Projection(data, strategy, max_cached_columns=2)
+    n_voxels = data["atlas_maps"].shape[1]
+    masked = np.zeros((2, n_voxels))
+    masked[:, [3, 11]] = np.random.default_rng(0).random((2, 2))
+    dense = projection.atlas_operator.dot(masked.T)
+    if projection.inv_covar is not None:
+        dense = projection.inv_covar.dot(dense)
+    expected = np.asarray(dense).T
+    assert np.allclose(projection.project(masked), expected)
+    assert not projection._column_operators
+    for columns in [3, 5, 11], [0, 3, 11], [3, 11]:
+        assert np.allclose(projection.project(masked, columns), expected)
+    assert len(projection._column_operators) == 2
+    operator = projection.columns_operator([3, 11])
+    assert projection.columns_operator([3, 11]) is operator
+    assert np.allclose(projection.project(np.zeros((1, n_voxels))), 0)
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from neuroquery_image_search import _quantization, _searching
+from neuroquery_image_search._ranking import top_k_rows
+
+
+@pytest.mark.parametrize("quantization", ["float32", "float16", "int8"])
+def test_quantized_loadings(quantization):
+    rng = np.random.default_rng(0)
+    loadings = rng.standard_normal((3000, 32))
+    # near-ties make the approximate ranking differ from the exact one
+    loadings[1:100] = loadings[0] + 1e-4 * rng.standard_normal((99, 32))
+    weights = rng.random(3000)
+    queries = np.vstack([loadings[0], rng.standard_normal((4, 32))])
+    quantized = _quantization.QuantizedLoadings(loadings, quantization)
+    assert quantized.codes.dtype == np.dtype(quantization)
+    assert quantized.nbytes < loadings.nbytes
+    for weights in [None, weights]:
+        quantized = _quantization.QuantizedLoadings(
+            loadings, quantization, weights=weights
+        )
+        exact_scores = queries.dot(loadings.T)
+        if weights is not None:
+            exact_scores *= weights
+        approximate = quantized.approximate_scores(queries)
+        errors = np.abs(approximate - exact_scores)
+        assert (
+            errors
+            <= np.linalg.norm(queries, axis=1)[:, None]
+            * quantized.error_bounds
+        ).all()
+        indices, similarities = quantized.top_k(queries, 20)
+        assert (indices == top_k_rows(exact_scores, 20)).all()
+        assert np.allclose(
+            similarities, np.take_along_axis(exact_scores, indices, 1)
+        )
+        _, rescaled = quantized.top_k(queries, 20, rescale_similarities=True)
+        low = exact_scores.min(axis=1, keepdims=True)
+        high = exact_scores.max(axis=1, keepdims=True)
+        assert np.allclose(rescaled, (similarities - low) / (high - low))
+
+
+def test_quantized_edge_cases():
+    loadings = np.zeros((5, 3))
+    quantized = _quantization.QuantizedLoadings(loadings, "int8")
+    indices, similarities = quantized.top_k(np.ones(3), 10, True)
+    assert indices.tolist() == [[0, 1, 2, 3, 4]]
+    assert (similarities == 0).all()
+    assert quantized.top_k(np.ones((2, 3)), 0)[0].shape == (2, 0)
+    with pytest.raises(ValueError):
+        _quantization.QuantizedLoadings(loadings, "int4")
+
+
+@pytest.mark.parametrize("quantization", ["float16", "int8"])
+def test_search_with_quantization(fake_img, quantization):
+    exact = _searching.NeuroQueryImageSearch()(fake_img, 5, 3)
+    search = _searching.NeuroQueryImageSearch(quantization=quantization)
+    results = search(fake_img, 5, 3)
+    for key, column in [("studies", "pmid"), ("terms", "term")]:
+        assert results[key][column].equals(exact[key][column])
+        assert np.allclose(
+            results[key]["similarity"], exact[key]["similarity"]
+        )
@@ -0,0 +1,47 @@
+import numpy as np
+
+import pytest
+
+from neuroquery_image_search import _ranking
+
+
+def _reference_top_k(scores, k):
+    return np.lexsort((np.arange(len(scores)), -scores))[:k]
+
+
+@pytest.mark.parametrize("k", [0, 1, 5, 29, 30, 50])
+def test_top_k(k):
+    rng = np.random.default_rng(0)
+    scores = rng.normal(size=30)
+    assert (_ranking.top_k(scores, k) == _reference_top_k(scores, k)).all()
+    scores = rng.integers(0, 4, size=30).astype(float)
+    assert (_ranking.top_k(scores, k) == _reference_top_k(scores, k)).all()
+    scores[[3, 7, 11]] = np.nan
+    assert (_ranking.top_k(scores, k) == _reference_top_k(scores, k)).all()
+
+
+@pytest.mark.parametrize("k", [0, 1, 5, 30, 50])
+def test_top_k_rows(k):
+    rng = np.random.default_rng(0)
+    scores = rng.normal(size=(6, 30))
+    scores[1] = rng.integers(0, 4, size=30)
+    scores[2, :5] = np.nan
+    scores[3] = 0.0
+    indices = _ranking.top_k_rows(scores, k)
+    assert indices.shape == (6, min(k, 30))
+    for row, row_indices in zip(scores, indices):
+        assert (row_indices == _reference_top_k(row, k)).all()
+
+
+def test_merge_top_k():
+    rng = np.random.default_rng(0)
+    scores = rng.integers(0, 4, size=(3, 40)).astype(float)
+    # candidates from two top-k lists, in any order
+    first = _ranking.top_k_rows(scores[:, :20], 5)
+    second = _ranking.top_k_rows(scores[:, 20:], 5) + 20
+    candidates = np.hstack([second, first])
+    indices, selected = _ranking.merge_top_k(
+        candidates, np.take_along_axis(scores, candidates, 1), 5
+    )
+    assert (indices == _ranking.top_k_rows(scores, 5)).all()
+    assert (selected == np.take_along_axis(scores, indices, 1)).all()
@@ -0,0 +1,59 @@
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+import pytest
+
+from neuroquery_image_search import _registry, _searching
+
+
+def _search_in_worker(img):
+    search = _searching.NeuroQueryImageSearch()
+    assert not search.data["studies_loadings"].flags.writeable
+    return search(img, 5, 3)
+
+
+def test_get_data():
+    search_a = _searching.NeuroQueryImageSearch()
+    search_b = _searching.NeuroQueryImageSearch()
+    assert search_a.data is search_b.data
+    assert search_a.projection is search_b.projection
+    search_c = _searching.NeuroQueryImageSearch(dtype=np.float32)
+    assert search_c.data is search_a.data
+    assert search_c.projection is not search_a.projection
+    assert _registry.get_data(lazy=True) is not search_a.data
+    _registry.clear()
+    assert _registry.get_data() is not search_a.data
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 8), reason="shared memory needs Python 3.8"
+)
+def test_publish_and_attach(fake_img, monkeypatch):
+    monkeypatch.delenv(_registry.SHARED_DATA_ENV, raising=False)
+    expected = _searching.NeuroQueryImageSearch()(fake_img, 5, 3)
+    with _registry.publish_data() as shared:
+        assert os.environ[_registry.SHARED_DATA_ENV] == shared.name
+        search = _searching.NeuroQueryImageSearch()
+        assert search.data is _registry.attach_data(shared.name)
+        assert "folded_studies_loadings" in search.data
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(1) as pool:
+            results = [
+                search(fake_img, 5, 3),
+                pool.apply(_search_in_worker, (fake_img,)),
+            ]
+        for result in results:
+            for key in "studies", "terms":
+                assert np.allclose(
+                    result[key]["similarity"], expected[key]["similarity"]
+                )
+                assert (
+                    result[key]
+                    .drop(columns="similarity")
+                    .equals(expected[key].drop(columns="similarity"))
+                )
+    assert _registry.SHARED_DATA_ENV not in os.environ
+    with pytest.raises(FileNotFoundError):
+        _registry.attach_data(shared.name)
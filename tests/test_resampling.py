@@ -0,0 +1,72 @@
+import numpy as np
+import nibabel
+from nilearn import image
+
+import pytest
+
+from neuroquery_image_search import _resampling, _datasets, _searching
+
+
+def _mask_geometry():
+    mask_img = _datasets.fetch_data()["masker"].mask_img_
+    mask = image.get_data(mask_img) != 0
+    return mask_img, np.nonzero(mask)
+
+
+def test_resampling_cache():
+    mask_img, mask_voxels = _mask_geometry()
+    rng = np.random.default_rng(0)
+    affine = np.diag([0.7, 0.8, 0.6, 1.0])
+    affine[:3, 3] = [-0.3, 0.2, -0.1]
+    imgs = [
+        nibabel.Nifti1Image(rng.random((7, 5, 8)), affine) for _ in range(3)
+    ]
+    cache = _resampling.ResamplingCache(mask_img.affine, mask_voxels)
+    for img in imgs:
+        expected = image.get_data(
+            image.resample_img(
+                img,
+                target_affine=mask_img.affine,
+                target_shape=mask_img.shape,
+                interpolation="linear",
+            )
+        )[mask_voxels]
+        assert np.allclose(cache.transform(img), expected)
+    assert len(cache._operators) == 1
+    resampled = cache.transform(image.concat_imgs(imgs))
+    assert resampled.shape == (len(mask_voxels[0]), 3)
+    assert np.allclose(resampled[:, 1], cache.transform(imgs[1]))
+
+
+def test_resampling_cache_eviction():
+    mask_img, mask_voxels = _mask_geometry()
+    cache = _resampling.ResamplingCache(
+        mask_img.affine, mask_voxels, "nearest", max_size=2
+    )
+    data = np.random.default_rng(0).random(mask_img.shape)
+    img = nibabel.Nifti1Image(data, mask_img.affine)
+    assert np.allclose(cache.transform(img), data[mask_voxels])
+    for shift in [1, 2]:
+        affine = mask_img.affine.copy()
+        affine[0, 3] += shift
+        cache.operator(affine, mask_img.shape)
+    assert len(cache._operators) == 2
+    with pytest.raises(ValueError):
+        _resampling.ResamplingCache(mask_img.affine, mask_voxels, "cubic")
+
+
+def test_search_with_resampling(fake_img):
+    img = image.new_img_like(
+        fake_img, image.get_data(fake_img), affine=np.diag([1.1, 1, 1, 1])
+    )
+    search = _searching.NeuroQueryImageSearch(interpolation="linear")
+    results = search(img, 5, 3)
+    assert results["studies"].shape == (5, 4)
+    assert len(search._masker.resampling._operators) == 1
+    imgs = [img, fake_img, image.math_img("-img", img=img)]
+    all_results = search.search_many(imgs, 5, 3)
+    for img, results in zip(imgs, all_results):
+        expected = search(img, 5, 3)
+        assert np.allclose(
+            results["studies"]["similarity"], expected["studies"]["similarity"]
+        )
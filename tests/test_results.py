@@ -0,0 +1,79 @@
+import json
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from neuroquery_image_search import _results, _searching, _tables
+
+
+def _table():
+    return pd.DataFrame(
+        {
+            "pmid": [10, 11, 12, 13, 14],
+            "title": ["a", "b", np.nan, "d", "e"],
+        }
+    )
+
+
+def test_search_hits():
+    table = _table()
+    index, similarity = np.array([3, 0, 2]), np.array([0.9, 0.5, 0.1])
+    hits = _results.SearchHits(table, index, similarity)
+    assert len(hits) == 3
+    assert hits.columns == ["pmid", "title", "similarity"]
+    assert (hits["pmid"] == [13, 10, 12]).all()
+    assert hits["similarity"] is similarity
+    expected = table.iloc[index].reset_index(drop=True)
+    expected["similarity"] = similarity
+    assert hits.to_dataframe().equals(expected)
+    assert json.dumps(hits.to_dict(), allow_nan=True) == json.dumps(
+        expected.to_dict(), allow_nan=True
+    )
+    assert _results.as_dataframe(expected) is expected
+    assert _results.as_dataframe(hits).equals(expected)
+
+
+def test_search_hits_columnar_table():
+    table = _table()
+    columnar = _tables.ColumnarTable(
+        {
+            "pmid": table["pmid"].values,
+            "title": (
+                np.array([0, 1, 2, 2, 3, 4]),
+                np.frombuffer(b"abde", dtype="uint8"),
+                np.array([False, False, True, False, False]),
+            ),
+        },
+        5,
+    )
+    index, similarity = np.array([4, 2]), np.array([0.3, 0.2])
+    hits = _results.SearchHits(columnar, index, similarity)
+    frame = hits.to_dataframe()
+    assert list(frame["pmid"]) == [14, 12]
+    assert frame["title"][0] == "e" and pd.isnull(frame["title"][1])
+
+
+def test_search_hits_pickle():
+    hits = _results.SearchHits(_table(), np.array([1, 4]), np.array([1.0, 0]))
+    loaded = pickle.loads(pickle.dumps(hits))
+    assert loaded.table is None
+    assert loaded.to_dataframe().equals(hits.to_dataframe())
+    copied = hits.copy()
+    copied.similarity[0] = 2.0
+    assert hits.similarity[0] == 1.0
+
+
+def test_compact_search(fake_img):
+    search = _searching.NeuroQueryImageSearch()
+    results = search(fake_img, 5, 3)
+    compact = search(fake_img, 5, 3, compact=True)
+    for key in "studies", "terms":
+        assert isinstance(compact[key], _results.SearchHits)
+        assert compact[key].to_dataframe().equals(results[key])
+    assert json.loads(_searching._results_to_json(compact)) == json.loads(
+        _searching._results_to_json(results)
+    )
+    assert "studies-table" in _searching.studies_to_html_table(
+        compact["studies"]
+    )
@@ -75,3 +75,118 @@ def test_neuroquery_image_search(fake_img):
         .all()
         .all()
     )
+
+
+def test_search_many(fake_img):
+    search = _searching.NeuroQueryImageSearch()
+    neg_img = image.new_img_like(fake_img, image.get_data(fake_img) * -1.0)
+    imgs = [fake_img, neg_img]
+    for batch in [imgs, image.concat_imgs(imgs)]:
+        all_results = search.search_many(batch, 5, 3, transform="identity")
+        assert len(all_results) == 2
+        for img, results in zip(imgs, all_results):
+            expected = search(img, 5, 3, transform="identity")
+            for key in "studies", "terms":
+                assert (results[key].columns == expected[key].columns).all()
+                assert np.allclose(
+                    results[key]["similarity"], expected[key]["similarity"]
+                )
+            assert (
+                results["studies"]["pmid"] == expected["studies"]["pmid"]
+            ).all()
+    assert search.search_many([]) == []
+
+
+def test_similarities(fake_img):
+    search = _searching.NeuroQueryImageSearch()
+    neg_img = image.new_img_like(fake_img, image.get_data(fake_img) * -1.0)
+    similarities = search.similarities([fake_img, neg_img])
+    assert similarities["studies"].shape == (2, 12)
+    assert similarities["terms"].shape == (2, 9)
+    assert similarities["studies"].dtype == np.float32
+    assert np.allclose(similarities["studies"][0], similarities["studies"][1])
+    results = search(fake_img, n_studies=12, n_terms=9)
+    rescaled = search.similarities(fake_img, rescale_similarities=True)
+    for key, info in [
+        ("studies", search.data["studies_info"]),
+        ("terms", search.data["document_frequencies"]),
+    ]:
+        order = np.argsort(-similarities[key][0], kind="stable")
+        assert (
+            info.iloc[order].reset_index(drop=True).iloc[:, 0]
+            == results[key].iloc[:, 0]
+        ).all()
+        assert np.allclose(
+            rescaled[key][0][order], results[key]["similarity"], atol=1e-6
+        )
+    assert search.similarities([])["studies"].shape == (0, 12)
+
+
+def test_roi_and_threshold(fake_img):
+    search = _searching.NeuroQueryImageSearch()
+    data = image.get_data(fake_img)
+    roi = np.zeros(data.shape)
+    roi.ravel()[[2, 5, 6, 17]] = 1
+    roi_img = image.new_img_like(fake_img, roi)
+    expected = search(image.new_img_like(fake_img, data * roi), 5, 3)
+    for _ in range(2):
+        results = search(fake_img, 5, 3, roi=roi_img)
+        assert np.allclose(
+            results["studies"]["similarity"], expected["studies"]["similarity"]
+        )
+        assert (results["terms"]["term"] == expected["terms"]["term"]).all()
+    assert len(search.projection._column_operators) == 1
+    thresholded = image.new_img_like(fake_img, data * (data >= 0.5))
+    expected = search.similarities(thresholded)
+    similarities = search.similarities(fake_img, threshold=0.5)
+    assert np.allclose(similarities["studies"], expected["studies"])
+
+
+def test_lazy_search(fake_img):
+    results = _searching.NeuroQueryImageSearch()(fake_img, 5, 3)
+    lazy_results = _searching.NeuroQueryImageSearch(lazy=True)(fake_img, 5, 3)
+    for key in "studies", "terms":
+        assert results[key].equals(lazy_results[key])
+
+
+def test_html_tables():
+    terms = pd.DataFrame(
+        {
+            "term": ["a b", "c"],
+            "document_frequency": [1, 2],
+            "similarity": [1.0, 0.25],
+        }
+    )
+    table = _searching.terms_to_html_table(terms)
+    assert "query?text=a+b' target='_blank'>a b</a>" in table
+    assert "lightgreen 95.0%, transparent 95.0%)'>1.00</td>" in table
+    assert "lightgreen 23.8%, transparent 23.8%)'>0.25</td>" in table
+    assert "Term" not in terms.columns
+    studies = pd.DataFrame(
+        {
+            "pmid": [1, 2],
+            "title": ["t1", "t2"],
+            "pubmed_url": ["u1", "u2"],
+            "similarity": [0.5, -1.0],
+        }
+    )
+    table = _searching.studies_to_html_table(studies)
+    assert table.startswith('<table class="studies-table">')
+    assert "<a href='u2' target='_blank'>t2</a>" in table
+    assert "lightgreen 98.0%, transparent 98.0%)'>0.50</td>" in table
+    assert "lightgreen 0.0%, transparent 0.0%)'>-1.00</td>" in table
+    assert table.count("<tr>") == 3
+
+
+def test_results_to_html(fake_img):
+    results = _searching.NeuroQueryImageSearch()(fake_img, 3, 2)
+    viewer = _searching.results_to_html(results, "my title").get_standalone()
+    static = _searching.results_to_html(
+        results, img_display="static"
+    ).get_standalone()
+    assert "data:image/png;base64," in static
+    assert len(static) < len(viewer)
+    no_img = _searching.results_to_html(results, img_display="none")
+    assert "<iframe" not in no_img.get_standalone()
+    with pytest.raises(ValueError):
+        _searching.results_to_html(results, img_display="3d")
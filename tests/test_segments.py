@@ -0,0 +1,176 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from neuroquery_image_search import _segments, _searching
+from neuroquery_image_search._caching import ResultCache
+
+
+def _make_segment(n_studies, n_terms, seed=0, n_components=8):
+    rng = np.random.default_rng(seed)
+    studies_info = pd.DataFrame(
+        {"pmid": 1000 * (seed + 1) + np.arange(n_studies)}
+    )
+    studies_info["title"] = [f"new title {p}" for p in studies_info["pmid"]]
+    studies_info["pubmed_url"] = [f"url {p}" for p in studies_info["pmid"]]
+    document_frequencies = pd.DataFrame(
+        {
+            "term": [f"new_term_{seed}_{i}" for i in range(n_terms)],
+            "document_frequency": np.arange(n_terms) + 3,
+        }
+    )
+    return {
+        "studies_loadings": rng.random((n_studies, n_components)),
+        "studies_info": studies_info,
+        "terms_loadings": rng.random((n_terms, n_components)),
+        "document_frequencies": document_frequencies,
+    }
+
+
+def test_write_read_compact_segments(tmp_path):
+    segments_dir = tmp_path / "segments"
+    assert _segments.list_segments(segments_dir) == []
+    first = _make_segment(3, 2)
+    _segments.write_segment(segments_dir, **first)
+    studies_only = _make_segment(4, 0, seed=1)
+    _segments.write_segment(
+        segments_dir,
+        studies_loadings=studies_only["studies_loadings"],
+        studies_info=studies_only["studies_info"],
+    )
+    segments = _segments.list_segments(segments_dir)
+    assert [p.name for p in segments] == ["segment_000001", "segment_000002"]
+    loaded = _segments.read_segment(segments[0])
+    assert np.allclose(loaded["studies_loadings"], first["studies_loadings"])
+    assert loaded["document_frequencies"].equals(first["document_frequencies"])
+    lazy = _segments.read_segment(segments[1], lazy=True)
+    assert isinstance(lazy["studies_loadings"], np.memmap)
+    assert lazy["terms_loadings"] is None
+    assert (
+        lazy["studies_info"]
+        .iloc[[1]]
+        .equals(studies_only["studies_info"].iloc[[1]])
+    )
+    compacted = _segments.compact_segments(segments_dir)
+    assert _segments.list_segments(segments_dir) == [compacted]
+    merged = _segments.read_segment(compacted)
+    assert len(merged["studies_info"]) == 7
+    assert len(merged["document_frequencies"]) == 2
+    assert _segments.compact_segments(segments_dir) is None
+    with pytest.raises(ValueError):
+        _segments.write_segment(
+            segments_dir, studies_loadings=first["studies_loadings"]
+        )
+    with pytest.raises(ValueError):
+        _segments.write_segment(
+            segments_dir,
+            studies_loadings=first["studies_loadings"][:2],
+            studies_info=first["studies_info"],
+        )
+
+
+def _check_same_results(results, expected):
+    for key, column in [("studies", "pmid"), ("terms", "term")]:
+        assert results[key][column].tolist() == expected[key][column].tolist()
+        assert np.allclose(
+            results[key]["similarity"], expected[key]["similarity"]
+        )
+
+
+@pytest.mark.parametrize(
+    "search_params",
+    [{}, {"quantization": "int8"}, {"ann": {"n_lists": 2, "n_probe": 2}}],
+)
+def test_search_with_segments(tmp_path, fake_img, search_params):
+    search = _searching.NeuroQueryImageSearch(
+        segments_dir=tmp_path / "segments", **search_params
+    )
+    segments = [_make_segment(5, 4), _make_segment(2, 3, seed=1)]
+    for segment in segments:
+        search.add_segment(**segment)
+    assert search.n_studies == 12 + 7
+    assert search.n_terms == 9 + 7
+    data = dict(search.data)
+    for loadings_key, info_key in [
+        ("studies_loadings", "studies_info"),
+        ("terms_loadings", "document_frequencies"),
+    ]:
+        data[loadings_key] = np.concatenate(
+            [data[loadings_key]] + [s[loadings_key] for s in segments]
+        )
+        data[info_key] = pd.concat(
+            [data[info_key]] + [s[info_key] for s in segments],
+            ignore_index=True,
+        )
+    expected_search = _searching.NeuroQueryImageSearch(data=data)
+    for n_studies, n_terms in [(30, 30), (4, 2)]:
+        _check_same_results(
+            search(fake_img, n_studies, n_terms),
+            expected_search(fake_img, n_studies, n_terms),
+        )
+    similarities = search.similarities(fake_img)
+    assert np.allclose(
+        similarities["studies"],
+        expected_search.similarities(fake_img)["studies"],
+    )
+    # segments written in segments_dir are found by new search objects
+    reloaded = _searching.NeuroQueryImageSearch(
+        segments_dir=tmp_path / "segments", lazy=True
+    )
+    _check_same_results(
+        reloaded(fake_img, 30, 30), expected_search(fake_img, 30, 30)
+    )
+    assert search.compact_segments() is not None
+    compacted = _searching.NeuroQueryImageSearch(
+        segments_dir=tmp_path / "segments"
+    )
+    _check_same_results(
+        compacted(fake_img, 30, 30), expected_search(fake_img, 30, 30)
+    )
+
+
+def test_add_segment_clears_cache(fake_img):
+    cache = ResultCache()
+    search = _searching.NeuroQueryImageSearch(cache=cache)
+    search(fake_img)
+    assert len(cache) == 1
+    segment = _make_segment(2, 2)
+    with pytest.raises(ValueError, match="columns"):
+        search.add_segment(
+            segment["studies_loadings"],
+            segment["studies_info"].drop(columns="title"),
+        )
+    search.add_segment(**segment)
+    assert len(cache) == 0
+    results = search(fake_img, n_studies=20)
+    assert len(results["studies"]) == 14
+    with pytest.raises(ValueError, match="segments_dir"):
+        search.compact_segments()
+
+
+@pytest.mark.parametrize("projection", ["factored", "fold_loadings"])
+@pytest.mark.parametrize("with_dir", [False, True])
+def test_add_invalid_segment(fake_img, tmp_path, projection, with_dir):
+    search = _searching.NeuroQueryImageSearch(
+        projection=projection,
+        segments_dir=(tmp_path / "segments") if with_dir else None,
+    )
+    segment = _make_segment(3, 2)
+    wrong_components = _make_segment(3, 2, n_components=5)
+    for invalid, match in [
+        ({"studies_loadings": segment["studies_loadings"]}, "needed"),
+        (
+            dict(segment, studies_info=segment["studies_info"].iloc[:2]),
+            "one row",
+        ),
+        (
+            dict(segment, terms_loadings=wrong_components["terms_loadings"]),
+            "components",
+        ),
+    ]:
+        with pytest.raises(ValueError, match=match):
+            search.add_segment(**invalid)
+        assert search.n_studies == 12 and search.n_terms == 9
+        assert len(search(fake_img)["studies"]) == 12
+    if with_dir:
+        assert not _segments.list_segments(tmp_path / "segments")
@@ -0,0 +1,171 @@
+import asyncio
+import json
+from unittest.mock import MagicMock
+
+from nilearn import image
+
+from neuroquery_image_search import _server, _searching
+
+
+async def _request(port, method, path, body=b"", headers=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    headers = dict(headers or {}, **{"Content-Length": str(len(body))})
+    head = f"{method} {path} HTTP/1.1\r\n" + "".join(
+        f"{name}: {value}\r\n" for name, value in headers.items()
+    )
+    writer.write(head.encode("latin-1") + b"\r\n" + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    status_line, _, content = response.partition(b"\r\n\r\n")
+    return int(status_line.split()[1]), json.loads(content.decode("utf-8"))
+
+
+def test_search_server(fake_img, tmp_path):
+    search = _searching.NeuroQueryImageSearch()
+    img_path = tmp_path / "img.nii.gz"
+    fake_img.to_filename(str(img_path))
+    img_4d_path = tmp_path / "img_4d.nii.gz"
+    image.concat_imgs([fake_img, fake_img]).to_filename(str(img_4d_path))
+    expected = json.loads(
+        _searching._results_to_json(search(fake_img, n_studies=4, n_terms=2))
+    )
+
+    async def run():
+        server = _server.SearchServer(search, max_workers=2, allow_paths=True)
+        await server.start(port=0)
+        port = server.port
+        try:
+            status, health = await _request(port, "GET", "/health")
+            assert status == 200
+            assert health["n_studies"] == 12
+            status, uploaded = await _request(
+                port,
+                "POST",
+                "/search?n_studies=4&n_terms=2",
+                img_path.read_bytes(),
+            )
+            assert status == 200
+            assert uploaded == expected
+            body = json.dumps(
+                {"path": str(img_path), "n_studies": 4, "n_terms": 2}
+            ).encode("utf-8")
+            status, from_path = await _request(
+                port,
+                "POST",
+                "/search",
+                body,
+                {"Content-Type": "application/json"},
+            )
+            assert status == 200
+            assert from_path == expected
+            status, error = await _request(port, "POST", "/search", b"abc")
+            assert status == 400
+            assert "NIfTI" in error["error"]
+            for request in {"path": str(tmp_path / "img.txt")}, ["path"]:
+                (tmp_path / "img.txt").write_text("not an image")
+                status, error = await _request(
+                    port,
+                    "POST",
+                    "/search",
+                    json.dumps(request).encode("utf-8"),
+                    {"Content-Type": "application/json"},
+                )
+                assert status == 400
+                assert "error" in error
+            for n_studies in None, [1]:
+                body = json.dumps(
+                    {"path": str(img_path), "n_studies": n_studies}
+                ).encode("utf-8")
+                status, error = await _request(
+                    port,
+                    "POST",
+                    "/search",
+                    body,
+                    {"Content-Type": "application/json"},
+                )
+                assert status == 400
+                assert "parameter" in error["error"]
+            status, error = await _request(
+                port, "POST", "/search", img_4d_path.read_bytes()
+            )
+            assert status == 400
+            assert "3D" in error["error"]
+            status, _ = await _request(port, "GET", "/unknown")
+            assert status == 404
+        finally:
+            await server.close()
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+
+def test_search_server_errors(fake_img, tmp_path):
+    search = MagicMock(side_effect=RuntimeError("unexpected"))
+    img_path = tmp_path / "img.nii.gz"
+    fake_img.to_filename(str(img_path))
+
+    async def run():
+        server = _server.SearchServer(search)
+        await server.start(port=0)
+        try:
+            internal_error = await _request(
+                server.port, "POST", "/search", img_path.read_bytes()
+            )
+            body = json.dumps({"path": str(img_path)}).encode("utf-8")
+            path_error = await _request(
+                server.port,
+                "POST",
+                "/search",
+                body,
+                {"Content-Type": "application/json"},
+            )
+        finally:
+            await server.close()
+        return internal_error, path_error
+
+    internal_error, path_error = asyncio.new_event_loop().run_until_complete(
+        run()
+    )
+    assert internal_error == (500, {"error": "unexpected"})
+    assert path_error[0] == 400
+    assert "not allowed" in path_error[1]["error"]
+
+
+def test_serve_cli(monkeypatch):
+    serve = MagicMock()
+    monkeypatch.setattr(_server, "serve", serve)
+    _searching.image_search(["--serve", "--port", "8123"])
+    assert serve.call_args[1]["port"] == 8123
+    assert not serve.call_args[1]["allow_paths"]
+    _searching.image_search(["--serve", "--allow_paths"])
+    assert serve.call_args[1]["allow_paths"]
+
+
+def test_search_server_batching(fake_img, tmp_path):
+    img_path = tmp_path / "img.nii.gz"
+    fake_img.to_filename(str(img_path))
+
+    async def run():
+        server = _server.SearchServer(max_batch_size=4, max_batch_delay=0.2)
+        await server.start(port=0)
+        try:
+            responses = await asyncio.gather(
+                *[
+                    _request(
+                        server.port, "POST", "/search", img_path.read_bytes()
+                    )
+                    for _ in range(3)
+                ]
+            )
+            _, metrics = await _request(server.port, "GET", "/metrics")
+        finally:
+            await server.close()
+        return responses, metrics
+
+    responses, metrics = asyncio.new_event_loop().run_until_complete(run())
+    assert [status for status, _ in responses] == [200] * 3
+    assert (
+        responses[0][1]["studies"]["pmid"]
+        == responses[2][1]["studies"]["pmid"]
+    )
+    assert metrics["n_requests"] == 3
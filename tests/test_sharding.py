@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from neuroquery_image_search import _sharding, _searching
+from neuroquery_image_search._ranking import top_k_rows
+
+
+@pytest.mark.parametrize("n_shards", [1, 3, 7, 500])
+def test_sharded_scorer(n_shards):
+    rng = np.random.default_rng(0)
+    loadings = rng.standard_normal((200, 16))
+    # ties across shard boundaries are broken by index
+    loadings[50:150:10] = loadings[0]
+    weights = rng.random(200)
+    queries = np.vstack([loadings[0], rng.standard_normal((3, 16))])
+    for weights in [None, weights]:
+        scorer = _sharding.ShardedScorer(loadings, n_shards, weights=weights)
+        assert scorer.n_shards == min(n_shards, 200)
+        expected = queries.dot(loadings.T)
+        if weights is not None:
+            expected *= weights
+        assert np.allclose(scorer.scores(queries), expected)
+        indices, similarities, low, high = scorer.top_k_with_range(queries, 15)
+        assert (indices == top_k_rows(expected, 15)).all()
+        assert np.allclose(
+            similarities, np.take_along_axis(expected, indices, 1)
+        )
+        assert np.allclose(low, expected.min(axis=1))
+        assert np.allclose(high, expected.max(axis=1))
+        indices, _ = scorer.top_k(queries, 300)
+        assert indices.shape == (4, 200)
+        _, rescaled = scorer.top_k(queries, 5, rescale_similarities=True)
+        assert np.allclose(rescaled[:, 0], 1.0)
+        scorer.close()
+    with pytest.raises(ValueError, match="n_shards"):
+        _sharding.ShardedScorer(loadings, 0)
+
+
+def test_search_with_shards(fake_img):
+    expected = _searching.NeuroQueryImageSearch()(fake_img, 5, 3)
+    search = _searching.NeuroQueryImageSearch(n_shards=4)
+    assert search._studies_scorer.n_shards == 4
+    results = search(fake_img, 5, 3)
+    for key in ["studies", "terms"]:
+        assert (
+            results[key]
+            .drop(columns="similarity")
+            .equals(expected[key].drop(columns="similarity"))
+        )
+        assert np.allclose(
+            results[key]["similarity"], expected[key]["similarity"]
+        )
+    similarities = search.similarities(fake_img)
+    assert similarities["studies"].shape == (1, search.n_studies)
+
+
+def test_close_search(fake_img):
+    with _searching.NeuroQueryImageSearch(n_shards=2) as search:
+        results = search(fake_img, 5, 3)
+        assert search._studies_scorer._executor is not None
+    assert search._studies_scorer._executor is None
+    assert search._terms_scorer._executor is None
+    assert search(fake_img, 5, 3)["studies"].equals(results["studies"])
+    search.close()
@@ -0,0 +1,37 @@
+import pandas as pd
+
+from neuroquery_image_search import _tables
+
+
+def test_lazy_csv_table(tmp_path):
+    df = pd.DataFrame(
+        {
+            "pmid": [1, 2, 3, 4],
+            "title": ["a, b", 'with "quotes"\nand newline', "1984", "d"],
+        }
+    )
+    csv_file = tmp_path / "table.csv"
+    df.to_csv(csv_file, index=False)
+    table = _tables.LazyCSVTable(csv_file)
+    assert len(table) == 4
+    assert table.shape == (4, 2)
+    assert table.iloc[[1, 2]].equals(df.iloc[[1, 2]])
+    assert table.iloc[[]].shape == (0, 2)
+    assert table["title"].equals(df["title"])
+
+
+def test_concatenated_table(tmp_path):
+    df = pd.DataFrame({"pmid": [1, 2, 3], "title": ["a", "b", "c"]})
+    other = pd.DataFrame({"pmid": [4, 5], "title": ["d", "e"]})
+    csv_file = tmp_path / "table.csv"
+    other.to_csv(csv_file, index=False)
+    expected = pd.concat([df, other, df], ignore_index=True)
+    table = _tables.ConcatenatedTable([df, _tables.LazyCSVTable(csv_file), df])
+    assert len(table) == 8
+    assert table.shape == (8, 2)
+    assert list(table.columns) == ["pmid", "title"]
+    rows = [6, 3, 0, 3, 7]
+    assert table.iloc[rows].equals(expected.iloc[rows])
+    assert table.iloc[[]].shape == (0, 2)
+    assert table["title"].equals(expected["title"])
+    assert table.to_dataframe().equals(expected)